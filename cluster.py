@@ -0,0 +1,210 @@
+# cluster.py
+# Multi-process mode: several gateway shard processes share data/cluster.db (SQLite, WAL), a small state service holding
+# leases (which process owns each guild economy, which one is the leader for cluster-wide jobs) and the lottery schedule.
+# `python cluster.py --simulate` checks the lease/claim protocol with a model shard (_sim_shard) behind a fake gateway,
+# including a leader crash. The model reimplements the bot's load/heartbeat/draw logic; it does not run working_money_bot.py.
+
+import os
+import time
+import queue
+import random
+import socket
+import shutil
+import sqlite3
+import asyncio
+import logging
+import argparse
+import tempfile
+import multiprocessing
+
+logger = logging.getLogger(__name__)
+
+LEADER_LEASE = "leader"
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS lottery_schedule (
+    guild_id INTEGER PRIMARY KEY,
+    due REAL NOT NULL
+);
+"""
+
+def guild_lease(guild_id: int) -> str: return f"guild:{int(guild_id)}"
+def shard_for_guild(guild_id: int, shard_count: int) -> int: return (int(guild_id) >> 22) % shard_count # Discord's gateway routing
+def make_owner_id(label: str) -> str:
+    """Unique per process incarnation: a restarted process must not inherit the leases of the one it replaces."""
+    return f"{label}@{socket.gethostname()}:{os.getpid()}:{os.urandom(3).hex()}"
+
+class LeaseHeld(RuntimeError):
+    """The lease is held by another live process."""
+    def __init__(self, name: str, holder: str): super().__init__(f"{name} is held by {holder}"); self.name = name; self.holder = holder
+
+class ClusterState:
+    """Leases and the shared lottery schedule. Blocking; the bot runs every call on the persistence executor.
+
+    A lease is held until `expires_at`; the holder extends all of its leases with renew(). Work that must happen once
+    cluster-wide is claimed with a conditional write that only succeeds while the claimer still holds the named lease,
+    so a process that stalled past its lease (and was replaced) cannot also do it.
+    """
+    def __init__(self, path: str, owner: str, lease_seconds: float = 30.0, clock=time.time):
+        self.path = path; self.owner = owner; self.lease_seconds = lease_seconds; self.clock = clock
+        dirname = os.path.dirname(path)
+        if dirname: os.makedirs(dirname, exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=10.0, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL"); self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.stats = {"acquired": 0, "contended": 0, "renewals": 0, "lost": 0, "claims": 0}
+    def close(self):
+        try: self.conn.close()
+        except Exception as e: logger.error(f"Error closing cluster state: {e}")
+
+    # --- Leases ---
+    def try_acquire(self, name: str) -> str:
+        """Takes (or extends) the lease if it is free, expired or already ours. Returns the live holder after the attempt."""
+        now = self.clock(); cur = self.conn.cursor(); cur.execute("BEGIN IMMEDIATE")
+        try:
+            row = cur.execute("SELECT owner, expires_at FROM leases WHERE name = ?", (name,)).fetchone()
+            if row and row[0] != self.owner and row[1] > now: cur.execute("COMMIT"); self.stats["contended"] += 1; return row[0]
+            cur.execute("INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at",
+                        (name, self.owner, now + self.lease_seconds))
+            cur.execute("COMMIT")
+        except Exception:
+            cur.execute("ROLLBACK"); raise
+        if not row or row[0] != self.owner: self.stats["acquired"] += 1
+        return self.owner
+    def renew(self) -> set[str]:
+        """Extends every lease this process still holds. Returns their names; a lease missing from it was lost (expired and taken)."""
+        now = self.clock()
+        self.conn.execute("UPDATE leases SET expires_at = ? WHERE owner = ? AND expires_at > ?", (now + self.lease_seconds, self.owner, now))
+        self.stats["renewals"] += 1
+        return {name for (name,) in self.conn.execute("SELECT name FROM leases WHERE owner = ?", (self.owner,))}
+    def holds(self, name: str) -> bool:
+        return self.conn.execute("SELECT 1 FROM leases WHERE name = ? AND owner = ? AND expires_at > ?", (name, self.owner, self.clock())).fetchone() is not None
+    def holder(self, name: str) -> str | None:
+        row = self.conn.execute("SELECT owner FROM leases WHERE name = ? AND expires_at > ?", (name, self.clock())).fetchone()
+        return row[0] if row else None
+    def release(self, name: str): self.conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, self.owner))
+    def release_all(self): self.conn.execute("DELETE FROM leases WHERE owner = ?", (self.owner,))
+
+    # --- Lottery schedule ---
+    def schedule_draw(self, guild_id: int, due: float):
+        self.conn.execute("INSERT INTO lottery_schedule (guild_id, due) VALUES (?, ?) ON CONFLICT(guild_id) DO UPDATE SET due = excluded.due", (int(guild_id), due))
+    def cancel_draw(self, guild_id: int): self.conn.execute("DELETE FROM lottery_schedule WHERE guild_id = ?", (int(guild_id),))
+    def draws(self) -> dict[int, float]: return dict(self.conn.execute("SELECT guild_id, due FROM lottery_schedule").fetchall())
+    def due_draws(self, now: float | None = None) -> dict[int, float]:
+        return dict(self.conn.execute("SELECT guild_id, due FROM lottery_schedule WHERE due <= ? ORDER BY due", (self.clock() if now is None else now,)).fetchall())
+    def claim_draw(self, guild_id: int, lease: str) -> bool:
+        """Removes the guild's due draw if this process holds `lease`. True = this caller (and no other) runs the draw."""
+        now = self.clock()
+        claimed = self.conn.execute("DELETE FROM lottery_schedule WHERE guild_id = ? AND due <= ? AND EXISTS (SELECT 1 FROM leases WHERE name = ? AND owner = ? AND expires_at > ?)",
+                                    (int(guild_id), now, lease, self.owner, now)).rowcount == 1
+        if claimed: self.stats["claims"] += 1
+        return claimed
+    def summary(self) -> str:
+        st = self.stats; held = self.conn.execute("SELECT COUNT(*) FROM leases WHERE owner = ? AND expires_at > ?", (self.owner, self.clock())).fetchone()[0]
+        return (f"owner={self.owner} leases={held} leader={self.holds(LEADER_LEASE)} acquired={st['acquired']} contended={st['contended']} "
+                f"lost={st['lost']} claims={st['claims']} renewals={st['renewals']}")
+
+# --- Protocol model (fake gateway) ---
+SIM_SCHEMA = "CREATE TABLE IF NOT EXISTS sim_draws (guild_id INTEGER NOT NULL, owner TEXT NOT NULL, orphan INTEGER NOT NULL, t REAL NOT NULL);"
+
+async def _sim_shard(db_path: str, data_dir: str, shard_id: int, inbox, lease_seconds: float, idle_seconds: float, shard_count: int):
+    """Model of one shard process, mirroring working_money_bot.py's load_guild_economy / cluster_tick / lottery_drawing
+    on top of the real ClusterState, ShardCache and LedgerStore: owns the guilds the gateway routes to it, draws their
+    lotteries, and while leader also draws lotteries of guilds whose owner is gone (orphans). Keep it in step with the bot."""
+    from shards import ShardCache
+    from ledger_store import LedgerStore
+    owner = make_owner_id(f"shard{shard_id}"); cluster = ClusterState(db_path, owner, lease_seconds); cluster.conn.executescript(SIM_SCHEMA)
+    async def load(guild_id: int):
+        while cluster.try_acquire(guild_lease(guild_id)) != owner: await asyncio.sleep(lease_seconds / 10) # A crashed predecessor's lease must expire first
+        store = LedgerStore(os.path.join(data_dir, str(guild_id), "economy.db")); return store, store.load_users()
+    async def unload(guild_id: int, shard): shard[0].close(); cluster.release(guild_lease(guild_id))
+    guilds = ShardCache(load, unload, idle_seconds)
+    async def draw(guild_id: int, orphan: bool):
+        if cluster.claim_draw(guild_id, guild_lease(guild_id)): cluster.conn.execute("INSERT INTO sim_draws VALUES (?, ?, ?, ?)", (guild_id, owner, int(orphan), time.time()))
+    async def heartbeat():
+        while True:
+            held = cluster.renew(); leader = cluster.try_acquire(LEADER_LEASE) == owner
+            for guild_id in [g for g in guilds.keys() if guild_lease(g) not in held]:
+                if cluster.try_acquire(guild_lease(guild_id)) != owner: cluster.stats["lost"] += 1; logger.error(f"{owner} lost guild {guild_id}")
+            for guild_id in cluster.due_draws():
+                if shard_for_guild(guild_id, shard_count) == shard_id: await guilds.get(guild_id); await draw(guild_id, False)
+                elif leader and cluster.holder(guild_lease(guild_id)) is None: await guilds.get(guild_id); await draw(guild_id, True); await guilds.evict(guild_id)
+            await guilds.evict_idle()
+            await asyncio.sleep(lease_seconds / 3)
+    beat = asyncio.create_task(heartbeat()); loop = asyncio.get_running_loop()
+    while True:
+        try: event = await loop.run_in_executor(None, inbox.get, True, 0.1)
+        except queue.Empty: continue
+        if event[0] == "crash": os._exit(0) # Leases are left to expire, like a killed process
+        if event[0] == "stop": break
+        _, guild_id, user_id = event; store, users = await guilds.get(guild_id)
+        row = users.setdefault(user_id, {"balance": 0, "savings": 0, "pin": None, "best_win": 0}); row["balance"] += 1000
+        store.commit(users={user_id: row})
+    beat.cancel(); await guilds.close(); cluster.release_all(); cluster.close()
+
+def _sim_process(*args):
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s:%(levelname)s:%(processName)s: %(message)s')
+    asyncio.run(_sim_shard(*args))
+
+def simulate(shard_count: int, guild_count: int, events: int, seconds: float, lease_seconds: float, seed: int) -> bool:
+    """Fake gateway: routes message events to shard processes by Discord's guild->shard rule, crashes the leader's
+    process halfway and restarts it after a pause, then checks balances, draw counts and leadership hand-over."""
+    from ledger_store import LedgerStore
+    rng = random.Random(seed); workdir = tempfile.mkdtemp(prefix="cluster-sim-"); db_path = os.path.join(workdir, "cluster.db")
+    try:
+        gateway = ClusterState(db_path, make_owner_id("gateway"), lease_seconds)
+        guild_ids = [rng.getrandbits(40) << 22 | rng.getrandbits(22) for _ in range(guild_count)] # Snowflake-shaped IDs
+        for guild_id in guild_ids: gateway.schedule_draw(guild_id, time.time() + rng.uniform(0, seconds * 0.8))
+        ctx = multiprocessing.get_context("spawn"); inboxes = [ctx.Queue() for _ in range(shard_count)]
+        def start(shard_id: int):
+            proc = ctx.Process(target=_sim_process, name=f"shard{shard_id}", args=(db_path, workdir, shard_id, inboxes[shard_id], lease_seconds, lease_seconds * 2, shard_count))
+            proc.start(); return proc
+        procs = [start(i) for i in range(shard_count)]; sent: dict[int, int] = {}; leaders = set(); crashed = None; started = time.time()
+        for i in range(events):
+            guild_id = rng.choice(guild_ids); inboxes[shard_for_guild(guild_id, shard_count)].put(("msg", guild_id, rng.randint(1, 50))); sent[guild_id] = sent.get(guild_id, 0) + 1
+            if (leader := gateway.holder(LEADER_LEASE)): leaders.add(leader)
+            if crashed is None and i >= events // 2 and leader:
+                crashed = int(leader.split("@", 1)[0].removeprefix("shard")); inboxes[crashed].put(("crash",)); crash_at = time.time()
+                print(f"Crashed the leader ({leader}) after {i:,} events.")
+            if crashed is not None and procs[crashed].exitcode is not None and time.time() - crash_at > lease_seconds * 1.5:
+                procs[crashed] = start(crashed); print(f"Restarted shard{crashed}."); crashed = -1
+            time.sleep(max(0.0, started + seconds * (i + 1) / events - time.time()))
+        if crashed is not None and crashed >= 0: procs[crashed].join(); procs[crashed] = start(crashed)
+        deadline = time.time() + seconds + lease_seconds * 4
+        while gateway.draws() and time.time() < deadline:
+            if (leader := gateway.holder(LEADER_LEASE)): leaders.add(leader)
+            time.sleep(0.2)
+        for inbox in inboxes: inbox.put(("stop",))
+        for proc in procs: proc.join(timeout=lease_seconds * 4)
+        credited = {}
+        for guild_id in sent:
+            store = LedgerStore(os.path.join(workdir, str(guild_id), "economy.db")); credited[guild_id] = sum(u["balance"] for u in store.load_users().values()) // 1000; store.close()
+        draw_counts = dict(gateway.conn.execute("SELECT guild_id, COUNT(*) FROM sim_draws GROUP BY guild_id").fetchall())
+        orphans = gateway.conn.execute("SELECT COUNT(*) FROM sim_draws WHERE orphan = 1").fetchone()[0]
+        lost_events = sum(sent.values()) - sum(credited.values()); double = [g for g, n in draw_counts.items() if n > 1]; missed = [g for g in guild_ids if g not in draw_counts]
+        leftover = gateway.conn.execute("SELECT COUNT(*) FROM leases WHERE expires_at > ?", (time.time(),)).fetchone()[0]
+        ok = lost_events == 0 and not double and not missed and len(leaders) >= 2 and leftover == 0
+        print(f"{shard_count} shards, {guild_count} guilds, {sum(sent.values()):,} events in {time.time() - started:.1f}s: credited={sum(credited.values()):,} lost={lost_events} "
+              f"draws={sum(draw_counts.values())}/{guild_count} (orphan={orphans}) double={len(double)} missed={len(missed)} leaders={len(leaders)} leftover_leases={leftover} -> {'PASS' if ok else 'FAIL'}")
+        gateway.close(); return ok
+    finally: shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s:%(levelname)s:%(name)s: %(message)s')
+    parser = argparse.ArgumentParser(description="Inspect data/cluster.db, or simulate a multi-process cluster locally.")
+    parser.add_argument("--db", default=os.path.join("data", "cluster.db"))
+    parser.add_argument("--simulate", action="store_true", help="Check the lease/claim protocol with model shard processes behind a fake gateway (not the bot's own code).")
+    parser.add_argument("--shards", type=int, default=3); parser.add_argument("--guilds", type=int, default=40)
+    parser.add_argument("--events", type=int, default=3000); parser.add_argument("--seconds", type=float, default=12.0)
+    parser.add_argument("--lease", type=float, default=1.5, help="Lease length in seconds (the bot uses CLUSTER_LEASE_SECONDS).")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    if args.simulate: raise SystemExit(0 if simulate(args.shards, args.guilds, args.events, args.seconds, args.lease, args.seed) else 1)
+    state = ClusterState(args.db, "inspect"); now = time.time()
+    for name, owner, expires_at in state.conn.execute("SELECT name, owner, expires_at FROM leases ORDER BY name"): print(f"{name:<28} {owner:<48} {'expires in' if expires_at > now else 'expired'} {abs(expires_at - now):.1f}s")
+    print(f"{len(state.draws())} lottery draws scheduled, {len(state.due_draws())} due.")
+    state.close()
@@ -0,0 +1,400 @@
+# economy.py
+# In-memory economy bookkeeping shared by the bot: slotted user records, running money-supply aggregates, lottery ticket ledger,
+# purchase-order book, leaderboard rank indexes, chat reward accumulator, lock-striped balance operations.
+# `python economy.py --stress` runs the concurrency harness, `--memory` the user-record memory benchmark.
+
+import time
+import random
+import asyncio
+import logging
+import bisect
+import argparse
+import contextlib
+
+from money import MILLI, Milli, fmt_coins
+
+try: from sortedcontainers import SortedList
+except ImportError: SortedList = None
+
+logger = logging.getLogger(__name__)
+
+POOL_KEYS = ("slot_jackpot_pool", "lottery_pot")
+
+def _num(value) -> int | float:
+    return value if isinstance(value, (int, float)) and not isinstance(value, bool) else 0
+
+class UserRecord:
+    """One user's economy row. Slotted (no per-instance dict) and type-checked once, in from_row();
+    hot paths use the attributes. record["balance"] / .get() / dict(record) keep dict-style callers working."""
+    __slots__ = ("balance", "savings", "pin", "best_win")
+    def __init__(self, balance: Milli = 0, savings: Milli = 0, pin: str | None = None, best_win: Milli = 0):
+        self.balance = balance; self.savings = savings; self.pin = pin; self.best_win = best_win
+    @classmethod
+    def from_row(cls, row) -> "UserRecord":
+        """Builds a record from a loaded row (dict or record), replacing bad values with defaults."""
+        pin = row.get("pin")
+        return cls(_num(row.get("balance", 0)), _num(row.get("savings", 0)), pin if isinstance(pin, str) else None, _num(row.get("best_win", 0)))
+    def __getitem__(self, key: str):
+        try: return getattr(self, key)
+        except (AttributeError, TypeError): raise KeyError(key) from None
+    def __setitem__(self, key: str, value):
+        if key not in self.__slots__: raise KeyError(key)
+        setattr(self, key, value)
+    def __contains__(self, key) -> bool: return key in self.__slots__
+    def get(self, key: str, default=None): return getattr(self, key, default) if key in self.__slots__ else default
+    def keys(self) -> tuple[str, ...]: return self.__slots__
+    def __eq__(self, other) -> bool: return isinstance(other, UserRecord) and all(self[k] == other[k] for k in self.__slots__)
+    def __repr__(self) -> str: return f"UserRecord(balance={self.balance!r}, savings={self.savings!r}, pin={'set' if self.pin else None}, best_win={self.best_win!r})"
+
+class MoneySupply:
+    """Running totals of every place money can live. Mutation paths call add(); checks are O(1)."""
+    def __init__(self, threshold: float, on_threshold=None):
+        self.threshold = threshold; self.on_threshold = on_threshold
+        self.components = {"balance": 0, "savings": 0, "slot_jackpot_pool": 0, "lottery_pot": 0, "escrow": 0}
+        self.total = 0; self.tripped = False
+        self.last_reconcile_at = None; self.last_reconcile_drift = 0.0; self.last_reconcile_ms = 0.0; self.reconciles = 0
+    def add(self, component: str, delta: Milli):
+        if not delta: return
+        self.components[component] += delta; self.total += delta
+        if not self.tripped and self.total >= self.threshold:
+            self.tripped = True # Fire once; cleared by the next reconcile (e.g. after the reset)
+            if self.on_threshold:
+                try: self.on_threshold(self.total)
+                except Exception as e: logger.error(f"Money supply threshold callback failed: {e}", exc_info=True)
+    def over_threshold(self) -> bool: return self.total >= self.threshold
+    def reconcile(self, user_data: dict[int, UserRecord], bot_data: dict, escrow: Milli = 0) -> Milli:
+        """Full scan: recomputes every component, replaces the running totals and returns the drift (running - actual)."""
+        started = time.perf_counter()
+        balance = 0; savings = 0
+        for d in user_data.values(): balance += d.balance; savings += d.savings # UserRecords are type-checked at load
+        actual = {"balance": balance, "savings": savings}
+        for key in POOL_KEYS: actual[key] = _num(bot_data.get(key, 0))
+        actual["escrow"] = escrow
+        actual_total = sum(actual.values()); drift = self.total - actual_total
+        self.components = actual; self.total = actual_total; self.tripped = actual_total >= self.threshold
+        self.last_reconcile_at = time.time(); self.last_reconcile_drift = drift; self.reconciles += 1
+        self.last_reconcile_ms = (time.perf_counter() - started) * 1000
+        return drift
+
+class LotteryTickets:
+    """Per-user ticket counts plus a Fenwick tree over them: O(log n) buys and weighted draws, O(1) totals."""
+    def __init__(self):
+        self.counts: dict[int, int] = {}; self.total = 0; self.migrated = False
+        self._index: dict[int, int] = {}; self._owners: list[int] = []
+        self._capacity = 16; self._tree = [0] * (self._capacity + 1)
+    @classmethod
+    def from_json(cls, data) -> "LotteryTickets":
+        """Accepts the {user_id: count} format, or the legacy one-entry-per-ticket list (flagged as migrated)."""
+        tickets = cls()
+        if isinstance(data, list):
+            legacy_counts = {}
+            for uid in data:
+                try: legacy_counts[int(uid)] = legacy_counts.get(int(uid), 0) + 1
+                except (TypeError, ValueError): continue
+            data = legacy_counts; tickets.migrated = True
+        if isinstance(data, dict):
+            for uid, n in data.items():
+                try: uid, n = int(uid), int(n)
+                except (TypeError, ValueError): continue
+                if n > 0: tickets.add(uid, n)
+        return tickets
+    def _tree_add(self, pos: int, delta: int):
+        while pos <= self._capacity: self._tree[pos] += delta; pos += pos & -pos
+    def _grow(self):
+        self._capacity *= 2; self._tree = [0] * (self._capacity + 1)
+        for i, owner in enumerate(self._owners): self._tree_add(i + 1, self.counts[owner])
+    def add(self, user_id: int, tickets: int):
+        if tickets <= 0: return
+        if user_id not in self._index:
+            if len(self._owners) >= self._capacity: self._grow()
+            self._index[user_id] = len(self._owners); self._owners.append(user_id); self.counts[user_id] = 0
+        self.counts[user_id] += tickets; self.total += tickets
+        self._tree_add(self._index[user_id] + 1, tickets)
+    def count(self, user_id: int) -> int: return self.counts.get(user_id, 0)
+    def draw(self, rng) -> int:
+        """Picks a user with probability proportional to their ticket count. Raises IndexError when empty."""
+        if self.total <= 0: raise IndexError("No lottery tickets.")
+        remaining = rng.randrange(self.total); pos = 0; step = 1 << (self._capacity.bit_length() - 1)
+        while step:
+            nxt = pos + step
+            if nxt <= self._capacity and self._tree[nxt] <= remaining: pos = nxt; remaining -= self._tree[nxt]
+            step >>= 1
+        return self._owners[pos]
+    def clear(self):
+        self.counts.clear(); self.total = 0; self._index.clear(); self._owners.clear()
+        self._capacity = 16; self._tree = [0] * (self._capacity + 1)
+
+# --- Leaderboards ---
+class _BisectList:
+    """Fallback for SortedList when sortedcontainers isn't installed: same calls, O(n) inserts/removals."""
+    def __init__(self): self._items = []
+    def add(self, item): bisect.insort(self._items, item)
+    def remove(self, item): del self._items[bisect.bisect_left(self._items, item)]
+    def bisect_left(self, item) -> int: return bisect.bisect_left(self._items, item)
+    def islice(self, start: int, stop: int): return iter(self._items[start:stop])
+    def clear(self): self._items.clear()
+    def __len__(self) -> int: return len(self._items)
+
+class RankIndex:
+    """Users ordered by score (highest first), kept sorted as scores change: O(log n) updates, rank and top-K lookups."""
+    def __init__(self):
+        self._scores: dict[int, int | float] = {}; self._sorted = SortedList() if SortedList is not None else _BisectList()
+    def update(self, user_id: int, score: int | float):
+        old = self._scores.get(user_id)
+        if old == score: return
+        if old is not None: self._sorted.remove((-old, user_id))
+        self._sorted.add((-score, user_id)); self._scores[user_id] = score
+    def discard(self, user_id: int):
+        old = self._scores.pop(user_id, None)
+        if old is not None: self._sorted.remove((-old, user_id))
+    def top(self, k: int) -> list[tuple[int, int | float]]:
+        """[(user_id, score)] for the k highest scores; ties rank by user ID."""
+        return [(uid, -neg) for neg, uid in self._sorted.islice(0, k)]
+    def rank(self, user_id: int) -> int | None:
+        """1-based position of the user, or None if they aren't ranked."""
+        score = self._scores.get(user_id)
+        return None if score is None else self._sorted.bisect_left((-score, user_id)) + 1
+    def score(self, user_id: int) -> int | float | None: return self._scores.get(user_id)
+    def clear(self): self._scores.clear(); self._sorted.clear()
+    def __len__(self) -> int: return len(self._scores)
+
+# --- Purchase Orders ---
+ORDER_OPEN_STATUSES = ("pending", "claimed")
+
+class OrderStateError(ValueError):
+    """An order transition that isn't allowed from the order's current state (or by this actor)."""
+
+class OrderBook:
+    """Purchase orders keyed by order ID, with the total credits held in escrow by open orders.
+
+    Orders are plain dicts (persisted as JSON). Closed orders stay in memory until prune() so a pending
+    flush can still snapshot them. Transitions are synchronous: no await between a check and its mutation.
+    """
+    def __init__(self):
+        self.orders: dict[str, dict] = {}; self.escrow = 0
+    def load(self, orders: dict[str, dict]):
+        self.orders = dict(orders)
+        self.escrow = sum(_num(o.get("amount", 0)) for o in self.orders.values() if o.get("status") in ORDER_OPEN_STATUSES)
+    def get(self, order_id: str) -> dict | None: return self.orders.get(order_id)
+    def open_orders(self) -> list[dict]:
+        return sorted((o for o in self.orders.values() if o["status"] in ORDER_OPEN_STATUSES), key=lambda o: o["created_at"])
+    def create(self, order_id: str, user_id: int, guild_id: int, item: dict, payment_method: str, amount: Milli) -> dict:
+        if order_id in self.orders: raise OrderStateError(f"Order {order_id} already exists.")
+        now = time.time()
+        order = {"order_id": order_id, "user_id": int(user_id), "guild_id": int(guild_id), "item_id": item.get("id"), "item_name": item.get("name", "?"),
+                 "payment_method": payment_method, "amount": amount, "status": "pending", "created_at": now, "updated_at": now,
+                 "claimed_by": None, "closed_by": None, "notified": False}
+        self.orders[order_id] = order; self.escrow += amount
+        return order
+    def claim(self, order_id: str, shopkeeper_id: int) -> dict:
+        order = self._open(order_id)
+        if order["status"] != "pending": raise OrderStateError(f"Order {order_id} was already claimed by <@{order['claimed_by']}>.")
+        order["status"] = "claimed"; order["claimed_by"] = int(shopkeeper_id); order["updated_at"] = time.time()
+        return order
+    def close(self, order_id: str, status: str, actor_id: int) -> dict:
+        """Moves an open order to 'fulfilled' or 'cancelled' and releases its escrow. The caller settles the money."""
+        if status not in ("fulfilled", "cancelled"): raise ValueError(f"Unknown closing status '{status}'.")
+        order = self._open(order_id)
+        if status == "fulfilled" and order["claimed_by"] != int(actor_id): raise OrderStateError(f"Only the claiming shopkeeper can fulfill order {order_id}.")
+        order["status"] = status; order["closed_by"] = int(actor_id); order["updated_at"] = time.time(); self.escrow -= order["amount"]
+        return order
+    def prune(self, keep: set[str] = frozenset()) -> int:
+        """Drops closed orders from memory (they live on in the ledger), except IDs in `keep` (e.g. still dirty)."""
+        closed = [oid for oid, o in self.orders.items() if o["status"] not in ORDER_OPEN_STATUSES and oid not in keep]
+        for oid in closed: del self.orders[oid]
+        return len(closed)
+    def _open(self, order_id: str) -> dict:
+        order = self.orders.get(order_id)
+        if order is None: raise OrderStateError(f"Order {order_id} not found.")
+        if order["status"] not in ORDER_OPEN_STATUSES: raise OrderStateError(f"Order {order_id} is already {order['status']}.")
+        return order
+
+# --- Message Rewards ---
+class MessageRewards:
+    """Per-user chat reward accumulator with a diminishing-returns window, credited in batches.
+
+    Inside a user's `window` seconds the first `full_rate` messages earn 1 coin each and every later one earns
+    `decay` times the one before (decay 0 = a hard cap per window), so a flood earns at most about
+    full_rate + decay / (1 - decay) coins per window. Rewards are milli-coins (floored), so fractional coins are paid
+    exactly. add() is O(1) on the message path; drain() credits what's pending and evicts users whose window has expired.
+    """
+    def __init__(self, window: float = 60.0, full_rate: int = 5, decay: float = 0.5, clock=time.monotonic):
+        self.window = window; self.full_rate = full_rate; self.decay = decay; self.clock = clock
+        self._users: dict[int, list] = {} # user_id -> [window_start, messages_in_window, uncredited milli-coins]
+        self._window_messages = 0; self._window_started = clock()
+        self.stats = {"messages": 0, "throttled": 0, "batches": 0, "credited": 0, "last_batch_users": 0, "last_batch_ms": 0.0,
+                      "rate": 0.0, "peak_rate": 0.0}
+    def add(self, user_id: int) -> Milli:
+        """Counts one message; returns the reward it earned (credited by the next drain)."""
+        now = self.clock(); entry = self._users.get(user_id)
+        if entry is None: entry = self._users[user_id] = [now, 0, 0]
+        elif now - entry[0] >= self.window: entry[0] = now; entry[1] = 0
+        entry[1] += 1; extra = entry[1] - self.full_rate
+        reward = MILLI if extra <= 0 else int(MILLI * self.decay ** extra)
+        if extra > 0: self.stats["throttled"] += 1
+        entry[2] += reward; self.stats["messages"] += 1; self._window_messages += 1
+        return reward
+    def drain(self, credit) -> Milli:
+        """Calls credit(user_id, milli) once per user with a pending reward. Returns the milli-coins credited."""
+        started = time.perf_counter(); now = self.clock(); coins_total = 0; users = 0
+        for user_id, entry in list(self._users.items()):
+            if coins := entry[2]: entry[2] = 0; credit(user_id, coins); coins_total += coins; users += 1
+            if now - entry[0] >= self.window: del self._users[user_id]
+        st = self.stats; elapsed = now - self._window_started
+        if elapsed > 0: st["rate"] = self._window_messages / elapsed; st["peak_rate"] = max(st["peak_rate"], st["rate"])
+        self._window_messages = 0; self._window_started = now
+        st["batches"] += 1; st["credited"] += coins_total; st["last_batch_users"] = users; st["last_batch_ms"] = (time.perf_counter() - started) * 1000
+        return coins_total
+    def pending(self) -> Milli: return sum(entry[2] for entry in self._users.values())
+    def clear(self): self._users.clear()
+    def __len__(self) -> int: return len(self._users)
+    def summary(self) -> str:
+        st = self.stats
+        return (f"msgs={st['messages']:,} rate={st['rate']:.1f}/s peak={st['peak_rate']:.1f}/s throttled={st['throttled']:,} "
+                f"credited={fmt_coins(st['credited'])} batches={st['batches']} last_batch={st['last_batch_users']} users/{st['last_batch_ms']:.2f}ms tracked={len(self._users):,}")
+
+# --- Balance Operations ---
+class InsufficientFunds(Exception):
+    def __init__(self, available: Milli, required: Milli):
+        super().__init__(f"Insufficient funds ({fmt_coins(available)} < {fmt_coins(required)})."); self.available = available; self.required = required
+
+class BalanceOps:
+    """Check-and-mutate balance operations guarded by striped per-user asyncio locks.
+
+    Users hash onto a fixed pool of locks, so unrelated users almost never contend and an uncontended
+    acquire never yields to the loop. Multi-user operations take their stripes in index order (no deadlocks).
+    The *_now methods are the synchronous core: only call them while holding the user's stripe, or with
+    no await between reading a balance and mutating it.
+    """
+    def __init__(self, get_user, money_supply: MoneySupply, on_change=None, on_entry=None, stripes: int = 256):
+        self.get_user = get_user; self.money_supply = money_supply; self.on_change = on_change; self.on_entry = on_entry # on_entry(user_id, field, delta)
+        self._locks = [asyncio.Lock() for _ in range(stripes)]
+        self.stats = {"ops": 0, "contended": 0, "insufficient": 0}
+    def _stripe(self, user_id: int) -> int: return hash(int(user_id)) % len(self._locks)
+    @contextlib.asynccontextmanager
+    async def hold(self, *user_ids: int):
+        """Holds the stripes for all given users (for flows that await between a check and a mutation)."""
+        acquired = []
+        try:
+            for idx in sorted({self._stripe(uid) for uid in user_ids}):
+                lock = self._locks[idx]
+                if lock.locked(): self.stats["contended"] += 1
+                await lock.acquire(); acquired.append(lock)
+            yield
+        finally:
+            for lock in reversed(acquired): lock.release()
+    def held(self) -> bool: return any(lock.locked() for lock in self._locks) # Some flow is mid-operation
+    def _changed(self, *user_ids: int):
+        self.stats["ops"] += 1
+        if self.on_change: self.on_change(*user_ids)
+    def debit_now(self, user_id: int, amount: Milli, field: str = "balance") -> UserRecord:
+        if amount < 0: raise ValueError("Debit amount must be non-negative.")
+        udata = self.get_user(user_id); available = getattr(udata, field)
+        if available < amount: self.stats["insufficient"] += 1; raise InsufficientFunds(available, amount)
+        setattr(udata, field, available - amount); self.money_supply.add(field, -amount)
+        if self.on_entry: self.on_entry(user_id, field, -amount)
+        self._changed(user_id)
+        return udata
+    def credit_now(self, user_id: int, amount: Milli, field: str = "balance") -> UserRecord:
+        if amount < 0: raise ValueError("Credit amount must be non-negative.")
+        udata = self.get_user(user_id)
+        setattr(udata, field, getattr(udata, field) + amount); self.money_supply.add(field, amount)
+        if self.on_entry: self.on_entry(user_id, field, amount)
+        self._changed(user_id)
+        return udata
+    async def debit(self, user_id: int, amount: Milli, field: str = "balance") -> UserRecord:
+        async with self.hold(user_id): return self.debit_now(user_id, amount, field)
+    async def credit(self, user_id: int, amount: Milli, field: str = "balance") -> UserRecord:
+        async with self.hold(user_id): return self.credit_now(user_id, amount, field)
+    async def transfer(self, from_id: int, to_id: int, amount: Milli) -> tuple[UserRecord, UserRecord]:
+        """Moves balance between two users; both rows change or neither does."""
+        async with self.hold(from_id, to_id):
+            sender = self.debit_now(from_id, amount); recipient = self.credit_now(to_id, amount)
+            return sender, recipient
+    async def bet(self, user_id: int, stake: Milli, resolve) -> tuple[dict, UserRecord]:
+        """Debits `stake`, calls resolve() (a dict with "winnings") and credits the winnings under one hold with no await in
+        between, so nothing (an admin set, a take, a reset) can land between the bet and its payout."""
+        async with self.hold(user_id):
+            self.debit_now(user_id, stake); outcome = resolve()
+            return outcome, (self.credit_now(user_id, outcome["winnings"]) if outcome["winnings"] else self.get_user(user_id))
+    async def move(self, user_id: int, amount: Milli, src: str, dst: str) -> UserRecord:
+        """Moves money between two fields of one user (e.g. balance -> savings)."""
+        async with self.hold(user_id): self.debit_now(user_id, amount, src); return self.credit_now(user_id, amount, dst)
+
+# --- Stress Harness ---
+async def _stress(users: int, tasks: int, stripes: int, seed: int) -> bool:
+    """Fires interleaved fake interactions (pay, savings moves, bets, slow read-modify-write transfers) and checks
+    that the money supply is conserved, matches a full scan, and no balance ever goes negative."""
+    rng = random.Random(seed)
+    user_data = {uid: UserRecord(1000) for uid in range(users)}
+    supply = MoneySupply(float("inf")); supply.reconcile(user_data, {})
+    ops = BalanceOps(lambda uid: user_data[uid], supply, stripes=stripes)
+    minted = 0; outcomes = {"ok": 0, "insufficient": 0}
+    async def fake_pay():
+        a, b = rng.sample(range(users), 2)
+        await asyncio.sleep(0); await ops.transfer(a, b, rng.randint(1, 300))
+    async def fake_savings():
+        uid = rng.randrange(users); src, dst = rng.choice([("balance", "savings"), ("savings", "balance")])
+        await asyncio.sleep(0); await ops.move(uid, rng.randint(1, 200), src, dst)
+    async def fake_bet():
+        nonlocal minted
+        uid = rng.randrange(users); bet = rng.randint(1, 150)
+        await ops.debit(uid, bet); minted -= bet
+        for _ in range(rng.randint(1, 3)): await asyncio.sleep(0) # "animation" frames
+        win = rng.choice([0, 0, bet * 2, bet * 5])
+        if win: await ops.credit(uid, win); minted += win
+    async def slow_transfer():
+        a, b = rng.sample(range(users), 2); amount = rng.randint(1, 100)
+        async with ops.hold(a, b): # read, yield, write: loses updates without the stripe locks
+            bal_a = user_data[a].balance; await asyncio.sleep(0)
+            if bal_a < amount: raise InsufficientFunds(bal_a, amount)
+            user_data[a].balance = bal_a - amount; user_data[b].balance += amount
+    kinds = [fake_pay, fake_savings, fake_bet, slow_transfer]
+    async def run_one(fn):
+        try: await fn(); outcomes["ok"] += 1
+        except InsufficientFunds: outcomes["insufficient"] += 1
+    started = time.perf_counter()
+    await asyncio.gather(*(run_one(rng.choice(kinds)) for _ in range(tasks)))
+    elapsed = time.perf_counter() - started
+    expected = users * 1000 + minted; running = supply.total; drift = supply.reconcile(user_data, {})
+    negatives = [uid for uid, d in user_data.items() if d.balance < 0 or d.savings < 0]
+    ok = running == expected and drift == 0 and not negatives
+    print(f"{tasks} interactions over {users} users / {stripes} stripes in {elapsed:.3f}s ({tasks / elapsed:,.0f}/s): {outcomes}, "
+          f"contended={ops.stats['contended']}, expected={expected:,} running={running:,} drift={drift} negatives={len(negatives)} -> {'PASS' if ok else 'FAIL'}")
+    return ok
+
+# --- Memory Benchmark ---
+def _memory_bench(sizes: list[int], seed: int):
+    """Builds user_data both ways (old dict rows vs UserRecord) at each size and reports traced memory and access cost."""
+    import tracemalloc
+    def rows(n: int):
+        rng = random.Random(seed)
+        for uid in range(10**17, 10**17 + n): yield uid, rng.randint(0, 10**6), rng.choice((0, rng.randint(1, 10**5))), rng.choice((None, "1234")), 0
+    def old_validate(ud: dict): # What get_user_data did on every access before records
+        if "balance" not in ud or not isinstance(ud["balance"], (int, float)): ud["balance"] = 0
+        if "savings" not in ud or not isinstance(ud["savings"], (int, float)): ud["savings"] = 0
+        if "pin" not in ud or (ud["pin"] is not None and not isinstance(ud["pin"], str)): ud["pin"] = None
+        if "best_win" not in ud or not isinstance(ud["best_win"], (int, float)): ud["best_win"] = 0
+        return ud
+    builders = {"dict": lambda n: {uid: {"balance": b, "savings": s, "pin": p, "best_win": w} for uid, b, s, p, w in rows(n)},
+                "UserRecord": lambda n: {uid: UserRecord(b, s, p, w) for uid, b, s, p, w in rows(n)}}
+    readers = {"dict": lambda d: sum(old_validate(ud)["balance"] for ud in d.values()), "UserRecord": lambda d: sum(ud.balance for ud in d.values())}
+    print(f"{'users':>10} {'layout':>10} {'MiB':>9} {'B/user':>7} {'build s':>8} {'read ns/user':>13}")
+    for n in sizes:
+        for name, build in builders.items():
+            tracemalloc.start(); started = time.perf_counter(); data = build(n); built = time.perf_counter() - started
+            size, _ = tracemalloc.get_traced_memory(); tracemalloc.stop()
+            started = time.perf_counter(); readers[name](data); read = time.perf_counter() - started
+            print(f"{n:>10,} {name:>10} {size / 2**20:>9.1f} {size / n:>7.0f} {built:>8.2f} {read / n * 1e9:>13.0f}")
+            del data
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Economy helpers. --stress runs the balance-ops concurrency harness, --memory the user-record benchmark.")
+    parser.add_argument("--stress", action="store_true", help="Run the concurrent interaction stress test.")
+    parser.add_argument("--memory", type=int, nargs="*", metavar="USERS", help="Compare dict vs UserRecord memory (default sizes: 10^4 10^5 10^6).")
+    parser.add_argument("--users", type=int, default=50); parser.add_argument("--tasks", type=int, default=5000)
+    parser.add_argument("--stripes", type=int, default=256); parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    if args.memory is not None: _memory_bench(args.memory or [10**4, 10**5, 10**6], args.seed)
+    elif not args.stress: parser.print_help()
+    else: raise SystemExit(0 if asyncio.run(_stress(args.users, args.tasks, args.stripes, args.seed)) else 1)
@@ -0,0 +1,172 @@
+# games.py
+# Payout rules for /gamble slots, dice and red/black as pure functions on milli-coin ints (see money.py), plus a
+# Monte Carlo simulator for return-to-player, variance and jackpot growth (run `python games.py --help`). NumPy is
+# optional: without it the simulator falls back to a plain-Python loop (same report, much lower throughput).
+
+import math
+import time
+import random
+import argparse
+from fractions import Fraction
+
+from money import MILLI, Milli, to_milli, scale
+
+try: import numpy as np
+except ImportError: np = None
+
+SLOT_EMOJIS = ["🍎", "🍊", "🍋", "🍉", "🍇", "🍓", "🍒", "⭐", "💎"]; SLOT_JACKPOT_EMOJI = "💎"
+DICE_WIN_MULTIPLIER = 5; REDBLACK_WIN_MULTIPLIER = Fraction(19, 10) # Fractions keep payouts exact in milli-coins
+SLOT_TRIPLE_MULTIPLIER = 10; SLOT_PAIR_MULTIPLIER = 2; SLOT_JACKPOT_SHARE = Fraction(1, 2)
+SLOT_OUTCOMES = ("jackpot", "override", "triple", "pair", "loss")
+
+# --- Payout Rules ---
+def slot_outcome(reels: list[str]) -> str:
+    """Natural outcome of three reels: jackpot, triple, pair or loss (the override roll is separate)."""
+    if reels[0] == reels[1] == reels[2]: return "jackpot" if reels[0] == SLOT_JACKPOT_EMOJI else "triple"
+    if reels[0] == reels[1] or reels[1] == reels[2] or reels[0] == reels[2]: return "pair"
+    return "loss"
+def slot_payout(outcome: str, amount: Milli, jackpot_pool: Milli, contribution_rate: float) -> tuple[Milli, Milli]:
+    """(winnings, jackpot pool delta) for one spin. Jackpots pay the stake back plus half the pool; losses feed the pool."""
+    if outcome in ("jackpot", "override"): share = scale(jackpot_pool, SLOT_JACKPOT_SHARE); return amount + share, -share
+    if outcome == "triple": return amount * SLOT_TRIPLE_MULTIPLIER, 0
+    if outcome == "pair": return amount * SLOT_PAIR_MULTIPLIER, 0
+    return 0, scale(amount, contribution_rate)
+def spin_slots(rng, amount: Milli, jackpot_pool: Milli, contribution_rate: float, override_chance: float) -> tuple[list[str], str, Milli, Milli]:
+    """One spin against the given pool. Returns (reels, outcome, winnings, jackpot pool delta)."""
+    reels = [rng.choice(SLOT_EMOJIS) for _ in range(3)]; outcome = slot_outcome(reels)
+    if outcome == "loss" and override_chance > 0 and rng.random() < override_chance: outcome = "override"
+    return (reels, outcome, *slot_payout(outcome, amount, jackpot_pool, contribution_rate))
+def dice_win(amount: Milli) -> Milli: return amount * DICE_WIN_MULTIPLIER
+def dice_payout(guess: int, roll: int, amount: Milli) -> Milli: return dice_win(amount) if guess == roll else 0
+def redblack_win(amount: Milli) -> Milli: return scale(amount, REDBLACK_WIN_MULTIPLIER)
+def redblack_is_red(roll: int) -> bool: return roll % 2 == 0
+def redblack_payout(choice: str, roll: int, amount: Milli) -> Milli: return redblack_win(amount) if (choice == "red") == redblack_is_red(roll) else 0
+
+# --- Simulator ---
+class SimulationReport:
+    """Aggregates of a simulated run, in coins. Payout stats are per unit staked; `supply_drift` is money created per round."""
+    def __init__(self, game: str, rounds: int, bet: int, engine: str):
+        self.game = game; self.rounds = rounds; self.bet = bet; self.engine = engine
+        self.total_bet = rounds * bet; self.total_won = 0.0; self.sum_sq = 0.0; self.counts: dict[str, int] = {}
+        self.start_pool = 0.0; self.end_pool = 0.0; self.trajectory: list[tuple[int, float]] = []; self.elapsed = 0.0
+    @property
+    def rtp(self) -> float: return self.total_won / self.total_bet if self.total_bet else 0.0
+    @property
+    def variance(self) -> float:
+        """Variance of a single round's payout multiple (winnings / bet)."""
+        mean = self.rtp; return max(0.0, self.sum_sq / self.rounds - mean * mean) if self.rounds else 0.0
+    @property
+    def pool_growth(self) -> float: return (self.end_pool - self.start_pool) / self.rounds if self.rounds else 0.0
+    @property
+    def supply_drift(self) -> float:
+        """Change in total money supply per round: payouts minus stakes, plus what stays behind in the pool."""
+        return (self.total_won - self.total_bet + self.end_pool - self.start_pool) / self.rounds if self.rounds else 0.0
+    def rounds_to_reset(self, threshold: float, current_supply: float = 0.0) -> float:
+        drift = self.supply_drift
+        return (threshold - current_supply) / drift if drift > 0 and threshold > current_supply else math.inf
+    def lines(self, threshold: float | None = None, current_supply: float = 0.0, rounds_per_hour: float | None = None) -> list[str]:
+        lines = [f"{self.game}: {self.rounds:,} rounds x {self.bet:,} ({self.engine}, {self.elapsed:.2f}s, {self.rounds / max(self.elapsed, 1e-9):,.0f} rounds/s)",
+                 f"RTP {self.rtp:.4%} (house edge {1 - self.rtp:+.4%}), payout variance {self.variance:,.4f} (stdev {math.sqrt(self.variance):,.3f}x bet)",
+                 "Outcomes: " + ", ".join(f"{k} {v / self.rounds:.4%}" for k, v in self.counts.items())]
+        if self.game == "slots":
+            lines.append(f"Jackpot pool {self.start_pool:,.2f} -> {self.end_pool:,.2f} ({self.pool_growth:+,.4f}/round); trajectory: "
+                         + ", ".join(f"{n:,}:{p:,.0f}" for n, p in self.trajectory))
+        lines.append(f"Money supply drift {self.supply_drift:+,.4f} coins/round")
+        if threshold is not None:
+            rounds_left = self.rounds_to_reset(threshold, current_supply)
+            if math.isinf(rounds_left): lines.append("Time to economy reset: never (this game removes money on average)")
+            else:
+                lines.append(f"Time to economy reset: {rounds_left:,.0f} rounds" + (f" (~{rounds_left / rounds_per_hour / 24:,.1f} days at {rounds_per_hour:,.0f} rounds/h)" if rounds_per_hour else ""))
+        return lines
+
+def _chunks(rounds: int, chunk: int):
+    while rounds > 0: n = min(chunk, rounds); yield n; rounds -= n
+
+def simulate_slots(rounds: int, bet: int, contribution_rate: float, override_chance: float, start_pool: float = 0.0,
+                   seed: int | None = None, samples: int = 10, chunk: int = 1_000_000, use_numpy: bool = True) -> SimulationReport:
+    """Plays `rounds` spins with the live payout rules, carrying the jackpot pool from spin to spin."""
+    started = time.perf_counter(); engine = "numpy" if use_numpy and np is not None else "python"
+    report = SimulationReport("slots", rounds, bet, engine); report.start_pool = pool = float(start_pool)
+    counts = dict.fromkeys(SLOT_OUTCOMES, 0); sample_every = max(1, rounds // max(1, samples)); done = 0
+    if engine == "python": # Same integer milli-coin arithmetic as the bot
+        rng = random.Random(seed); bet_m = to_milli(bet); pool_m = to_milli(start_pool)
+        for i in range(rounds):
+            _, outcome, won, delta = spin_slots(rng, bet_m, pool_m, contribution_rate, override_chance)
+            pool_m += delta; counts[outcome] += 1; report.total_won += won / MILLI; report.sum_sq += (won / bet_m) ** 2
+            if (i + 1) % sample_every == 0: report.trajectory.append((i + 1, pool_m / MILLI))
+        pool = pool_m / MILLI
+    else:
+        gen = np.random.default_rng(seed); jackpot_idx = SLOT_EMOJIS.index(SLOT_JACKPOT_EMOJI); contribution = bet * contribution_rate; share = float(SLOT_JACKPOT_SHARE)
+        for n in _chunks(rounds, chunk):
+            reels = gen.integers(0, len(SLOT_EMOJIS), size=(n, 3), dtype=np.int8)
+            a, b, c = reels[:, 0], reels[:, 1], reels[:, 2]
+            triple = (a == b) & (b == c); jackpot = triple & (a == jackpot_idx); triple &= ~jackpot
+            pair = ~(jackpot | triple) & ((a == b) | (b == c) | (a == c)); loss = ~(jackpot | triple | pair)
+            if override_chance > 0: override = loss & (gen.random(n) < override_chance); loss &= ~override
+            else: override = np.zeros(n, dtype=bool)
+            for key, mask in (("jackpot", jackpot), ("override", override), ("triple", triple), ("pair", pair), ("loss", loss)): counts[key] += int(mask.sum())
+            fixed = triple.sum() * SLOT_TRIPLE_MULTIPLIER + pair.sum() * SLOT_PAIR_MULTIPLIER # In units of the bet
+            report.total_won += float(fixed) * bet; report.sum_sq += float(triple.sum() * SLOT_TRIPLE_MULTIPLIER ** 2 + pair.sum() * SLOT_PAIR_MULTIPLIER ** 2)
+            # The pool only changes sequentially at jackpot spins; between them it grows by the cumulative loss contributions.
+            feed = np.cumsum(loss * contribution); hits = np.flatnonzero(jackpot | override)
+            pool_after = np.empty(len(hits)); base = pool; fed_before = 0.0
+            for k, idx in enumerate(hits.tolist()):
+                pool_before = base + (feed[idx] - fed_before); won = bet + pool_before * share
+                report.total_won += won; report.sum_sq += (won / bet) ** 2
+                base = pool_after[k] = pool_before - pool_before * share; fed_before = feed[idx]
+            for i in range(sample_every - done % sample_every - 1, n, sample_every): # Pool after spin i of this chunk
+                k = np.searchsorted(hits, i, side="right") - 1
+                report.trajectory.append((done + i + 1, float(pool + feed[i] if k < 0 else pool_after[k] + feed[i] - feed[hits[k]])))
+            pool = float(base + (feed[-1] - fed_before)); done += n
+    report.counts = counts; report.end_pool = pool; report.elapsed = time.perf_counter() - started
+    return report
+
+def simulate_dice(rounds: int, bet: int, guess: int = 1, seed: int | None = None, chunk: int = 1_000_000, use_numpy: bool = True) -> SimulationReport:
+    started = time.perf_counter(); engine = "numpy" if use_numpy and np is not None else "python"
+    report = SimulationReport("dice", rounds, bet, engine); wins = 0
+    if engine == "python":
+        rng = random.Random(seed); wins = sum(1 for _ in range(rounds) if dice_payout(guess, rng.randint(1, 6), bet))
+    else:
+        gen = np.random.default_rng(seed)
+        for n in _chunks(rounds, chunk): wins += int((gen.integers(1, 7, size=n) == guess).sum())
+    multiple = dice_win(to_milli(bet)) / to_milli(bet)
+    report.counts = {"win": wins, "loss": rounds - wins}; report.total_won = wins * multiple * bet; report.sum_sq = wins * multiple ** 2
+    report.elapsed = time.perf_counter() - started
+    return report
+
+def simulate_redblack(rounds: int, bet: int, choice: str = "red", seed: int | None = None, chunk: int = 1_000_000, use_numpy: bool = True) -> SimulationReport:
+    started = time.perf_counter(); engine = "numpy" if use_numpy and np is not None else "python"
+    report = SimulationReport("redblack", rounds, bet, engine); wins = 0
+    if engine == "python":
+        rng = random.Random(seed); wins = sum(1 for _ in range(rounds) if redblack_payout(choice, rng.randint(1, 36), bet))
+    else:
+        gen = np.random.default_rng(seed)
+        for n in _chunks(rounds, chunk): reds = int((gen.integers(1, 37, size=n) % 2 == 0).sum()); wins += reds if choice == "red" else n - reds
+    multiple = redblack_win(to_milli(bet)) / to_milli(bet)
+    report.counts = {"win": wins, "loss": rounds - wins}; report.total_won = wins * multiple * bet; report.sum_sq = wins * multiple ** 2
+    report.elapsed = time.perf_counter() - started
+    return report
+
+def simulate(game: str, rounds: int, bet: int, contribution_rate: float = 0.10, override_chance: float = 0.0, start_pool: float = 0.0,
+             seed: int | None = None, use_numpy: bool = True) -> SimulationReport:
+    if game == "slots": return simulate_slots(rounds, bet, contribution_rate, override_chance, start_pool, seed=seed, use_numpy=use_numpy)
+    if game == "dice": return simulate_dice(rounds, bet, seed=seed, use_numpy=use_numpy)
+    if game == "redblack": return simulate_redblack(rounds, bet, seed=seed, use_numpy=use_numpy)
+    raise ValueError(f"Unknown game '{game}'.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Monte Carlo RTP / jackpot benchmark for the gambling commands.")
+    parser.add_argument("--game", choices=["slots", "dice", "redblack", "all"], default="all")
+    parser.add_argument("--rounds", type=int, default=10_000_000 if np is not None else 1_000_000)
+    parser.add_argument("--bet", type=int, default=100)
+    parser.add_argument("--contribution", type=float, default=0.10, help="slot_jackpot_contribution")
+    parser.add_argument("--override", type=float, default=0.0, help="slot_jackpot_override_chance")
+    parser.add_argument("--pool", type=float, default=0.0, help="Starting jackpot pool.")
+    parser.add_argument("--threshold", type=float, default=1.0e15, help="ECONOMY_RESET_THRESHOLD")
+    parser.add_argument("--supply", type=float, default=0.0, help="Current money supply.")
+    parser.add_argument("--rounds-per-hour", type=float, default=1000.0)
+    parser.add_argument("--seed", type=int, default=None); parser.add_argument("--pure-python", action="store_true", help="Skip NumPy even if installed.")
+    args = parser.parse_args()
+    for game in (["slots", "dice", "redblack"] if args.game == "all" else [args.game]):
+        report = simulate(game, args.rounds, args.bet, args.contribution, args.override, args.pool, seed=args.seed, use_numpy=not args.pure_python)
+        print("\n".join(report.lines(args.threshold, args.supply, args.rounds_per_hour))); print()
@@ -0,0 +1,170 @@
+# journal.py
+# Append-only money journal: every balance/pool mutation as one compact JSON line, fsync'd in batches, plus periodic
+# snapshots so recovery replays at most one snapshot interval of entries. Run `python journal.py --help` for the replay tool.
+# Amounts are milli-coins (money.py); snapshots written before the switch carry no "unit" and are replayed scaled up.
+
+import os
+import json
+import time
+import glob
+import logging
+import argparse
+import datetime
+import contextvars
+
+from ledger_store import atomic_write_json
+from money import MILLI, fmt_coins
+
+logger = logging.getLogger(__name__)
+
+journal_op: contextvars.ContextVar[str] = contextvars.ContextVar("journal_op", default="other") # Set per command/task; tags its entries
+SEGMENT_GLOB = "journal-*.jsonl"; SNAPSHOT_GLOB = "snapshot-*.json"
+
+def _seq_of(path: str) -> int: return int(os.path.basename(path).split("-", 1)[1].split(".", 1)[0])
+def _segments(directory: str) -> list[str]: return sorted(glob.glob(os.path.join(directory, SEGMENT_GLOB)), key=_seq_of)
+def _snapshots(directory: str) -> list[str]: return sorted(glob.glob(os.path.join(directory, SNAPSHOT_GLOB)), key=_seq_of)
+def _snapshot_time(path: str) -> float:
+    with open(path, 'r') as f: return json.load(f)["t"]
+def _repair_tail(path: str):
+    """Cuts a torn final line so the next append starts on a fresh line."""
+    with open(path, 'rb+') as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"): f.truncate(data.rfind(b"\n") + 1); logger.warning(f"Truncated torn journal tail in {path}")
+def _last_seq(path: str) -> int:
+    """`s` of the segment's last complete entry (reads only the tail); 0 if it has none."""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END); size = f.tell(); f.seek(max(0, size - 4096)); tail = f.read()
+    for line in reversed(tail.split(b"\n")):
+        try: return json.loads(line)["s"]
+        except (ValueError, KeyError, TypeError): continue
+    return 0 if size <= 4096 else max((e["s"] for e in read_entries(path)), default=0) # Very long last line: fall back to a full read
+def read_entries(path: str):
+    """Yields decoded entries; a torn last line (crash mid-write) is skipped."""
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try: yield json.loads(line)
+            except json.JSONDecodeError: logger.warning(f"Skipping torn journal line in {path}")
+
+class Journal:
+    """Line-delimited journal split into segments; each snapshot starts a new segment.
+
+    record() only appends to an in-memory buffer (loop thread). take_pending() + write() move it to disk with one
+    fsync per batch (write() is blocking, run it on the persistence executor, in order with snapshot()).
+    """
+    def __init__(self, directory: str, keep_snapshots: int = 48):
+        self.directory = directory; self.keep_snapshots = keep_snapshots; os.makedirs(directory, exist_ok=True)
+        self.seq = 0; self._pending: list[str] = []
+        snapshots = _snapshots(directory); segments = _segments(directory)
+        if snapshots: self.seq = _seq_of(snapshots[-1])
+        if segments:
+            _repair_tail(segments[-1])
+            for entry in read_entries(segments[-1]): self.seq = max(self.seq, entry.get("s", 0))
+        snapshot_is_latest = bool(snapshots) and _seq_of(snapshots[-1]) == self.seq
+        self.segment_path = segments[-1] if segments and not snapshot_is_latest else self._segment_for(self.seq + 1)
+        self.has_snapshot = bool(snapshots)
+        self.stats = {"entries": 0, "batches": 0, "last_batch": 0, "max_batch": 0, "last_fsync_ms": 0.0, "max_fsync_ms": 0.0, "snapshots": 0, "last_snapshot_ms": 0.0}
+    def _segment_for(self, first_seq: int) -> str: return os.path.join(self.directory, f"journal-{first_seq:012d}.jsonl")
+
+    # --- Loop thread ---
+    def record(self, user_id: int | None, field: str, delta: int | None = None, value: int | None = None, op: str | None = None):
+        """Appends one mutation: a delta, or an absolute value (`value`). user_id None = a bot-wide pool. `op` defaults to journal_op."""
+        self.seq += 1
+        entry = {"s": self.seq, "t": round(time.time(), 3), "op": op or journal_op.get(), "u": user_id, "f": field}
+        if value is not None: entry["v"] = value
+        else: entry["d"] = delta
+        self._pending.append(json.dumps(entry, separators=(",", ":")))
+    def pending(self) -> int: return len(self._pending)
+    def take_pending(self) -> list[str]:
+        lines = self._pending; self._pending = []; return lines
+
+    # --- Worker thread ---
+    def write(self, lines: list[str]):
+        if not lines: return
+        started = time.perf_counter()
+        with open(self.segment_path, 'a', encoding='utf-8') as f: f.write("\n".join(lines) + "\n"); f.flush(); os.fsync(f.fileno())
+        elapsed_ms = (time.perf_counter() - started) * 1000; st = self.stats
+        st["entries"] += len(lines); st["batches"] += 1; st["last_batch"] = len(lines); st["max_batch"] = max(st["max_batch"], len(lines))
+        st["last_fsync_ms"] = elapsed_ms; st["max_fsync_ms"] = max(st["max_fsync_ms"], elapsed_ms)
+    def checkpoint(self, lines: list[str], seq: int, users: dict[int, dict], pools: dict[str, int]):
+        """write() then snapshot() as one executor job, so no later batch can be queued between them (it would land in the
+        old segment after entries the snapshot already covers)."""
+        self.write(lines); self.snapshot(seq, users, pools)
+    def snapshot(self, seq: int, users: dict[int, dict], pools: dict[str, int]):
+        """Writes the state as of entry `seq` and starts a new segment. Call after write() has flushed entries up to `seq`
+        and before any later batch is written (checkpoint() does both)."""
+        started = time.perf_counter()
+        data = {"seq": seq, "t": round(time.time(), 3), "unit": "milli", "pools": pools,
+                "users": {str(uid): [d.get("balance", 0), d.get("savings", 0)] for uid, d in users.items()}}
+        atomic_write_json(os.path.join(self.directory, f"snapshot-{seq:012d}.json"), data, indent=None)
+        self.segment_path = self._segment_for(seq + 1); self.has_snapshot = True
+        for old in _snapshots(self.directory)[:-self.keep_snapshots]: os.unlink(old)
+        self.stats["snapshots"] += 1; self.stats["last_snapshot_ms"] = (time.perf_counter() - started) * 1000
+    def summary(self) -> str:
+        st = self.stats
+        return (f"seq={self.seq} entries={st['entries']} batches={st['batches']} batch(last/max)={st['last_batch']}/{st['max_batch']} "
+                f"fsync_ms(last/max)={st['last_fsync_ms']:.2f}/{st['max_fsync_ms']:.2f} snapshots={st['snapshots']} pending={len(self._pending)}")
+
+# --- Replay ---
+def apply_entry(users: dict[int, dict], pools: dict[str, int], entry: dict, scale: int = 1):
+    """Applies one entry; `scale` converts amounts from a coin-denominated (pre-milli) journal."""
+    uid, field = entry.get("u"), entry.get("f")
+    if entry.get("op") == "reset" and uid is None and field == "*": # Economy reset: every balance back to the start value, savings/pools cleared
+        for d in users.values(): d["balance"] = round(entry["v"] * scale); d["savings"] = 0
+        for key in pools: pools[key] = 0
+        return
+    target = pools if uid is None else users.setdefault(int(uid), {"balance": 0, "savings": 0})
+    if "v" in entry: target[field] = round(entry["v"] * scale)
+    else: target[field] = target.get(field, 0) + round(entry["d"] * scale)
+
+def replay(directory: str, until: float | None = None, user_id: int | None = None) -> tuple[dict[int, dict], dict[str, int], dict]:
+    """Rebuilds balances and pools (milli-coins) as of `until` (epoch seconds; None = latest) from the nearest earlier snapshot.
+    With `user_id`, info["history"] lists that user's replayed entries."""
+    snapshots = _snapshots(directory)
+    if until is not None: snapshots = [p for p in snapshots if _snapshot_time(p) <= until]
+    if not snapshots: raise FileNotFoundError(f"No snapshot in {directory}" + (" at or before that time." if until is not None else "."))
+    with open(snapshots[-1], 'r') as f: snap = json.load(f)
+    scale = 1 if snap.get("unit") == "milli" else MILLI # The bot snapshots right after converting, so a coin snapshot is only followed by coin entries
+    users = {int(uid): {"balance": round(bal * scale), "savings": round(sav * scale)} for uid, (bal, sav) in snap["users"].items()}
+    pools = {key: round(value * scale) for key, value in snap["pools"].items()}
+    info = {"snapshot": snapshots[-1], "snapshot_t": snap["t"], "snapshot_seq": snap["seq"], "applied": 0, "last_seq": snap["seq"], "last_t": snap["t"], "history": [], "scale": scale}
+    for path in _segments(directory):
+        if _last_seq(path) <= info["last_seq"]: continue # Entirely covered by the snapshot (decided by entry seqs, not file names)
+        for entry in read_entries(path):
+            if entry["s"] <= info["last_seq"]: continue # Covered by the snapshot, or already applied
+            if until is not None and entry["t"] > until: return users, pools, info
+            apply_entry(users, pools, entry, scale); info["applied"] += 1; info["last_seq"] = entry["s"]; info["last_t"] = entry["t"]
+            if user_id is not None and entry.get("u") in (user_id, None): info["history"].append(entry)
+    return users, pools, info
+
+def _parse_time(value: str) -> float:
+    try: return float(value)
+    except ValueError:
+        dt = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+        return (dt if dt.tzinfo else dt.replace(tzinfo=datetime.timezone.utc)).timestamp()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s:%(levelname)s:%(name)s: %(message)s')
+    parser = argparse.ArgumentParser(description="Replay the money journal to rebuild balances at a point in time.")
+    parser.add_argument("--dir", help="Journal directory. Default: data/journal, or the guild's journal with --guild.")
+    parser.add_argument("--guild", type=int, help="Replay this guild's economy (data/guilds/<id>/journal).")
+    parser.add_argument("--until", help="Epoch seconds or ISO timestamp (UTC if no offset). Default: latest entry.")
+    parser.add_argument("--user", type=int, help="Show this user's balance and replayed history.")
+    parser.add_argument("--write-db", help="Write the replayed balances and pools into this SQLite ledger (e.g. a recovery copy).")
+    args = parser.parse_args()
+    args.dir = args.dir or (os.path.join("data", "guilds", str(args.guild), "journal") if args.guild is not None else os.path.join("data", "journal"))
+    users, pools, info = replay(args.dir, _parse_time(args.until) if args.until else None, args.user)
+    when = lambda t: datetime.datetime.fromtimestamp(t, datetime.timezone.utc).isoformat(timespec="seconds")
+    total = sum(d["balance"] + d["savings"] for d in users.values()) + sum(pools.values())
+    print(f"Snapshot {os.path.basename(info['snapshot'])} ({when(info['snapshot_t'])}) + {info['applied']:,} entries -> seq {info['last_seq']} ({when(info['last_t'])})")
+    print(f"{len(users):,} users, money supply {fmt_coins(total)}, pools: " + ", ".join(f"{k}={fmt_coins(v)}" for k, v in pools.items()))
+    if args.user is not None:
+        user = users.get(args.user)
+        print(f"User {args.user}: " + (f"balance {fmt_coins(user['balance'])}, savings {fmt_coins(user['savings'])}" if user else "not found"))
+        milli = lambda amount: round(amount * info["scale"])
+        for e in info["history"]: print(f"  {when(e['t'])} #{e['s']} {e['op']:<10} {e['f']:<18} " + (f"= {fmt_coins(milli(e['v']))}" if "v" in e else f"{'+' if e['d'] >= 0 else ''}{fmt_coins(milli(e['d']))}"))
+    if args.write_db:
+        from ledger_store import LedgerStore
+        store = LedgerStore(args.write_db); existing = store.load_users()
+        rows = {uid: {**existing.get(uid, {"pin": None, "best_win": 0}), **d} for uid, d in users.items()}
+        store.commit(users=rows, state={**store.load_state(), **pools}); store.close()
+        print(f"Wrote {len(rows):,} users and pools to {args.write_db}.")
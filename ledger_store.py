@@ -0,0 +1,243 @@
+# ledger_store.py
+# SQLite (WAL) persistence for the currency bot. Replaces whole-file JSON rewrites with row-level upserts.
+# Money columns and pool values are integer milli-coins (money.py); older coin-denominated ledgers are converted on open.
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import argparse
+import tempfile
+
+from money import MILLI, to_milli
+
+logger = logging.getLogger(__name__)
+
+USERS_TABLE = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    balance INTEGER NOT NULL DEFAULT 0,
+    savings INTEGER NOT NULL DEFAULT 0,
+    pin TEXT,
+    best_win INTEGER NOT NULL DEFAULT 0
+);"""
+SCHEMA = USERS_TABLE + """
+CREATE TABLE IF NOT EXISTS bot_state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS orders (
+    order_id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS orders_status ON orders (status);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+MONEY_STATE_KEYS = ("slot_jackpot_pool", "lottery_pot") # bot_state values holding money
+
+def _num(value) -> int | float:
+    if isinstance(value, bool) or not isinstance(value, (int, float)): return 0
+    return int(value) if isinstance(value, float) and value.is_integer() else value
+
+def atomic_write_json(path: str, data, indent: int | None = 4):
+    """Writes JSON to a temp file in the same directory, fsyncs it, then renames it over `path`."""
+    dirname = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=dirname)
+    try:
+        with os.fdopen(fd, 'w') as f: json.dump(data, f, indent=indent); f.flush(); os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try: os.unlink(tmp_path)
+        except OSError: pass
+        raise
+
+def snapshot_state(state: dict) -> dict:
+    """Copies a state dict one container level deep so a worker thread can serialize it while the loop keeps mutating."""
+    return {k: (list(v) if isinstance(v, list) else dict(v) if isinstance(v, dict) else v) for k, v in state.items()}
+
+class LedgerStore:
+    """Embedded transactional store: one row per user plus a key/value table for bot state."""
+    def __init__(self, path: str):
+        self.path = path
+        dirname = os.path.dirname(path)
+        if dirname: os.makedirs(dirname, exist_ok=True)
+        # isolation_level=None -> we issue BEGIN/COMMIT ourselves so multi-row writes are one transaction.
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self._migrate()
+
+    def _migrate(self):
+        """Adds columns introduced after a ledger was first created and converts coin amounts to milli-coins."""
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(users)")}
+        if "best_win" not in columns: self.conn.execute("ALTER TABLE users ADD COLUMN best_win REAL NOT NULL DEFAULT 0")
+        self.migrated_to_milli = self.get_meta("money_unit") is None
+        if self.migrated_to_milli: self._migrate_to_milli()
+    def _migrate_to_milli(self):
+        """One-time rewrite of a coin-denominated ledger: REAL user columns become INTEGER milli-coins, and the money pools
+        and open-order escrow amounts in the JSON values are scaled the same way. All or nothing."""
+        started = time.perf_counter(); cur = self.conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            cur.execute("ALTER TABLE users RENAME TO users_coins"); cur.execute(USERS_TABLE)
+            cur.execute(f"INSERT INTO users (user_id, balance, savings, pin, best_win) SELECT user_id, CAST(ROUND(balance * {MILLI}) AS INTEGER), "
+                        f"CAST(ROUND(savings * {MILLI}) AS INTEGER), pin, CAST(ROUND(best_win * {MILLI}) AS INTEGER) FROM users_coins")
+            cur.execute("DROP TABLE users_coins"); users = cur.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+            for key in MONEY_STATE_KEYS:
+                row = cur.execute("SELECT value FROM bot_state WHERE key = ?", (key,)).fetchone()
+                if row: cur.execute("UPDATE bot_state SET value = ? WHERE key = ?", (json.dumps(to_milli(_num(json.loads(row[0])))), key))
+            orders = cur.execute("SELECT order_id, data FROM orders").fetchall()
+            for order_id, data in orders:
+                order = json.loads(data); order["amount"] = to_milli(_num(order.get("amount", 0)))
+                cur.execute("UPDATE orders SET data = ? WHERE order_id = ?", (json.dumps(order), order_id))
+            cur.execute("INSERT INTO meta (key, value) VALUES ('money_unit', 'milli') ON CONFLICT(key) DO UPDATE SET value = excluded.value")
+            cur.execute("COMMIT")
+        except Exception:
+            cur.execute("ROLLBACK"); raise
+        if users or orders: logger.info(f"Converted ledger to milli-coins ({users:,} users, {len(orders):,} orders) in {(time.perf_counter() - started) * 1000:.1f} ms.")
+
+    def close(self):
+        try: self.conn.close()
+        except Exception as e: logger.error(f"Error closing ledger store: {e}")
+
+    # --- Reads ---
+    def load_users(self) -> dict[int, dict]:
+        rows = self.conn.execute("SELECT user_id, balance, savings, pin, best_win FROM users").fetchall()
+        return {uid: {"balance": _num(bal), "savings": _num(sav), "pin": pin, "best_win": _num(best)} for uid, bal, sav, pin, best in rows}
+    def load_state(self) -> dict:
+        state = {}
+        for key, value in self.conn.execute("SELECT key, value FROM bot_state").fetchall():
+            try: state[key] = json.loads(value)
+            except json.JSONDecodeError: logger.warning(f"Skipping undecodable bot_state key '{key}'")
+        return state
+    def load_orders(self, statuses: tuple[str, ...]) -> dict[str, dict]:
+        """Orders in the given statuses, keyed by order ID."""
+        rows = self.conn.execute(f"SELECT order_id, data FROM orders WHERE status IN ({', '.join('?' * len(statuses))})", statuses).fetchall()
+        orders = {}
+        for order_id, data in rows:
+            try: orders[order_id] = json.loads(data)
+            except json.JSONDecodeError: logger.warning(f"Skipping undecodable order '{order_id}'")
+        return orders
+    def get_meta(self, key: str, default=None):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+    def user_count(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    # --- Writes ---
+    def commit(self, users: dict[int, dict] | None = None, state: dict | None = None, deleted_users: list[int] | None = None, orders: dict[str, dict] | None = None):
+        """Writes the given user rows, bot state and/or orders in a single transaction."""
+        cur = self.conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            if users:
+                cur.executemany(
+                    "INSERT INTO users (user_id, balance, savings, pin, best_win) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET balance = excluded.balance, savings = excluded.savings, pin = excluded.pin, best_win = excluded.best_win",
+                    [(int(uid), _num(d.get("balance", 0)), _num(d.get("savings", 0)), d.get("pin"), _num(d.get("best_win", 0))) for uid, d in users.items()])
+            if deleted_users: cur.executemany("DELETE FROM users WHERE user_id = ?", [(int(uid),) for uid in deleted_users])
+            if state is not None:
+                cur.executemany("INSERT INTO bot_state (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                                [(key, json.dumps(value)) for key, value in state.items()])
+            if orders:
+                cur.executemany("INSERT INTO orders (order_id, user_id, status, created_at, data) VALUES (?, ?, ?, ?, ?) "
+                                "ON CONFLICT(order_id) DO UPDATE SET status = excluded.status, data = excluded.data",
+                                [(order_id, int(o["user_id"]), o["status"], o["created_at"], json.dumps(o)) for order_id, o in orders.items()])
+            cur.execute("COMMIT")
+        except Exception:
+            cur.execute("ROLLBACK"); raise
+    def set_meta(self, key: str, value: str):
+        self.conn.execute("INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value", (key, value))
+
+    # --- One-shot JSON importer ---
+    def import_json(self, user_file: str | None, bot_file: str | None = None) -> int:
+        """Imports the legacy JSON files (coin amounts, stored as milli-coins). Returns the number of users imported."""
+        users = {}
+        if user_file and os.path.exists(user_file):
+            with open(user_file, 'r') as f: loaded = json.load(f)
+            for user_id_str, data in loaded.items():
+                try: user_id = int(user_id_str)
+                except ValueError: logger.warning(f"Import: skipping invalid user ID key '{user_id_str}'"); continue
+                if isinstance(data, (int, float)): users[user_id] = {"balance": to_milli(_num(data)), "savings": 0, "pin": None}
+                elif isinstance(data, dict):
+                    pin = data.get("pin")
+                    users[user_id] = {"balance": to_milli(_num(data.get("balance", 0))), "savings": to_milli(_num(data.get("savings", 0))), "pin": pin if isinstance(pin, str) else None}
+                else: logger.warning(f"Import: skipping invalid data for user {user_id_str}")
+        state = None
+        if bot_file and os.path.exists(bot_file):
+            with open(bot_file, 'r') as f: state = json.load(f)
+            if not isinstance(state, dict): state = None
+            else: state.update({key: to_milli(_num(state[key])) for key in MONEY_STATE_KEYS if key in state}) # JSON files are in coins
+        self.commit(users=users, state=state)
+        self.set_meta("json_imported_from", json.dumps({"users": user_file, "bot_data": bot_file}))
+        logger.info(f"Imported {len(users)} users from JSON into {self.path}.")
+        return len(users)
+
+# --- Write-behind buffer ---
+class WriteBehindBuffer:
+    """Tracks dirty user IDs, order IDs and whether bot state changed, and flushes only those rows in one transaction."""
+    def __init__(self, store: LedgerStore, max_dirty: int = 500):
+        self.store = store; self.max_dirty = max_dirty
+        self.dirty_users: set[int] = set(); self.dirty_orders: set[str] = set(); self.state_dirty = False
+        self.stats = {"marks": 0, "flushes": 0, "rows_flushed": 0, "last_batch": 0, "max_batch": 0,
+                      "last_flush_ms": 0.0, "max_flush_ms": 0.0, "total_flush_ms": 0.0, "failures": 0}
+    def mark(self, *user_ids: int, state: bool = False, orders: tuple[str, ...] = ()) -> bool:
+        """Marks users/state/orders dirty. Returns True once the dirty set reaches the size threshold."""
+        for uid in user_ids: self.dirty_users.add(int(uid))
+        if state: self.state_dirty = True
+        self.dirty_orders.update(orders)
+        self.stats["marks"] += 1
+        return len(self.dirty_users) >= self.max_dirty
+    def has_pending(self) -> bool: return bool(self.dirty_users) or bool(self.dirty_orders) or self.state_dirty
+    def take_batch(self, users: dict[int, dict], state: dict, orders: dict[str, dict] | None = None) -> tuple[dict[int, dict], dict | None, list[int], dict[str, dict]]:
+        """Snapshots the dirty rows (copies) and clears the dirty set. Call from the thread that owns `users`."""
+        ids = list(self.dirty_users); self.dirty_users.clear()
+        rows = {uid: dict(users[uid]) for uid in ids if uid in users}
+        deleted = [uid for uid in ids if uid not in users]
+        state_copy = snapshot_state(state) if self.state_dirty else None; self.state_dirty = False
+        order_rows = {oid: dict(orders[oid]) for oid in self.dirty_orders if orders and oid in orders}; self.dirty_orders.clear()
+        return rows, state_copy, deleted, order_rows
+    def write_batch(self, rows: dict[int, dict], state: dict | None, deleted: list[int], order_rows: dict[str, dict] | None = None) -> int:
+        """Commits a batch from take_batch(). Safe to call from a worker thread; on failure call requeue()."""
+        if not rows and state is None and not deleted and not order_rows: return 0
+        started = time.perf_counter()
+        try: self.store.commit(users=rows, state=state, deleted_users=deleted, orders=order_rows)
+        except Exception: self.stats["failures"] += 1; raise
+        elapsed_ms = (time.perf_counter() - started) * 1000; batch = len(rows) + len(deleted) + len(order_rows or ())
+        st = self.stats; st["flushes"] += 1; st["rows_flushed"] += batch; st["last_batch"] = batch; st["max_batch"] = max(st["max_batch"], batch)
+        st["last_flush_ms"] = elapsed_ms; st["max_flush_ms"] = max(st["max_flush_ms"], elapsed_ms); st["total_flush_ms"] += elapsed_ms
+        return batch
+    def requeue(self, rows: dict[int, dict], state: dict | None, deleted: list[int], order_rows: dict[str, dict] | None = None):
+        """Re-marks a failed batch dirty so the next flush retries it."""
+        self.dirty_users.update(rows.keys()); self.dirty_users.update(deleted); self.dirty_orders.update(order_rows or ())
+        if state is not None: self.state_dirty = True
+    def flush(self, users: dict[int, dict], state: dict, orders: dict[str, dict] | None = None) -> int:
+        batch = self.take_batch(users, state, orders)
+        try: return self.write_batch(*batch)
+        except Exception: self.requeue(*batch); raise
+    def summary(self) -> str:
+        st = self.stats; avg_ms = st["total_flush_ms"] / st["flushes"] if st["flushes"] else 0.0
+        avg_batch = st["rows_flushed"] / st["flushes"] if st["flushes"] else 0.0
+        return (f"flushes={st['flushes']} rows={st['rows_flushed']} marks={st['marks']} batch(last/avg/max)={st['last_batch']}/{avg_batch:.1f}/{st['max_batch']} "
+                f"latency_ms(last/avg/max)={st['last_flush_ms']:.2f}/{avg_ms:.2f}/{st['max_flush_ms']:.2f} failures={st['failures']} pending={len(self.dirty_users) + len(self.dirty_orders)}")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s:%(levelname)s:%(name)s: %(message)s')
+    parser = argparse.ArgumentParser(description="Import legacy JSON economy files into the SQLite ledger.")
+    parser.add_argument("--db", default=os.path.join("data", "economy.db"))
+    parser.add_argument("--users", default=os.path.join("data", "user_balances.json"))
+    parser.add_argument("--bot-data", default=os.path.join("data", "bot_data.json"))
+    parser.add_argument("--force", action="store_true", help="Import even if the ledger already has users.")
+    args = parser.parse_args()
+    store = LedgerStore(args.db)
+    if store.user_count() and not args.force: print(f"{args.db} already has {store.user_count()} users; use --force to re-import.")
+    else: print(f"Imported {store.import_json(args.users, args.bot_data)} users into {args.db}.")
+    store.close()
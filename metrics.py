@@ -0,0 +1,154 @@
+# metrics.py
+# In-process metrics: counters, gauges and histograms rendered in the Prometheus text format, served by a tiny asyncio
+# HTTP endpoint (no extra dependency). Histograms also keep a sliding window of recent samples for p50/p95/p99.
+# Run `python metrics.py --bench` to measure the per-observation overhead.
+
+import time
+import asyncio
+import logging
+import argparse
+import bisect
+import functools
+import collections
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0) # Seconds
+
+def _escape(value: str) -> str: return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)] + ([extra] if extra else [])
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+def _fmt(value: float) -> str: return "+Inf" if value == float("inf") else repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    """Monotonic count per label set."""
+    kind = "counter"
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name; self.help = help; self.label_names = labels; self.values: dict[tuple, float] = {}
+    def inc(self, *labels, amount: float = 1): self.values[labels] = self.values.get(labels, 0) + amount
+    def get(self, *labels) -> float: return self.values.get(labels, 0)
+    def render(self) -> list[str]: return [f"{self.name}{_labels(self.label_names, k)} {_fmt(v)}" for k, v in self.values.items()]
+
+class Gauge:
+    """Current value per label set; set_function() makes an unlabelled gauge read its value at scrape time."""
+    kind = "gauge"
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name; self.help = help; self.label_names = labels; self.values: dict[tuple, float] = {}; self.function = None
+    def set(self, value: float, *labels): self.values[labels] = value
+    def inc(self, *labels, amount: float = 1): self.values[labels] = self.values.get(labels, 0) + amount
+    def dec(self, *labels, amount: float = 1): self.values[labels] = self.values.get(labels, 0) - amount
+    def get(self, *labels) -> float: return self.function() if self.function else self.values.get(labels, 0)
+    def set_function(self, function): self.function = function
+    def render(self) -> list[str]:
+        if self.function:
+            try: return [f"{self.name} {_fmt(self.function())}"]
+            except Exception as e: logger.warning(f"Gauge {self.name} callback failed: {e}"); return []
+        return [f"{self.name}{_labels(self.label_names, k)} {_fmt(v)}" for k, v in self.values.items()]
+
+class _Series:
+    __slots__ = ("counts", "sum", "count", "recent")
+    def __init__(self, buckets: int, window_size: int):
+        self.counts = [0] * (buckets + 1); self.sum = 0.0; self.count = 0; self.recent: collections.deque[tuple[float, float]] = collections.deque(maxlen=window_size)
+
+class Histogram:
+    """Bucketed distribution per label set (for Prometheus) plus the last `window_size` samples within `window_seconds`
+    (for percentiles). observe() is O(log buckets); percentiles sort the window on demand."""
+    kind = "histogram"
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+                 window_seconds: float = 900.0, window_size: int = 2048, clock=time.monotonic):
+        self.name = name; self.help = help; self.label_names = labels; self.buckets = tuple(sorted(buckets))
+        self.window_seconds = window_seconds; self.window_size = window_size; self.clock = clock; self.series: dict[tuple, _Series] = {}
+    def observe(self, value: float, *labels):
+        series = self.series.get(labels)
+        if series is None: series = self.series[labels] = _Series(len(self.buckets), self.window_size)
+        series.counts[bisect.bisect_left(self.buckets, value)] += 1; series.sum += value; series.count += 1; series.recent.append((self.clock(), value))
+    def time(self, *labels, in_flight: Gauge | None = None) -> "Timer": return Timer(self, labels, in_flight)
+    def window(self, *labels) -> list[float]:
+        series = self.series.get(labels)
+        if series is None: return []
+        cutoff = self.clock() - self.window_seconds
+        return [value for t, value in series.recent if t >= cutoff]
+    def percentiles(self, *labels, qs: tuple[float, ...] = (0.5, 0.95, 0.99)) -> tuple[int, list[float]]:
+        """(samples in the window, nearest-rank value for each q); values are 0.0 with no samples."""
+        values = sorted(self.window(*labels))
+        if not values: return 0, [0.0] * len(qs)
+        return len(values), [values[min(len(values) - 1, max(0, int(q * len(values) + 0.5) - 1))] for q in qs]
+    def render(self) -> list[str]:
+        lines = []
+        for key, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series.counts):
+                le = 'le="' + _fmt(bound) + '"'; cumulative += count; lines.append(f"{self.name}_bucket{_labels(self.label_names, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {_fmt(series.sum)}"); lines.append(f"{self.name}_count{_labels(self.label_names, key)} {series.count}")
+        return lines
+
+class Timer:
+    """`with` / `async with` block timer: observes the elapsed seconds and keeps an optional in-flight gauge current."""
+    __slots__ = ("histogram", "labels", "in_flight", "started")
+    def __init__(self, histogram: Histogram, labels: tuple, in_flight: Gauge | None = None):
+        self.histogram = histogram; self.labels = labels; self.in_flight = in_flight; self.started = 0.0
+    def __enter__(self):
+        if self.in_flight: self.in_flight.inc(*self.labels)
+        self.started = time.perf_counter(); return self
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+        if self.in_flight: self.in_flight.dec(*self.labels)
+    async def __aenter__(self): return self.__enter__()
+    async def __aexit__(self, *exc): self.__exit__(*exc)
+
+def timed(histogram: Histogram, *labels, in_flight: Gauge | None = None):
+    """Decorator for coroutine functions (e.g. a tasks.loop body): each call is observed in `histogram`."""
+    def decorate(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with Timer(histogram, labels, in_flight): return await func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+class Registry:
+    def __init__(self): self.metrics: dict[str, Counter | Gauge | Histogram] = {}
+    def _add(self, metric):
+        if metric.name in self.metrics: raise ValueError(f"Metric {metric.name} already registered")
+        self.metrics[metric.name] = metric; return metric
+    def counter(self, name: str, help: str, labels: tuple[str, ...] = ()) -> Counter: return self._add(Counter(name, help, labels))
+    def gauge(self, name: str, help: str, labels: tuple[str, ...] = ()) -> Gauge: return self._add(Gauge(name, help, labels))
+    def histogram(self, name: str, help: str, labels: tuple[str, ...] = (), **kwargs) -> Histogram: return self._add(Histogram(name, help, labels, **kwargs))
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values(): lines += [f"# HELP {metric.name} {metric.help}", f"# TYPE {metric.name} {metric.kind}"] + metric.render()
+        return "\n".join(lines) + "\n"
+
+async def serve(registry: Registry, host: str, port: int) -> asyncio.AbstractServer:
+    """Serves GET /metrics in the Prometheus text format. Scrapes render on the event loop, so keep label sets bounded."""
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""): pass # Headers are ignored
+            parts = request.split()
+            if len(parts) >= 2 and parts[0] == b"GET" and parts[1].split(b"?", 1)[0] == b"/metrics": status = "200 OK"; body = registry.render().encode()
+            else: status = "404 Not Found"; body = b"Not found. Try /metrics\n"
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except Exception as e: logger.debug(f"Metrics request failed: {e}")
+        finally: writer.close()
+    return await asyncio.start_server(handle, host, port)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the per-observation cost of counters, histograms and rendering.")
+    parser.add_argument("--bench", type=int, nargs="?", const=1_000_000, metavar="N", help="Time N observations (default 1,000,000).")
+    args = parser.parse_args()
+    if args.bench is None: parser.print_help(); raise SystemExit(2)
+    registry = Registry(); hist = registry.histogram("demo_seconds", "Demo.", ("op",)); counter = registry.counter("demo_total", "Demo.", ("op",))
+    started = time.perf_counter()
+    for i in range(args.bench): hist.observe((i % 1000) / 10000, "a" if i & 1 else "b")
+    observe_ns = (time.perf_counter() - started) / args.bench * 1e9; started = time.perf_counter()
+    for i in range(args.bench): counter.inc("a")
+    inc_ns = (time.perf_counter() - started) / args.bench * 1e9; started = time.perf_counter()
+    for _ in range(args.bench // 10):
+        with hist.time("c"): pass
+    timer_ns = (time.perf_counter() - started) / (args.bench // 10) * 1e9; started = time.perf_counter()
+    count, (p50, p95, p99) = hist.percentiles("a"); pct_ms = (time.perf_counter() - started) * 1000; started = time.perf_counter()
+    text = registry.render(); render_ms = (time.perf_counter() - started) * 1000
+    print(f"observe {observe_ns:.0f} ns, counter inc {inc_ns:.0f} ns, timed block {timer_ns:.0f} ns; percentiles over {count} samples {pct_ms:.2f} ms "
+          f"(p50={p50:.4f} p95={p95:.4f} p99={p99:.4f}); render {len(text.splitlines())} lines {render_ms:.2f} ms")
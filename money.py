@@ -0,0 +1,26 @@
+# money.py
+# Fixed-point money: balances, savings, pools, escrow, stakes and payouts are ints counting milli-coins (1 coin = 1000).
+# Convert with to_milli() where coins come in (slash command amounts, config, shop prices) and fmt_coins() where they go out.
+
+from decimal import Decimal
+from fractions import Fraction
+
+MILLI = 1000
+Milli = int # Amounts in milli-coins; an alias so signatures say which unit they take
+
+def to_milli(coins: int | float | str | Decimal) -> Milli:
+    """Coins -> milli-coins. Ints are exact; floats/strings go through their decimal text (0.1 -> 100), rounded half-even."""
+    if isinstance(coins, int): return coins * MILLI
+    return int((Decimal(str(coins)) * MILLI).to_integral_value())
+def to_coins(milli: Milli) -> float:
+    """Milli-coins -> float coins, for statistics and ratios only (never store the result)."""
+    return milli / MILLI
+def fmt_coins(milli: Milli) -> str:
+    """`1,234` for whole coins, otherwise up to three decimals without trailing zeros (`1,234.5`)."""
+    whole, frac = divmod(abs(int(milli)), MILLI); sign = "-" if milli < 0 else ""
+    return f"{sign}{whole:,}" + (f".{frac:03d}".rstrip("0") if frac else "")
+def scale(milli: Milli, ratio: int | float | Fraction) -> Milli:
+    """milli * ratio, floored to a whole milli-coin. Float ratios are read as their decimal text (0.1 -> 1/10), so results are exact."""
+    if isinstance(ratio, int): return milli * ratio
+    if not isinstance(ratio, Fraction): ratio = Fraction(str(ratio))
+    return milli * ratio.numerator // ratio.denominator
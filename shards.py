@@ -0,0 +1,79 @@
+# shards.py
+# Per-guild economy shards: each guild's ledger, journal and shop catalog live in data/guilds/<guild_id>/, are loaded on
+# first use and dropped from memory once idle, so memory, saves and resets scale with one guild instead of all of them.
+
+import os
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+LEGACY_FILES = ("economy.db", "economy.db-wal", "economy.db-shm", "journal", "shop_items.json", "user_balances.json", "bot_data.json") # Pre-shard single economy
+
+def shard_dir(root: str, guild_id: int) -> str: return os.path.join(root, str(int(guild_id)))
+def has_legacy_data(data_dir: str) -> bool: return any(os.path.exists(os.path.join(data_dir, name)) for name in LEGACY_FILES)
+def adopt_legacy_data(data_dir: str, root: str, guild_id: int) -> list[str]:
+    """Moves the single-economy files in `data_dir` into the guild's shard directory (the ledger must not be open).
+    Names the shard already has are left where they are. Returns the moved names."""
+    target = shard_dir(root, guild_id); os.makedirs(target, exist_ok=True); moved = []
+    for name in LEGACY_FILES:
+        src = os.path.join(data_dir, name); dst = os.path.join(target, name)
+        if not os.path.exists(src): continue
+        if os.path.exists(dst): logger.warning(f"Not adopting {src}: {dst} already exists."); continue
+        os.replace(src, dst); moved.append(name)
+    return moved
+
+class ShardCache:
+    """Lazily loaded, idle-evicted shards keyed by guild ID.
+
+    get() builds a missing shard with `await load(key)` (one load per key; concurrent callers wait for it) and counts as
+    use. evict_idle() passes shards unused for `idle_seconds` to `await unload(key, shard)`. A shard leaves the map before
+    its unload starts, so a get() arriving mid-unload waits and then reloads the persisted state; if unload raises, the
+    shard is put back. Iterating values() does not count as use, so background loops don't keep shards alive.
+    """
+    def __init__(self, load, unload, idle_seconds: float, clock=time.monotonic):
+        self.load = load; self.unload = unload; self.idle_seconds = idle_seconds; self.clock = clock
+        self._shards: dict[int, object] = {}; self._last_used: dict[int, float] = {}; self._locks: dict[int, asyncio.Lock] = {}
+        self.stats = {"hits": 0, "loads": 0, "evictions": 0, "failed_unloads": 0, "peak_loaded": 0, "last_load_ms": 0.0, "max_load_ms": 0.0}
+    def _lock(self, key: int) -> asyncio.Lock: return self._locks.setdefault(key, asyncio.Lock()) # Kept after eviction: a waiter may still hold it
+    async def get(self, key: int):
+        if (shard := self._shards.get(key)) is not None: self._last_used[key] = self.clock(); self.stats["hits"] += 1; return shard
+        async with self._lock(key):
+            if (shard := self._shards.get(key)) is None:
+                started = time.perf_counter(); shard = await self.load(key); self._shards[key] = shard
+                elapsed_ms = (time.perf_counter() - started) * 1000; st = self.stats
+                st["loads"] += 1; st["last_load_ms"] = elapsed_ms; st["max_load_ms"] = max(st["max_load_ms"], elapsed_ms); st["peak_loaded"] = max(st["peak_loaded"], len(self._shards))
+            self._last_used[key] = self.clock()
+            return shard
+    def loaded(self, key: int): return self._shards.get(key)
+    def values(self) -> list: return list(self._shards.values())
+    def keys(self) -> list[int]: return list(self._shards)
+    def __len__(self) -> int: return len(self._shards)
+    def __contains__(self, key: int) -> bool: return key in self._shards
+    async def evict(self, key: int) -> bool:
+        async with self._lock(key):
+            shard = self._shards.pop(key, None)
+            if shard is None: return False
+            last_used = self._last_used.pop(key, self.clock())
+            try: await self.unload(key, shard)
+            except Exception as e:
+                self._shards[key] = shard; self._last_used[key] = last_used; self.stats["failed_unloads"] += 1
+                logger.error(f"Unloading shard {key} failed, keeping it in memory: {e}", exc_info=True); return False
+            self.stats["evictions"] += 1; return True
+    def discard(self, key: int):
+        """Drops a shard without unloading it (its state must not be written, e.g. another process now owns it). Returns it."""
+        self._last_used.pop(key, None); return self._shards.pop(key, None)
+    async def evict_idle(self, can_evict=None) -> int:
+        """Unloads shards idle for idle_seconds that `can_evict(shard)` allows. Returns how many were evicted."""
+        cutoff = self.clock() - self.idle_seconds; evicted = 0
+        for key, used in list(self._last_used.items()):
+            if used <= cutoff and (shard := self._shards.get(key)) is not None and (can_evict is None or can_evict(shard)): evicted += await self.evict(key)
+        return evicted
+    async def close(self):
+        """Unloads every shard (shutdown)."""
+        for key in list(self._shards): await self.evict(key)
+    def summary(self) -> str:
+        st = self.stats
+        return (f"loaded={len(self._shards)} peak={st['peak_loaded']} loads={st['loads']} hits={st['hits']:,} evictions={st['evictions']} "
+                f"failed_unloads={st['failed_unloads']} load_ms(last/max)={st['last_load_ms']:.1f}/{st['max_load_ms']:.1f} idle_after={self.idle_seconds:g}s")
@@ -0,0 +1,7 @@
+# tests/conftest.py
+# Tests import the bot's modules from the repository root (working_money_bot.py itself needs disnake and is not imported).
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
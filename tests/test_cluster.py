@@ -0,0 +1,41 @@
+# tests/test_cluster.py
+# ClusterState leases and lottery claims between two owners sharing one database, on a fake clock.
+
+from cluster import ClusterState, LEADER_LEASE, guild_lease
+
+def _pair(tmp_path, lease_seconds: float = 30.0):
+    now = [1000.0]; path = str(tmp_path / "cluster.db")
+    a = ClusterState(path, "a", lease_seconds, clock=lambda: now[0]); b = ClusterState(path, "b", lease_seconds, clock=lambda: now[0])
+    return now, a, b
+
+def test_lease_is_exclusive_until_it_expires(tmp_path):
+    now, a, b = _pair(tmp_path)
+    assert a.try_acquire(LEADER_LEASE) == "a" and b.try_acquire(LEADER_LEASE) == "a"
+    now[0] += 20; assert LEADER_LEASE in a.renew()
+    now[0] += 20; assert b.try_acquire(LEADER_LEASE) == "a" # Renewed at +20, so still live at +40
+    now[0] += 31; assert b.try_acquire(LEADER_LEASE) == "b" and not a.holds(LEADER_LEASE)
+    assert LEADER_LEASE not in a.renew() # a learns it lost the lease
+    a.close(); b.close()
+
+def test_release_frees_lease(tmp_path):
+    now, a, b = _pair(tmp_path)
+    a.try_acquire(guild_lease(1)); a.release(guild_lease(1))
+    assert a.holder(guild_lease(1)) is None and b.try_acquire(guild_lease(1)) == "b"
+    b.release_all(); assert b.holder(guild_lease(1)) is None
+    a.close(); b.close()
+
+def test_only_the_lease_holder_claims_a_due_draw_once(tmp_path):
+    now, a, b = _pair(tmp_path)
+    a.try_acquire(guild_lease(5)); a.schedule_draw(5, now[0] + 10)
+    assert not a.claim_draw(5, guild_lease(5)) # Not due yet
+    now[0] += 10
+    assert not b.claim_draw(5, guild_lease(5)) # b doesn't hold the guild
+    assert a.claim_draw(5, guild_lease(5)) and not a.claim_draw(5, guild_lease(5)) and a.draws() == {}
+    a.close(); b.close()
+
+def test_stalled_owner_cannot_claim_after_takeover(tmp_path):
+    now, a, b = _pair(tmp_path)
+    a.try_acquire(guild_lease(9)); a.schedule_draw(9, now[0])
+    now[0] += 31; assert b.try_acquire(guild_lease(9)) == "b" # a stalled past its lease
+    assert not a.claim_draw(9, guild_lease(9)) and b.claim_draw(9, guild_lease(9))
+    a.close(); b.close()
@@ -0,0 +1,67 @@
+# tests/test_economy.py
+# economy.py building blocks: balance operations and the in-memory indexes.
+
+import random
+import asyncio
+
+import pytest
+
+from money import MILLI
+from economy import BalanceOps, InsufficientFunds, MoneySupply, UserRecord, LotteryTickets, RankIndex, MessageRewards
+
+def _ops(balances: dict[int, int]) -> tuple[BalanceOps, dict[int, UserRecord], MoneySupply]:
+    users = {uid: UserRecord(balance=b) for uid, b in balances.items()}; supply = MoneySupply(10**15)
+    supply.reconcile(users, {})
+    return BalanceOps(lambda uid: users.setdefault(uid, UserRecord()), supply), users, supply
+
+def test_transfer_is_all_or_nothing():
+    async def run():
+        ops, users, supply = _ops({1: 100, 2: 0})
+        await ops.transfer(1, 2, 60)
+        with pytest.raises(InsufficientFunds): await ops.transfer(1, 2, 60)
+        assert users[1].balance == 40 and users[2].balance == 60 and supply.total == 100
+    asyncio.run(run())
+
+def test_bet_settles_under_one_hold():
+    """The gamble commands' path: an admin set racing a round sees the paid-out balance, never the gap after the debit."""
+    async def run():
+        ops, users, supply = _ops({1: 100}); during = []
+        def resolve(): during.append((ops.held(), users[1].balance)); return {"winnings": 100}
+        async def admin_set():
+            async with ops.hold(1): during.append(("set saw", users[1].balance)); users[1].balance = 7
+        outcome, udata = (await asyncio.gather(ops.bet(1, 50, resolve), admin_set()))[0]
+        assert during == [(True, 50), ("set saw", 150)] and users[1].balance == 7 and outcome["winnings"] == 100 and not ops.held()
+    asyncio.run(run())
+
+def test_bet_waits_for_a_held_user_and_refuses_overdraw():
+    async def run():
+        ops, users, supply = _ops({1: 100}); order = []
+        async with ops.hold(1): # e.g. a transfer in flight
+            round_ = asyncio.create_task(ops.bet(1, 30, lambda: order.append("round") or {"winnings": 0})); await asyncio.sleep(0)
+            assert order == [] and users[1].balance == 100
+        await round_
+        with pytest.raises(InsufficientFunds): await ops.bet(1, 1000, lambda: order.append("never") or {"winnings": 0})
+        assert order == ["round"] and users[1].balance == 70 and supply.total == 70
+    asyncio.run(run())
+
+def test_lottery_draw_is_weighted_and_survives_growth():
+    tickets = LotteryTickets()
+    for uid in range(100): tickets.add(uid, 1 if uid else 900) # Forces _grow() past the initial capacity
+    assert tickets.total == 999 and tickets.count(0) == 900
+    rng = random.Random(1); wins = sum(tickets.draw(rng) == 0 for _ in range(2000))
+    assert 1700 < wins < 1900
+    assert LotteryTickets.from_json(["5", "5", "6"]).counts == {5: 2, 6: 1}
+    tickets.clear()
+    with pytest.raises(IndexError): tickets.draw(rng)
+
+def test_rank_index_orders_and_updates():
+    index = RankIndex()
+    for uid, score in ((1, 10), (2, 30), (3, 20)): index.update(uid, score)
+    index.update(1, 40); index.discard(3)
+    assert index.top(2) == [(1, 40), (2, 30)] and index.rank(2) == 2 and index.rank(3) is None
+
+def test_message_rewards_diminish_within_window():
+    now = [0.0]; rewards = MessageRewards(window=60, full_rate=2, decay=0.5, clock=lambda: now[0])
+    assert [rewards.add(1) for _ in range(4)] == [MILLI, MILLI, MILLI // 2, MILLI // 4]
+    credited = {}; assert rewards.drain(lambda uid, amount: credited.update({uid: amount})) == credited[1] == 2750
+    now[0] = 60; assert rewards.add(1) == MILLI # New window
@@ -0,0 +1,45 @@
+# tests/test_journal.py
+# Replay across snapshot boundaries, including batches that reached the old segment after the snapshot's seq.
+
+import os
+
+from journal import Journal, replay, _segments
+
+def _flush(journal: Journal): journal.write(journal.take_pending())
+
+def test_replay_after_checkpoint(tmp_path):
+    journal = Journal(str(tmp_path))
+    journal.record(1, "balance", value=1000); journal.record(2, "balance", value=500); _flush(journal)
+    journal.record(1, "balance", delta=-200); seq = journal.seq; lines = journal.take_pending()
+    journal.checkpoint(lines, seq, {1: {"balance": 800}, 2: {"balance": 500}}, {"lottery_pot": 0})
+    journal.record(2, "balance", delta=300); journal.record(None, "lottery_pot", delta=50); _flush(journal)
+    users, pools, info = replay(str(tmp_path))
+    assert users[1]["balance"] == 800 and users[2]["balance"] == 800 and pools["lottery_pot"] == 50
+    assert info["snapshot_seq"] == seq and info["applied"] == 2 and info["last_seq"] == journal.seq
+
+def test_replay_keeps_entries_written_to_old_segment_after_snapshot_seq(tmp_path):
+    """The old flush/snapshot race: a batch newer than the snapshot is written before the segment switch."""
+    journal = Journal(str(tmp_path))
+    journal.record(1, "balance", value=1000); _flush(journal)
+    seq = journal.seq; state = {1: {"balance": 1000}}
+    journal.record(1, "balance", delta=25); journal.record(1, "balance", delta=25); _flush(journal) # Lands in the old segment
+    journal.snapshot(seq, state, {}) # Switches to journal-<seq + 1>, a name the old segment's newer entries also claim
+    journal.record(1, "balance", delta=-10); _flush(journal)
+    assert len(_segments(str(tmp_path))) == 2
+    users, _, info = replay(str(tmp_path))
+    assert users[1]["balance"] == 1040 and info["applied"] == 3
+
+def test_replay_skips_segments_covered_by_snapshot(tmp_path):
+    journal = Journal(str(tmp_path))
+    for round_ in range(3):
+        journal.record(1, "balance", delta=100); journal.record(2, "savings", delta=7)
+        journal.checkpoint(journal.take_pending(), journal.seq, {1: {"balance": 100 * (round_ + 1)}, 2: {"savings": 7 * (round_ + 1)}}, {})
+    journal.record(1, "balance", delta=1); _flush(journal)
+    users, _, info = replay(str(tmp_path))
+    assert users[1]["balance"] == 301 and users[2]["savings"] == 21 and info["applied"] == 1
+
+def test_reopen_continues_sequence(tmp_path):
+    journal = Journal(str(tmp_path)); journal.record(1, "balance", value=5); journal.checkpoint(journal.take_pending(), journal.seq, {1: {"balance": 5}}, {})
+    journal.record(1, "balance", delta=1); _flush(journal)
+    reopened = Journal(str(tmp_path))
+    assert reopened.seq == journal.seq and os.path.basename(reopened.segment_path) == os.path.basename(journal.segment_path)
@@ -0,0 +1,78 @@
+# tests/test_log_pipeline.py
+# Queue pipeline: JSON fields, bound context, sampling, shedding when full, size rotation and the --bench CLI.
+
+import os
+import sys
+import json
+import asyncio
+import logging
+import subprocess
+
+import pytest
+
+import log_pipeline
+from log_pipeline import setup_logging, bind, SizeAndTimeRotatingFileHandler, JsonFormatter
+
+ROOT = os.path.dirname(os.path.abspath(log_pipeline.__file__))
+
+@pytest.fixture
+def root_handlers():
+    root = logging.getLogger(); saved = (list(root.handlers), root.level)
+    yield
+    for handler in list(root.handlers): root.removeHandler(handler)
+    for handler in saved[0]: root.addHandler(handler)
+    root.setLevel(saved[1])
+
+def _lines(path) -> list[dict]:
+    with open(path, encoding="utf-8") as f: return [json.loads(line) for line in f]
+
+def test_records_carry_bound_and_extra_fields(tmp_path, root_handlers):
+    pipeline = setup_logging(log_file=str(tmp_path / "bot.log"), console=False); log = logging.getLogger("t")
+    async def command():
+        bind(command="pay", user_id=5)
+        try: 1 / 0
+        except ZeroDivisionError: log.error("boom", exc_info=True)
+        log.info("done %s", "ok", extra={"latency_ms": 1.5, "amount": 10})
+    asyncio.run(command()); log.info("outside")
+    pipeline.stop()
+    boom, done, outside = _lines(tmp_path / "bot.log")
+    assert boom["command"] == "pay" and "ZeroDivisionError" in boom["exc"] and boom["level"] == "ERROR"
+    assert done == {**done, "msg": "done ok", "user_id": 5, "latency_ms": 1.5, "amount": 10}
+    assert "command" not in outside # Bound fields stay with the task that bound them
+
+def test_sampling_keeps_one_in_n_and_all_warnings(tmp_path, root_handlers):
+    pipeline = setup_logging(log_file=str(tmp_path / "bot.log"), console=False, sample_every=10); log = logging.getLogger("t")
+    for i in range(25): log.info("msg", extra={"sample": "on_message", "i": i})
+    log.warning("loud", extra={"sample": "on_message"})
+    pipeline.stop()
+    lines = _lines(tmp_path / "bot.log")
+    assert [line.get("i") for line in lines] == [0, 10, 20, None] and lines[0]["sampled"] == 10 and pipeline.sampler.dropped == 22
+
+def test_full_queue_sheds_records(root_handlers):
+    pipeline = setup_logging(log_file=None, console=False, queue_size=5); pipeline.listener.stop() # Nothing drains the queue
+    for _ in range(8): logging.getLogger("t").info("x")
+    assert pipeline.handler.queue.qsize() == 5 and pipeline.handler.dropped == 3
+
+def test_size_rotation_keeps_every_record(tmp_path):
+    path = tmp_path / "bot.log"; handler = SizeAndTimeRotatingFileHandler(str(path), max_bytes=500, backup_count=50); handler.setFormatter(JsonFormatter())
+    log = logging.getLogger("rotation"); log.propagate = False; log.addHandler(handler)
+    for i in range(40): log.warning("line", extra={"i": i})
+    handler.close(); log.removeHandler(handler)
+    files = sorted(tmp_path.iterdir())
+    assert len(files) > 3 and sorted(entry["i"] for f in files for entry in _lines(f)) == list(range(40))
+
+def test_bench_cli():
+    done = subprocess.run([sys.executable, "log_pipeline.py", "--bench", "500"], capture_output=True, text=True, cwd=ROOT)
+    assert done.returncode == 0 and "us/record" in done.stderr
+    assert subprocess.run([sys.executable, "log_pipeline.py"], capture_output=True, cwd=ROOT).returncode == 2
+
+def test_backup_count_keeps_newest_size_rotations_past_ten(tmp_path):
+    path = tmp_path / "bot.log"; handler = SizeAndTimeRotatingFileHandler(str(path), max_bytes=200, backup_count=4); handler.setFormatter(JsonFormatter())
+    log = logging.getLogger("rotation.many"); log.propagate = False; log.addHandler(handler)
+    for i in range(80): log.warning("line", extra={"i": i}) # ~2 records per file: well over 10 rotations in one day
+    handler.close(); log.removeHandler(handler)
+    backups = sorted(f.name for f in tmp_path.iterdir() if f.name != "bot.log")
+    indexes = sorted(int(name.rsplit(".", 1)[1]) if name.count(".") == 3 else 0 for name in backups)
+    assert len(backups) == 4 and indexes[0] >= 10 # The newest rotations (.N with N >= 10) survive, not .2-.9
+    kept = sorted(entry["i"] for f in tmp_path.iterdir() for entry in _lines(f))
+    assert kept == list(range(kept[0], 80)) # Only the oldest records were deleted
@@ -0,0 +1,55 @@
+# tests/test_metrics.py
+# Histogram buckets/percentiles, Prometheus rendering, timers, the /metrics endpoint and the --bench CLI.
+
+import os
+import sys
+import asyncio
+import subprocess
+
+import metrics
+from metrics import Registry, Histogram, timed
+
+ROOT = os.path.dirname(os.path.abspath(metrics.__file__))
+
+def test_histogram_buckets_and_percentiles():
+    now = [0.0]; hist = Histogram("h", "help", ("op",), buckets=(0.1, 1.0), window_seconds=60, clock=lambda: now[0])
+    for value in (0.05, 0.5, 0.5, 5.0): hist.observe(value, "a")
+    assert hist.series[("a",)].counts == [1, 2, 1] and hist.series[("a",)].count == 4
+    assert hist.percentiles("a") == (4, [0.5, 5.0, 5.0])
+    now[0] = 61; hist.observe(0.2, "a")
+    assert hist.percentiles("a") == (1, [0.2, 0.2, 0.2]) and hist.percentiles("missing") == (0, [0.0, 0.0, 0.0])
+
+def test_render_is_prometheus_text():
+    registry = Registry(); counter = registry.counter("c_total", "Count.", ("kind",)); hist = registry.histogram("h_seconds", "Hist.", buckets=(1.0,))
+    gauge = registry.gauge("g", "Gauge."); gauge.set_function(lambda: 3)
+    counter.inc('say "hi"'); hist.observe(0.5)
+    text = registry.render()
+    assert '# TYPE c_total counter\nc_total{kind="say \\"hi\\""} 1' in text
+    assert 'h_seconds_bucket{le="1.0"} 1\nh_seconds_bucket{le="+Inf"} 1\nh_seconds_sum 0.5\nh_seconds_count 1' in text and "\ng 3\n" in text
+
+def test_timer_and_decorator_track_in_flight():
+    registry = Registry(); hist = registry.histogram("t", "T.", ("op",)); in_flight = registry.gauge("f", "F.", ("op",)); seen = []
+    @timed(hist, "job", in_flight=in_flight)
+    async def job(): seen.append(in_flight.get("job")); await asyncio.sleep(0)
+    asyncio.run(job())
+    with hist.time("sync", in_flight=in_flight): seen.append(in_flight.get("sync"))
+    assert seen == [1, 1] and in_flight.get("job") == 0 and hist.series[("job",)].count == 1 and hist.series[("sync",)].count == 1
+
+def test_serve_answers_metrics_and_404():
+    async def run():
+        from metrics import serve
+        registry = Registry(); registry.counter("up_total", "Up.").inc()
+        server = await serve(registry, "127.0.0.1", 0); port = server.sockets[0].getsockname()[1]
+        async def fetch(path: str) -> bytes:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: x\r\n\r\n".encode()); await writer.drain()
+            data = await reader.read(); writer.close(); return data
+        ok = await fetch("/metrics?x=1"); missing = await fetch("/")
+        server.close(); await server.wait_closed()
+        assert ok.startswith(b"HTTP/1.1 200 OK") and b"up_total 1" in ok and missing.startswith(b"HTTP/1.1 404")
+    asyncio.run(run())
+
+def test_bench_cli():
+    done = subprocess.run([sys.executable, "metrics.py", "--bench", "2000"], capture_output=True, text=True, cwd=ROOT)
+    assert done.returncode == 0 and "observe" in done.stdout
+    assert subprocess.run([sys.executable, "metrics.py"], capture_output=True, cwd=ROOT).returncode == 2 # Usage, not a benchmark
@@ -0,0 +1,66 @@
+# tests/test_shards.py
+# ShardCache: one load per key, get() during an unload, failed unloads, idle eviction and discard.
+
+import asyncio
+
+from shards import ShardCache
+
+class Store:
+    """Fake load/unload: shards are dicts, unload persists a copy, and an optional event blocks unload mid-way."""
+    def __init__(self):
+        self.persisted: dict[int, dict] = {}; self.loads = 0; self.unloads = 0; self.unload_gate: asyncio.Event | None = None; self.fail_unload = False
+        self.unload_started = asyncio.Event()
+    async def load(self, key: int) -> dict:
+        self.loads += 1; await asyncio.sleep(0); return dict(self.persisted.get(key, {"coins": 0}))
+    async def unload(self, key: int, shard: dict):
+        self.unload_started.set()
+        if self.unload_gate: await self.unload_gate.wait()
+        if self.fail_unload: raise OSError("disk full")
+        self.unloads += 1; self.persisted[key] = dict(shard)
+
+def test_concurrent_gets_load_once():
+    async def run():
+        store = Store(); cache = ShardCache(store.load, store.unload, 60)
+        shards = await asyncio.gather(*(cache.get(1) for _ in range(10)))
+        assert store.loads == 1 and all(s is shards[0] for s in shards) and cache.stats["loads"] == 1
+    asyncio.run(run())
+
+def test_get_during_unload_waits_and_reloads_persisted_state():
+    async def run():
+        store = Store(); store.unload_gate = asyncio.Event(); cache = ShardCache(store.load, store.unload, 60)
+        shard = await cache.get(1); shard["coins"] = 42
+        evicting = asyncio.create_task(cache.evict(1)); await store.unload_started.wait()
+        assert 1 not in cache # Leaves the map before its unload runs
+        getting = asyncio.create_task(cache.get(1)); await asyncio.sleep(0); await asyncio.sleep(0)
+        assert not getting.done() # Waits for the unload instead of loading stale state
+        store.unload_gate.set(); assert await evicting
+        reloaded = await getting
+        assert reloaded is not shard and reloaded["coins"] == 42 and store.loads == 2 and store.unloads == 1
+    asyncio.run(run())
+
+def test_failed_unload_keeps_shard():
+    async def run():
+        store = Store(); store.fail_unload = True; cache = ShardCache(store.load, store.unload, 60)
+        shard = await cache.get(1)
+        assert not await cache.evict(1)
+        assert cache.loaded(1) is shard and cache.stats["failed_unloads"] == 1
+        assert await cache.get(1) is shard and store.loads == 1
+    asyncio.run(run())
+
+def test_evict_idle_uses_clock_and_predicate():
+    async def run():
+        now = [0.0]; store = Store(); cache = ShardCache(store.load, store.unload, 60, clock=lambda: now[0])
+        await cache.get(1); await cache.get(2); now[0] = 30; await cache.get(2)
+        now[0] = 61; assert await cache.evict_idle() == 1 and cache.keys() == [2]
+        now[0] = 200; assert await cache.evict_idle(can_evict=lambda shard: False) == 0 and 2 in cache
+        cache.values() # Iterating doesn't count as use
+        assert await cache.evict_idle() == 1 and len(cache) == 0
+    asyncio.run(run())
+
+def test_discard_skips_unload():
+    async def run():
+        store = Store(); cache = ShardCache(store.load, store.unload, 60)
+        shard = await cache.get(7); shard["coins"] = 5
+        assert cache.discard(7) is shard and 7 not in cache and store.unloads == 0
+        assert (await cache.get(7))["coins"] == 0 # Nothing was persisted
+    asyncio.run(run())
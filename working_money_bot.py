@@ -11,24 +11,42 @@ import random
 import asyncio
 import time as time_module # Alias to avoid conflict with datetime.time
 import logging
+import heapq
+import collections
 from dotenv import load_dotenv
 from datetime import time, timedelta, timezone
 import uuid # For generating shop item IDs
+from concurrent.futures import ThreadPoolExecutor
+from ledger_store import LedgerStore, WriteBehindBuffer, atomic_write_json
+from journal import Journal, journal_op
+from money import MILLI, Milli, to_milli, to_coins, fmt_coins
+from shards import ShardCache, shard_dir, has_legacy_data, adopt_legacy_data
+from cluster import ClusterState, LeaseHeld, LEADER_LEASE, guild_lease, make_owner_id
+from metrics import Registry, Timer, timed, serve as serve_metrics
+from log_pipeline import setup_logging, bind as bind_log_fields
+import games
+from games import SLOT_EMOJIS, spin_slots, dice_win, dice_payout, redblack_win, redblack_payout, redblack_is_red
+from economy import MoneySupply, LotteryTickets, BalanceOps, InsufficientFunds, RankIndex, OrderBook, OrderStateError, ORDER_OPEN_STATUSES, MessageRewards, UserRecord
 
-# --- Logging Setup (Revised - Final Fix) ---
-log_formatter = logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s')
+# --- Logging Setup ---
+load_dotenv() # Before logging: the LOG_* settings come from .env too
 log_level = logging.INFO
-logging.basicConfig(level=log_level, format='%(asctime)s:%(levelname)s:%(name)s: %(message)s', handlers=[logging.StreamHandler()])
-disnake_logger = logging.getLogger('disnake')
-disnake_logger.setLevel(log_level)
-log_file_handler = logging.FileHandler(filename='discord_bot.log', encoding='utf-8', mode='w')
-log_file_handler.setFormatter(log_formatter)
-disnake_logger.addHandler(log_file_handler)
-disnake_logger.propagate = False
+_first_shard = os.getenv("SHARD_IDS", "").split(",")[0].strip()
+LOG_FILE = os.getenv("LOG_FILE") or (f"discord_bot.shard{_first_shard}.log" if _first_shard else "discord_bot.log") # JSON lines; one file per shard process
+try: LOG_MAX_MB = max(0.0, float(os.getenv("LOG_MAX_MB", 20.0))) # Also rotate when the file reaches this size (0 = by time only)
+except ValueError: LOG_MAX_MB = 20.0
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN", "midnight") # TimedRotatingFileHandler `when`: midnight, H, D, W0-W6 (UTC)
+try: LOG_BACKUPS = max(1, int(os.getenv("LOG_BACKUPS", 14))) # Rotated files kept
+except ValueError: LOG_BACKUPS = 14
+try: LOG_SAMPLE_EVERY = max(1, int(os.getenv("LOG_SAMPLE_EVERY", 100))) # Keep 1 in N high-volume records (per-message events); warnings always kept
+except ValueError: LOG_SAMPLE_EVERY = 100
+try: log_pipeline = setup_logging(log_level, LOG_FILE, int(LOG_MAX_MB * 1024 * 1024), LOG_ROTATE_WHEN, LOG_BACKUPS, LOG_SAMPLE_EVERY)
+except ValueError: log_pipeline = setup_logging(log_level, LOG_FILE, int(LOG_MAX_MB * 1024 * 1024), "midnight", LOG_BACKUPS, LOG_SAMPLE_EVERY); LOG_ROTATE_WHEN = "midnight (invalid LOG_ROTATE_WHEN)"
+logging.getLogger('disnake').setLevel(log_level)
 logger = logging.getLogger(__name__)
+logger.info(f"Logging to {LOG_FILE} (JSON lines; rotated {LOG_ROTATE_WHEN} and at {LOG_MAX_MB:g} MB, {LOG_BACKUPS} kept; per-message records sampled 1 in {LOG_SAMPLE_EVERY}).")
 
 # --- Configuration ---
-load_dotenv()
 DISCORD_BOT_TOKEN = os.getenv("DISCORD_BOT_TOKEN")
 PLACEHOLDER_IDS_PRESENT = False
 _SHOPKEEPER_ROLE_ID_STR = os.getenv("SHOPKEEPER_ROLE_ID", "1368456384886079519")
@@ -36,11 +54,18 @@ _ADMIN_CHANNEL_ID_STR = os.getenv("ADMIN_CHANNEL_ID", "1368455333751816213")
 SUPPORTER_ROLE_ID = 1368689142363590726
 VIP_ROLE_ID = 1368689440045797436
 _LOTTERY_ANNOUNCE_CHANNEL_ID_STR = os.getenv("LOTTERY_ANNOUNCE_CHANNEL_ID", _ADMIN_CHANNEL_ID_STR)
+_LEGACY_GUILD_ID_STR = os.getenv("LEGACY_GUILD_ID", "") # Guild that inherits the pre-shard data/economy.db (default: the only guild, if the bot is in one)
+_SHARD_COUNT_STR = os.getenv("SHARD_COUNT", ""); _SHARD_IDS_STR = os.getenv("SHARD_IDS", "") # Gateway sharding; unset = one process, one shard
 
 try:
     SHOPKEEPER_ROLE_ID = int(_SHOPKEEPER_ROLE_ID_STR)
     ADMIN_CHANNEL_ID = int(_ADMIN_CHANNEL_ID_STR)
     LOTTERY_ANNOUNCE_CHANNEL_ID = int(_LOTTERY_ANNOUNCE_CHANNEL_ID_STR)
+    LEGACY_GUILD_ID = int(_LEGACY_GUILD_ID_STR) if _LEGACY_GUILD_ID_STR else None
+    SHARD_COUNT = int(_SHARD_COUNT_STR) if _SHARD_COUNT_STR else None
+    SHARD_IDS = [int(x) for x in _SHARD_IDS_STR.split(",") if x.strip()] or None # This process's shards (default: all of SHARD_COUNT)
+    if SHARD_IDS and not SHARD_COUNT: raise ValueError("SHARD_IDS needs SHARD_COUNT.")
+    if SHARD_COUNT and any(not 0 <= i < SHARD_COUNT for i in SHARD_IDS or ()): raise ValueError(f"SHARD_IDS must be in 0..{SHARD_COUNT - 1}.")
     if not isinstance(SUPPORTER_ROLE_ID, int) or SUPPORTER_ROLE_ID <= 0: raise ValueError("Hardcoded SUPPORTER_ROLE_ID invalid.")
     if not isinstance(VIP_ROLE_ID, int) or VIP_ROLE_ID <= 0: raise ValueError("Hardcoded VIP_ROLE_ID invalid.")
 except ValueError as e:
@@ -53,11 +78,13 @@ for name, placeholder_id in original_placeholders.items():
          logger.warning(f"Config Warning: {name} still placeholder ({placeholder_id})."); PLACEHOLDER_IDS_PRESENT = True
 
 # Economy Settings
-INITIAL_STARTING_BALANCE = int(os.getenv("INITIAL_STARTING_BALANCE", 1000)) # Default 1k starting
-ECONOMY_RESET_THRESHOLD = float(os.getenv("ECONOMY_RESET_THRESHOLD", 1.0e15)) # Default: 1 Quadrillion
+# Configured in coins; every amount in memory, the ledger and the journal is integer milli-coins (money.py)
+# Each guild has its own economy; the reset threshold and lottery interval below are defaults a guild's admins can change
+INITIAL_STARTING_BALANCE = to_milli(int(os.getenv("INITIAL_STARTING_BALANCE", 1000))) # Default 1k starting
+ECONOMY_RESET_THRESHOLD = to_milli(float(os.getenv("ECONOMY_RESET_THRESHOLD", 1.0e15))) # Default: 1 Quadrillion
 
-try: LOTTERY_TICKET_PRICE = int(os.getenv("LOTTERY_TICKET_PRICE", 10))
-except ValueError: LOTTERY_TICKET_PRICE = 10
+try: LOTTERY_TICKET_PRICE = to_milli(int(os.getenv("LOTTERY_TICKET_PRICE", 10)))
+except ValueError: LOTTERY_TICKET_PRICE = to_milli(10)
 try: LOTTERY_INTERVAL_HOURS = float(os.getenv("LOTTERY_INTERVAL_HOURS", 2.0))
 except ValueError: LOTTERY_INTERVAL_HOURS = 2.0
 SHOP_TIMEZONE_STR = os.getenv("SHOP_TIMEZONE", 'America/Chicago')
@@ -66,127 +93,453 @@ except pytz.UnknownTimeZoneError: SHOP_TIMEZONE = pytz.utc
 SHOP_OPEN_HOUR = int(os.getenv("SHOP_OPEN_HOUR", 10)); SHOP_OPEN_MINUTE = int(os.getenv("SHOP_OPEN_MINUTE", 0))
 SHOP_CLOSE_HOUR = int(os.getenv("SHOP_CLOSE_HOUR", 21)); SHOP_CLOSE_MINUTE = int(os.getenv("SHOP_CLOSE_MINUTE", 0))
 SHOP_OPEN_TIME = time(SHOP_OPEN_HOUR, SHOP_OPEN_MINUTE); SHOP_CLOSE_TIME = time(SHOP_CLOSE_HOUR, SHOP_CLOSE_MINUTE)
-SLOT_EMOJIS = ["🍎", "🍊", "🍋", "🍉", "🍇", "🍓", "🍒", "⭐", "💎"]; SLOT_JACKPOT_EMOJI = "💎"
 DEFAULT_SLOT_JACKPOT_CONTRIBUTION = 0.10
 DEFAULT_SLOT_JACKPOT_OVERRIDE_CHANCE = 0.0
-DICE_WIN_MULTIPLIER = 5; REDBLACK_WIN_MULTIPLIER = 1.9; REDBLACK_COOLDOWN_SECONDS = 5
-BIG_WIN_THRESHOLD = 100000
+MAX_GAMBLE_ROUNDS = 1000 # /gamble ... rounds: resolved in one pass, one save, one summary embed
+REDBLACK_COOLDOWN_SECONDS = 5 # Slot/dice/red-black payout rules live in games.py
+SIMULATE_MAX_ROUNDS = 10_000_000 if games.np is not None else 1_000_000 # /admincoins simulate (pure-Python fallback is ~50x slower)
+BIG_WIN_THRESHOLD = to_milli(100000)
+LEADERBOARD_SIZE = 10; LEADERBOARD_CACHE_SECONDS = 10 # Rendered boards are shared by everyone for this long
 SCAN_MESSAGE_LIMIT_PER_CHANNEL = int(os.getenv("SCAN_MESSAGE_LIMIT", 10000))
-DATA_DIR = "data"; USER_DATA_FILE = os.path.join(DATA_DIR, "user_balances.json")
-SHOP_ITEMS_FILE = os.path.join(DATA_DIR, "shop_items.json"); BOT_DATA_FILE = os.path.join(DATA_DIR, "bot_data.json")
+try: SCAN_CONCURRENCY = max(1, int(os.getenv("SCAN_CONCURRENCY", 4)))
+except ValueError: SCAN_CONCURRENCY = 4
+try: SCAN_MAX_PAGES_PER_SECOND = float(os.getenv("SCAN_MAX_PAGES_PER_SECOND", 4.0)) # 1 page = 100 messages; 0 = unpaced
+except ValueError: SCAN_MAX_PAGES_PER_SECOND = 4.0
+SCAN_PROGRESS_LOG_SECONDS = 30; SCAN_MAX_RESTARTS = 3
+SHOP_FILE_WATCH_SECONDS = 30 # How often shop_items.json is stat'ed for external edits
+try: SHOPKEEPER_DM_CONCURRENCY = max(1, int(os.getenv("SHOPKEEPER_DM_CONCURRENCY", 3))) # Parallel purchase DMs (each DM channel is its own rate-limit bucket)
+except ValueError: SHOPKEEPER_DM_CONCURRENCY = 3
+try: ORDER_DM_BUDGET_PER_MINUTE = max(1, int(os.getenv("ORDER_DM_BUDGET_PER_MINUTE", 30))) # Instant order DMs per minute; beyond this orders go into the digest
+except ValueError: ORDER_DM_BUDGET_PER_MINUTE = 30
+SLOTS_TURBO_DEFAULT = os.getenv("SLOTS_TURBO", "0").lower() in ("1", "true", "yes") # Final frame only, for everyone
+try: ANIMATION_EDITS_PER_SECOND = max(1.0, float(os.getenv("ANIMATION_EDITS_PER_SECOND", 20.0))) # Shared by all animations; final frames always go out
+except ValueError: ANIMATION_EDITS_PER_SECOND = 20.0
+ANIMATION_ROUTE_BURST = 3; ANIMATION_ROUTE_EDITS_PER_SECOND = 1.5; ANIMATION_SLOW_EDIT_SECONDS = 1.5 # Per-interaction webhook bucket
+ORDER_DIGEST_SECONDS = 60; ORDER_DIGEST_MAX_ORDERS = 25 # One button per order, 25 buttons per message
+try: MESSAGE_REWARD_WINDOW_SECONDS = float(os.getenv("MESSAGE_REWARD_WINDOW_SECONDS", 60.0)) # Per-user anti-spam window
+except ValueError: MESSAGE_REWARD_WINDOW_SECONDS = 60.0
+try: MESSAGE_REWARD_FULL_RATE = max(1, int(os.getenv("MESSAGE_REWARD_FULL_RATE", 5))) # Messages per window paying the full coin
+except ValueError: MESSAGE_REWARD_FULL_RATE = 5
+try: MESSAGE_REWARD_DECAY = min(1.0, max(0.0, float(os.getenv("MESSAGE_REWARD_DECAY", 0.5)))) # Each extra message earns this x the last; 0 = hard cap
+except ValueError: MESSAGE_REWARD_DECAY = 0.5
+MESSAGE_REWARD_BATCH_SECONDS = 5 # Accumulated chat rewards are credited this often (one balance update per user)
+try: MONEY_SUPPLY_RECONCILE_MINUTES = float(os.getenv("MONEY_SUPPLY_RECONCILE_MINUTES", 60.0))
+except ValueError: MONEY_SUPPLY_RECONCILE_MINUTES = 60.0
+try: PERSIST_FLUSH_INTERVAL_SECONDS = float(os.getenv("PERSIST_FLUSH_INTERVAL_SECONDS", 5.0))
+except ValueError: PERSIST_FLUSH_INTERVAL_SECONDS = 5.0
+try: PERSIST_FLUSH_MAX_DIRTY = int(os.getenv("PERSIST_FLUSH_MAX_DIRTY", 500))
+except ValueError: PERSIST_FLUSH_MAX_DIRTY = 500
+DATA_DIR = "data"; GUILDS_DIR = os.path.join(DATA_DIR, "guilds") # One shard directory per guild: data/guilds/<guild_id>/
+LEDGER_FILE_NAME = "economy.db" # SQLite (WAL) store for the guild's balances, bot state and orders
+JOURNAL_DIR_NAME = "journal" # Append-only money journal + snapshots (python journal.py --guild <id> --help)
+SHOP_FILE_NAME = "shop_items.json"; LEGACY_USER_FILE_NAME = "user_balances.json"; LEGACY_BOT_FILE_NAME = "bot_data.json" # JSON files are imported once if present
+LOTTERY_SCHEDULE_FILE = os.path.join(GUILDS_DIR, "lottery_schedule.json") # Pre-cluster schedule file, imported into the cluster store once
+CLUSTER_DB_FILE = os.path.join(DATA_DIR, "cluster.db") # Shared by every shard process: guild/leader leases and the lottery schedule (cluster.py)
+try: CLUSTER_LEASE_SECONDS = max(5.0, float(os.getenv("CLUSTER_LEASE_SECONDS", 30.0))) # A crashed process's guilds and leadership free up after this
+except ValueError: CLUSTER_LEASE_SECONDS = 30.0
+LOTTERY_ORPHAN_GRACE_SECONDS = CLUSTER_LEASE_SECONDS * 3 + 60 # The leader draws an overdue lottery itself only once its owner has clearly been gone this long
+try: SHARD_IDLE_MINUTES = max(1.0, float(os.getenv("SHARD_IDLE_MINUTES", 30.0))) # An unused guild economy is flushed and dropped from memory after this
+except ValueError: SHARD_IDLE_MINUTES = 30.0
+try: JOURNAL_FSYNC_SECONDS = float(os.getenv("JOURNAL_FSYNC_SECONDS", 1.0))
+except ValueError: JOURNAL_FSYNC_SECONDS = 1.0
+try: JOURNAL_SNAPSHOT_MINUTES = float(os.getenv("JOURNAL_SNAPSHOT_MINUTES", 30.0)) # Bounds replay work on recovery
+except ValueError: JOURNAL_SNAPSHOT_MINUTES = 30.0
+JOURNAL_KEEP_SNAPSHOTS = 48 # Older snapshots are deleted (journal segments are kept as the audit trail)
+try: METRICS_PORT = int(os.getenv("METRICS_PORT", 0)) # Prometheus endpoint (GET /metrics); 0 = off. Shard processes add their first shard ID
+except ValueError: METRICS_PORT = 0
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1") # Local only by default
+try: METRICS_WINDOW_MINUTES = max(1.0, float(os.getenv("METRICS_WINDOW_MINUTES", 15.0))) # Sliding window for /admincoins perf percentiles
+except ValueError: METRICS_WINDOW_MINUTES = 15.0
 if not DISCORD_BOT_TOKEN: logger.critical("FATAL: Token missing."); exit(1)
-os.makedirs(DATA_DIR, exist_ok=True)
+os.makedirs(GUILDS_DIR, exist_ok=True)
+
+# --- Metrics ---
+PROCESS_STARTED = time_module.monotonic()
+metrics_registry = Registry(); _window = {"window_seconds": METRICS_WINDOW_MINUTES * 60}
+COMMAND_SECONDS = metrics_registry.histogram("bot_command_seconds", "Slash command handler duration.", ("command",), **_window)
+COMMANDS_IN_FLIGHT = metrics_registry.gauge("bot_commands_in_flight", "Slash commands currently running.", ("command",))
+COMMAND_ERRORS = metrics_registry.counter("bot_command_errors_total", "Slash commands that raised.", ("command", "error"))
+IO_SECONDS = metrics_registry.histogram("bot_io_seconds", "Persistence executor calls (queue wait + run), e.g. ledger writes, journal fsyncs, shard loads.", ("op",), **_window)
+IO_IN_FLIGHT = metrics_registry.gauge("bot_io_in_flight", "Persistence executor calls queued or running.", ("op",))
+TASK_SECONDS = metrics_registry.histogram("bot_task_seconds", "Background loop iterations and one-off jobs (on_ready, retro scan).", ("task",), **_window)
+GUILD_ECONOMY_SECONDS = metrics_registry.histogram("bot_guild_economy_seconds", "Guild economy shard load/unload duration.", ("op",), **_window)
+NOTIFY_SECONDS = metrics_registry.histogram("bot_shopkeeper_notify_seconds", "Shopkeeper order DM fan-out (immediate or digest).", ("path",), **_window)
+DMS_SENT = metrics_registry.counter("bot_dms_total", "Shopkeeper DMs by result (sent or the error type).", ("result",))
+metrics_registry.gauge("bot_log_records_dropped", "Log records shed because the log queue was full.").set_function(lambda: log_pipeline.handler.dropped)
+STARTUP_SECONDS = metrics_registry.gauge("bot_startup_seconds", "Process start to the end of the first on_ready.")
+command_timers: dict[int, Timer] = {} # Interaction ID -> running command timer
+
+def perf_table(histogram, limit: int) -> str:
+    """One `label  n  p50/p95/p99 ms` line per label set in the window, slowest p95 first, in a code block."""
+    rows = []
+    for labels in list(histogram.series):
+        count, (p50, p95, p99) = histogram.percentiles(*labels)
+        if count: rows.append((p95, f"{' '.join(map(str, labels))[:28]:<28} {count:>6} {p50 * 1000:>8.1f} {p95 * 1000:>8.1f} {p99 * 1000:>8.1f}"))
+    if not rows: return "No samples in the window."
+    rows.sort(key=lambda row: -row[0]); more = f"\n… {len(rows) - limit} more" if len(rows) > limit else ""
+    return "```\n" + f"{'':<28} {'n':>6} {'p50':>8} {'p95':>8} {'p99':>8}\n" + "\n".join(line for _, line in rows[:limit]) + more + "\n```"
 
 # --- Data Persistence ---
-user_data = {}; shop_items = {}; bot_data = {}
-def load_user_data():
-    global user_data
-    try:
-        with open(USER_DATA_FILE, 'r') as f: loaded_data = json.load(f)
-        migrated_data = {}; migration_needed = False
-        for user_id_str, data in loaded_data.items():
-            try:
-                user_id = int(user_id_str)
-                if isinstance(data, int): migrated_data[user_id] = {"balance": data, "savings": 0, "pin": None}; migration_needed = True
-                elif isinstance(data, dict):
-                    migrated_data[user_id] = {"balance": data.get("balance", 0), "savings": data.get("savings", 0), "pin": data.get("pin", None)}
-                    if migrated_data[user_id]["pin"] is not None and not isinstance(migrated_data[user_id]["pin"], str): migrated_data[user_id]["pin"] = None
-                else: logger.warning(f"Skipping invalid data for user {user_id_str}"); continue
-            except ValueError: logger.warning(f"Skipping invalid user ID key '{user_id_str}'"); continue
-        user_data = migrated_data
-        if migration_needed: logger.info(f"Migrated user data."); save_user_data()
-        elif USER_DATA_FILE and os.path.exists(USER_DATA_FILE): logger.info(f"Loaded user data.")
-    except FileNotFoundError: logger.warning(f"{USER_DATA_FILE} not found."); user_data = {}
-    except json.JSONDecodeError: logger.error(f"Error decoding {USER_DATA_FILE}."); user_data = {}
-    except Exception as e: logger.error(f"Error loading user data: {e}"); user_data = {}
-def save_user_data():
-    try:
-        data_to_save = {str(k): v for k, v in user_data.items()}
-        with open(USER_DATA_FILE, 'w') as f: json.dump(data_to_save, f, indent=4)
-    except Exception as e: logger.error(f"Error saving user data: {e}")
-def get_user_data(user_id: int) -> dict:
-    user_id = int(user_id)
-    if user_id not in user_data:
-        user_data[user_id] = {"balance": INITIAL_STARTING_BALANCE, "savings": 0, "pin": None}
-        logger.info(f"Initialized new user {user_id} with {INITIAL_STARTING_BALANCE} balance.")
-    ud = user_data[user_id]
-    if "balance" not in ud or not isinstance(ud["balance"], (int, float)): ud["balance"] = 0
-    if "savings" not in ud or not isinstance(ud["savings"], (int, float)): ud["savings"] = 0
-    if "pin" not in ud or (ud["pin"] is not None and not isinstance(ud["pin"], str)): ud["pin"] = None
-    return user_data[user_id]
-def load_shop_items():
-    global shop_items
-    try:
-        with open(SHOP_ITEMS_FILE, 'r') as f: shop_items = json.load(f)
-        logger.info(f"Loaded shop items.")
-    except FileNotFoundError: logger.warning(f"{SHOP_ITEMS_FILE} not found."); shop_items = {}
-    except json.JSONDecodeError: logger.error(f"Error decoding {SHOP_ITEMS_FILE}."); shop_items = {}
-    except Exception as e: logger.error(f"Error loading shop items: {e}"); shop_items = {}
-def save_shop_items():
-    try:
-        with open(SHOP_ITEMS_FILE, 'w') as f: json.dump(shop_items, f, indent=4)
-    except Exception as e: logger.error(f"Error saving shop items: {e}")
-def load_bot_data():
-    global bot_data
-    default_data = { "slot_jackpot_pool": 0.0, "lottery_pot": 0.0, "lottery_tickets": [], "slot_jackpot_contribution": DEFAULT_SLOT_JACKPOT_CONTRIBUTION, "slot_jackpot_override_chance": DEFAULT_SLOT_JACKPOT_OVERRIDE_CHANCE, "initial_balance_check_done": False }
-    try:
-        with open(BOT_DATA_FILE, 'r') as f: loaded_data = json.load(f)
-        bot_data["slot_jackpot_pool"] = float(loaded_data.get("slot_jackpot_pool", default_data["slot_jackpot_pool"]))
-        bot_data["lottery_pot"] = float(loaded_data.get("lottery_pot", default_data["lottery_pot"]))
-        bot_data["lottery_tickets"] = loaded_data.get("lottery_tickets", default_data["lottery_tickets"])
-        contrib = float(loaded_data.get("slot_jackpot_contribution", default_data["slot_jackpot_contribution"]))
-        override = float(loaded_data.get("slot_jackpot_override_chance", default_data["slot_jackpot_override_chance"]))
-        bot_data["slot_jackpot_contribution"] = max(0.0, min(1.0, contrib))
-        bot_data["slot_jackpot_override_chance"] = max(0.0, min(1.0, override))
-        bot_data["initial_balance_check_done"] = loaded_data.get("initial_balance_check_done", default_data["initial_balance_check_done"])
-        if not isinstance(bot_data["slot_jackpot_pool"], float): bot_data["slot_jackpot_pool"] = 0.0
-        if not isinstance(bot_data["lottery_pot"], float): bot_data["lottery_pot"] = 0.0
-        if not isinstance(bot_data["lottery_tickets"], list): bot_data["lottery_tickets"] = []
-        if not isinstance(bot_data["initial_balance_check_done"], bool): bot_data["initial_balance_check_done"] = False
-        logger.info(f"Loaded bot data (JP Contrib: {bot_data['slot_jackpot_contribution']:.1%}, JP Override: {bot_data['slot_jackpot_override_chance']:.1%}).")
-    except FileNotFoundError: logger.warning(f"{BOT_DATA_FILE} not found."); bot_data = default_data.copy()
-    except json.JSONDecodeError: logger.error(f"Error decoding {BOT_DATA_FILE}."); bot_data = default_data.copy()
-    except Exception as e: logger.error(f"Error loading bot data: {e}"); bot_data = default_data.copy()
-def save_bot_data():
+persist_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persist") # Single worker: ledger + file I/O stay ordered, across all shards
+async def run_io(func, *args):
+    """Runs blocking persistence work (SQLite, JSON files) on the dedicated executor instead of the event loop."""
+    with IO_SECONDS.time(getattr(func, "__qualname__", "other"), in_flight=IO_IN_FLIGHT): # Includes time queued behind other work
+        return await asyncio.get_running_loop().run_in_executor(persist_executor, func, *args)
+LEADERBOARDS = {"balance": "💰 Balance", "savings": "🏦 Savings", "networth": "💎 Net Worth", "biggest_win": "🎰 Biggest Win"}
+
+# --- Guild Economies (shards) ---
+class GuildEconomy:
+    """One guild's economy: balances, pools, settings, shop catalog, orders, lottery, chat rewards and leaderboards, persisted
+    in its own ledger and journal under data/guilds/<guild_id>/. Built by load_guild_economy() on first use and flushed and
+    dropped by unload_guild_economy() once idle; every save, scan and reset here costs O(this guild)."""
+    def __init__(self, guild_id: int):
+        self.guild_id = guild_id; self.dir = shard_dir(GUILDS_DIR, guild_id)
+        self.ledger_file = os.path.join(self.dir, LEDGER_FILE_NAME); self.shop_items_file = os.path.join(self.dir, SHOP_FILE_NAME)
+        self.ledger: LedgerStore | None = None; self.write_buffer: WriteBehindBuffer | None = None; self.journal: Journal | None = None # Opened by open()
+        self.user_data: dict[int, UserRecord] = {}; self.bot_data: dict = {}; self.shop_items: dict = {}
+        self.shop_catalog = ShopCatalog(self)
+        self.order_book = OrderBook() # Purchase orders; open ones hold the buyer's credits in escrow
+        self.order_digest_queue: list[str] = [] # Pending order IDs whose shopkeeper DM was deferred to the digest
+        self.lottery_tickets = LotteryTickets()
+        self.message_rewards = MessageRewards(MESSAGE_REWARD_WINDOW_SECONDS, MESSAGE_REWARD_FULL_RATE, MESSAGE_REWARD_DECAY)
+        self.rank_indexes = {board: RankIndex() for board in LEADERBOARDS}; self.leaderboard_cache: dict[str, tuple[float, disnake.Embed]] = {}
+        self.money_supply = MoneySupply(ECONOMY_RESET_THRESHOLD, on_threshold=self._on_money_supply_threshold)
+        self.balance_ops = BalanceOps(self.get_user_data, self.money_supply, on_change=self.mark_dirty, # Check-and-mutate API, per-user lock striping
+                                      on_entry=lambda user_id, field, delta: self.journal.record(int(user_id), field, delta))
+        self._flush_task: asyncio.Task | None = None; self._reset_task: asyncio.Task | None = None
+
+    # --- Loading (persistence executor) ---
+    def open(self):
+        """Blocking: opens the shard's ledger and journal and reads its users, bot state, open orders and shop catalog."""
+        self.ledger = LedgerStore(self.ledger_file); self.write_buffer = WriteBehindBuffer(self.ledger, max_dirty=PERSIST_FLUSH_MAX_DIRTY)
+        self.journal = Journal(os.path.join(self.dir, JOURNAL_DIR_NAME), keep_snapshots=JOURNAL_KEEP_SNAPSHOTS)
+        self.import_legacy_json_once()
+        self.user_data = self.read_user_data(); self.bot_data = self.read_bot_data(); self.shop_items = self.read_shop_items()
+        self.order_book.load(self.ledger.load_orders(ORDER_OPEN_STATUSES))
+    def import_legacy_json_once(self):
+        """One-shot import of the old JSON files into the ledger (only when the ledger has never been populated)."""
+        user_file = os.path.join(self.dir, LEGACY_USER_FILE_NAME); bot_file = os.path.join(self.dir, LEGACY_BOT_FILE_NAME)
+        if self.ledger.get_meta("json_imported_from") is not None or self.ledger.user_count() > 0: return
+        if not (os.path.exists(user_file) or os.path.exists(bot_file)): self.ledger.set_meta("json_imported_from", "null"); return
+        try: logger.info(f"Importing legacy JSON data into {self.ledger_file}..."); self.ledger.import_json(user_file, bot_file)
+        except Exception as e: logger.error(f"Legacy JSON import failed: {e}", exc_info=True)
+    def read_user_data(self) -> dict[int, UserRecord]:
+        try:
+            users = {user_id: UserRecord.from_row(data) for user_id, data in self.ledger.load_users().items()} # Types checked once, here
+            logger.info(f"Loaded user data for guild {self.guild_id} ({len(users)} users).")
+            return users
+        except Exception as e: logger.error(f"Error loading user data for guild {self.guild_id}: {e}"); return {}
+    def read_bot_data(self) -> dict:
+        default_data = { "slot_jackpot_pool": 0, "lottery_pot": 0, "lottery_tickets": {}, "slot_jackpot_contribution": DEFAULT_SLOT_JACKPOT_CONTRIBUTION, "slot_jackpot_override_chance": DEFAULT_SLOT_JACKPOT_OVERRIDE_CHANCE, "initial_balance_check_done": False, "scan_checkpoints": {}, "slots_turbo_users": {},
+                         "economy_reset_threshold": ECONOMY_RESET_THRESHOLD, "lottery_interval_hours": LOTTERY_INTERVAL_HOURS, "lottery_next_draw": None }
+        loaded_bot_data = {}
+        try:
+            loaded_data = self.ledger.load_state()
+            if not loaded_data: raise FileNotFoundError
+            loaded_bot_data["slot_jackpot_pool"] = int(loaded_data.get("slot_jackpot_pool", default_data["slot_jackpot_pool"])) # Milli-coins
+            loaded_bot_data["lottery_pot"] = int(loaded_data.get("lottery_pot", default_data["lottery_pot"]))
+            loaded_bot_data["lottery_tickets"] = loaded_data.get("lottery_tickets", default_data["lottery_tickets"])
+            contrib = float(loaded_data.get("slot_jackpot_contribution", default_data["slot_jackpot_contribution"]))
+            override = float(loaded_data.get("slot_jackpot_override_chance", default_data["slot_jackpot_override_chance"]))
+            loaded_bot_data["slot_jackpot_contribution"] = max(0.0, min(1.0, contrib))
+            loaded_bot_data["slot_jackpot_override_chance"] = max(0.0, min(1.0, override))
+            loaded_bot_data["initial_balance_check_done"] = loaded_data.get("initial_balance_check_done", default_data["initial_balance_check_done"])
+            if not isinstance(loaded_bot_data["lottery_tickets"], (dict, list)): loaded_bot_data["lottery_tickets"] = {} # list = legacy format, migrated on attach
+            if not isinstance(loaded_bot_data["initial_balance_check_done"], bool): loaded_bot_data["initial_balance_check_done"] = False
+            loaded_bot_data["scan_checkpoints"] = loaded_data.get("scan_checkpoints", {}) # {channel_id: high-water-mark message ID}
+            if not isinstance(loaded_bot_data["scan_checkpoints"], dict): loaded_bot_data["scan_checkpoints"] = {}
+            loaded_bot_data["slots_turbo_users"] = loaded_data.get("slots_turbo_users", {}) # {user_id: True/False}, overrides SLOTS_TURBO
+            if not isinstance(loaded_bot_data["slots_turbo_users"], dict): loaded_bot_data["slots_turbo_users"] = {}
+            threshold = loaded_data.get("economy_reset_threshold", ECONOMY_RESET_THRESHOLD) # Per-guild settings; missing = the configured defaults
+            loaded_bot_data["economy_reset_threshold"] = threshold if isinstance(threshold, int) and threshold > 0 else ECONOMY_RESET_THRESHOLD
+            interval = loaded_data.get("lottery_interval_hours", LOTTERY_INTERVAL_HOURS)
+            loaded_bot_data["lottery_interval_hours"] = float(interval) if isinstance(interval, (int, float)) and interval > 0 else LOTTERY_INTERVAL_HOURS
+            next_draw = loaded_data.get("lottery_next_draw") # Epoch seconds, set by the round's first ticket
+            loaded_bot_data["lottery_next_draw"] = float(next_draw) if isinstance(next_draw, (int, float)) else None
+            logger.info(f"Loaded bot data for guild {self.guild_id} (JP Contrib: {loaded_bot_data['slot_jackpot_contribution']:.1%}, JP Override: {loaded_bot_data['slot_jackpot_override_chance']:.1%}).")
+            return loaded_bot_data
+        except FileNotFoundError: logger.info(f"No bot data in {self.ledger_file}, using defaults."); return default_data.copy()
+        except Exception as e: logger.error(f"Error loading bot data for guild {self.guild_id}: {e}"); return default_data.copy()
+    def shop_file_mtime(self) -> int | None:
+        try: return os.stat(self.shop_items_file).st_mtime_ns
+        except OSError: return None
+    def read_shop_items(self) -> dict:
+        try:
+            self.shop_catalog.file_mtime = self.shop_file_mtime()
+            with open(self.shop_items_file, 'r') as f: loaded = json.load(f)
+            logger.info(f"Loaded shop items for guild {self.guild_id}."); return loaded
+        except FileNotFoundError: return {} # A guild starts with an empty shop
+        except json.JSONDecodeError: logger.error(f"Error decoding {self.shop_items_file}."); return {}
+        except Exception as e: logger.error(f"Error loading shop items: {e}"); return {}
+    async def load_shop_items_async(self):
+        self.shop_items = await run_io(self.read_shop_items); self.shop_catalog.invalidate()
+    def write_shop_items(self, snapshot: dict):
+        try: atomic_write_json(self.shop_items_file, snapshot); self.shop_catalog.file_mtime = self.shop_file_mtime() # Our own write is not an external change
+        except Exception as e: logger.error(f"Error saving shop items: {e}")
+    async def save_shop_items_async(self):
+        snapshot = {item_id: dict(item) if isinstance(item, dict) else item for item_id, item in self.shop_items.items()} # Consistent copy for the worker
+        await run_io(self.write_shop_items, snapshot)
+
+    # --- Write-behind persistence ---
+    def mark_dirty(self, *user_ids: int, state: bool = False, orders: tuple[str, ...] = ()):
+        for uid in user_ids: self.update_ranks(uid) # Every user mutation is marked dirty, so this keeps the leaderboards current
+        if self.write_buffer.mark(*user_ids, state=state, orders=orders): self.schedule_flush() # Size threshold reached, don't wait for the interval
+    def save_user_data(self, *user_ids: int):
+        """Marks the given users (all of this guild's users if none given) dirty; the write-behind flusher persists them."""
+        self.mark_dirty(*(user_ids or self.user_data.keys()))
+    def save_economy(self, *user_ids: int):
+        """Marks the given users (all if none given) and bot_data dirty; they are flushed together in one transaction."""
+        self.mark_dirty(*(user_ids or self.user_data.keys()), state=True)
+    def save_bot_data(self): self.mark_dirty(state=True)
+    def schedule_flush(self):
+        if self._flush_task and not self._flush_task.done(): return
+        try: self._flush_task = asyncio.get_running_loop().create_task(self.flush_dirty_data_async())
+        except RuntimeError: self.flush_dirty_data() # No running loop (startup), flush inline
+    def flush_dirty_data(self) -> int:
+        """Blocking flush of the dirty rows; only for use outside the event loop."""
+        try: return self.write_buffer.flush(self.user_data, self.bot_data, self.order_book.orders)
+        except Exception as e: logger.error(f"Error flushing dirty data for guild {self.guild_id}: {e}"); return 0
+    async def flush_dirty_data_async(self) -> int:
+        """Snapshots dirty rows on the loop thread, then commits them on the persistence executor. Returns rows written."""
+        batch = self.write_buffer.take_batch(self.user_data, self.bot_data, self.order_book.orders)
+        try: return await run_io(self.write_buffer.write_batch, *batch)
+        except Exception as e: self.write_buffer.requeue(*batch); logger.error(f"Error flushing dirty data for guild {self.guild_id}: {e}"); return 0
+    async def journal_snapshot(self):
+        """Captures balances + pools and the journal position together on the loop thread, then writes both in one executor job."""
+        seq = self.journal.seq; lines = self.journal.take_pending()
+        users = {uid: {"balance": d.balance, "savings": d.savings} for uid, d in self.user_data.items()}
+        pools = {key: self.bot_data.get(key, 0) for key in ("slot_jackpot_pool", "lottery_pot")}
+        await run_io(self.journal.checkpoint, lines, seq, users, pools) # One job: a flush can't slip between the write and the segment switch
+        logger.info(f"Journal snapshot for guild {self.guild_id} at seq {seq} ({len(users):,} users, {self.journal.stats['last_snapshot_ms']:.1f} ms).")
+    def busy(self) -> bool:
+        """True while an unload would interrupt something: a held balance lock, a flush or reset in flight, orders awaiting the digest."""
+        return (self.balance_ops.held() or bool(self.order_digest_queue) or (self._flush_task is not None and not self._flush_task.done())
+                or (self._reset_task is not None and not self._reset_task.done()))
+
+    # --- Users & money ---
+    def get_user_data(self, user_id: int) -> UserRecord:
+        user_id = int(user_id); udata = self.user_data.get(user_id)
+        if udata is None:
+            udata = self.user_data[user_id] = UserRecord(INITIAL_STARTING_BALANCE); self.money_supply.add("balance", INITIAL_STARTING_BALANCE)
+            self.journal.record(user_id, "balance", value=INITIAL_STARTING_BALANCE, op="open")
+            logger.info(f"Initialized new user {user_id} in guild {self.guild_id} with {fmt_coins(INITIAL_STARTING_BALANCE)} balance.")
+        return udata
+    def adjust_balance(self, user_id: int, delta: Milli) -> UserRecord:
+        udata = self.get_user_data(user_id); udata.balance += delta; self.money_supply.add("balance", delta); self.journal.record(int(user_id), "balance", delta)
+        return udata
+    def set_balance(self, user_id: int, value: Milli) -> UserRecord:
+        udata = self.get_user_data(user_id); old = udata.balance
+        udata.balance = value; self.money_supply.add("balance", value - old); self.journal.record(int(user_id), "balance", value=value)
+        return udata
+    def adjust_pool(self, key: str, delta: Milli): self.bot_data[key] += delta; self.money_supply.add(key, delta); self.journal.record(None, key, delta)
+    def set_pool(self, key: str, value: Milli):
+        old = self.bot_data[key] if isinstance(self.bot_data.get(key), int) else 0
+        self.bot_data[key] = value; self.money_supply.add(key, value - old); self.journal.record(None, key, value=value)
+    def record_win(self, user_id: int, winnings: Milli):
+        """Tracks the user's biggest single win (for the leaderboard). Call after the winnings are credited."""
+        udata = self.get_user_data(user_id)
+        if winnings > udata.best_win: udata.best_win = winnings; self.mark_dirty(user_id)
+    def reset_threshold(self) -> Milli: return self.bot_data.get("economy_reset_threshold", ECONOMY_RESET_THRESHOLD)
+    def lottery_interval_hours(self) -> float: return self.bot_data.get("lottery_interval_hours", LOTTERY_INTERVAL_HOURS)
+    def reconcile_money_supply(self) -> Milli:
+        drift = self.money_supply.reconcile(self.user_data, self.bot_data, escrow=self.order_book.escrow)
+        if drift: logger.warning(f"Guild {self.guild_id} money supply drift corrected: {drift:+,} milli-coins (total now {fmt_coins(self.money_supply.total)}).") # Integer money: any drift is a bug
+        else: logger.debug(f"Guild {self.guild_id} money supply reconciled in {self.money_supply.last_reconcile_ms:.1f} ms (no drift).")
+        return drift
+    def _on_money_supply_threshold(self, total: Milli):
+        """Runs on the mutation that crosses this guild's reset threshold; schedules the reset instead of waiting for autosave."""
+        if self._reset_task and not self._reset_task.done(): return
+        try: self._reset_task = asyncio.get_running_loop().create_task(perform_economy_reset(self, triggered_by=f"Automatic Threshold ({fmt_coins(total)})"))
+        except RuntimeError: logger.warning(f"Guild {self.guild_id} economy threshold crossed ({fmt_coins(total)}) with no running loop; autosave will reset.")
+    def initial_balance_topup(self):
+        """One-time top-up of users below the starting balance (economies created before it existed)."""
+        logger.info(f"Performing one-time check/top-up for guild {self.guild_id} users below {fmt_coins(INITIAL_STARTING_BALANCE)} balance..."); journal_op.set("topup")
+        updated_count = 0
+        for user_id, udata in self.user_data.items():
+            if udata.balance < INITIAL_STARTING_BALANCE:
+                logger.debug(f"Topping up user {user_id} from {fmt_coins(udata.balance)} to {fmt_coins(INITIAL_STARTING_BALANCE)}.")
+                self.set_balance(user_id, INITIAL_STARTING_BALANCE); updated_count += 1
+        if updated_count > 0: logger.info(f"Topped up {updated_count} existing users to {fmt_coins(INITIAL_STARTING_BALANCE)} balance."); self.save_user_data()
+        self.bot_data["initial_balance_check_done"] = True; self.save_bot_data()
+
+    # --- Leaderboards ---
+    def update_ranks(self, user_id: int):
+        user_id = int(user_id); udata = self.user_data.get(user_id)
+        if udata is None:
+            for index in self.rank_indexes.values(): index.discard(user_id)
+            return
+        balance = udata.balance; savings = udata.savings
+        self.rank_indexes["balance"].update(user_id, balance); self.rank_indexes["savings"].update(user_id, savings)
+        self.rank_indexes["networth"].update(user_id, balance + savings); self.rank_indexes["biggest_win"].update(user_id, udata.best_win)
+    def rebuild_ranks(self):
+        for index in self.rank_indexes.values(): index.clear()
+        for user_id in self.user_data: self.update_ranks(user_id)
+        self.leaderboard_cache.clear()
+
+    # --- Lottery, chat rewards, scan checkpoints, orders ---
+    def attach_lottery_tickets(self):
+        """Builds the weighted ticket ledger from bot_data; bot_data["lottery_tickets"] then aliases its {user_id: count} dict."""
+        self.lottery_tickets = LotteryTickets.from_json(self.bot_data.get("lottery_tickets"))
+        self.bot_data["lottery_tickets"] = self.lottery_tickets.counts
+        if self.lottery_tickets.migrated: logger.info(f"Migrated legacy lottery ticket list to per-user counts ({self.lottery_tickets.total:,} tickets, {len(self.lottery_tickets.counts):,} holders)."); self.save_bot_data()
+    def credit_message_rewards(self) -> Milli:
+        """Credits accumulated chat rewards in one pass; every user gets a single balance update and one dirty mark."""
+        credited = []; journal_op.set("message")
+        def credit(user_id: int, coins: Milli): self.adjust_balance(user_id, coins); credited.append(user_id)
+        coins = self.message_rewards.drain(credit)
+        if credited: self.mark_dirty(*credited)
+        return coins
+    def scan_checkpoints(self) -> dict:
+        cps = self.bot_data.get("scan_checkpoints")
+        if not isinstance(cps, dict): cps = self.bot_data["scan_checkpoints"] = {}
+        return cps
+    def apply_scan_credits(self, channel_id: int, counts: dict[int, int], checkpoint_id: int):
+        """Credits one channel's counts and advances its checkpoint together; flushed as one transaction."""
+        journal_op.set("scan")
+        for user_id, count in counts.items(): self.adjust_balance(user_id, count * MILLI) # One coin per message
+        cps = self.scan_checkpoints(); key = str(channel_id)
+        if checkpoint_id > cps.get(key, 0): cps[key] = checkpoint_id
+        self.mark_dirty(*counts.keys(), state=True)
+    def mark_orders_notified(self, orders: list[dict]):
+        for order in orders: order["notified"] = True
+        self.mark_dirty(orders=tuple(o["order_id"] for o in orders))
+
+@timed(GUILD_ECONOMY_SECONDS, "load")
+async def load_guild_economy(guild_id: int) -> GuildEconomy:
+    """Shard loader: reads the guild's ledger on the persistence executor, then rebuilds the derived state on the loop."""
+    if (holder := await run_io(cluster.try_acquire, guild_lease(guild_id))) != cluster.owner: raise LeaseHeld(guild_lease(guild_id), holder) # One writer per guild cluster-wide
+    econ = GuildEconomy(guild_id)
+    try: await run_io(econ.open)
+    except BaseException: await run_io(cluster.release, guild_lease(guild_id)); raise
+    econ.attach_lottery_tickets(); econ.rebuild_ranks(); econ.shop_catalog.invalidate()
+    econ.money_supply.threshold = econ.reset_threshold(); econ.reconcile_money_supply()
+    econ.order_digest_queue.extend(o["order_id"] for o in econ.order_book.open_orders() if o["status"] == "pending" and not o.get("notified"))
+    if econ.ledger.migrated_to_milli or not econ.journal.has_snapshot: await econ.journal_snapshot() # Replay base (older snapshots may be in coins)
+    if not econ.bot_data.get("initial_balance_check_done", False): econ.initial_balance_topup()
+    if econ.lottery_tickets.total: await schedule_lottery_draw(econ, refresh=True) # Re-registers the round in case the cluster store lost it
+    logger.info(f"Loaded guild {guild_id} economy: {len(econ.user_data):,} users, {len(econ.order_book.orders)} open orders ({fmt_coins(econ.order_book.escrow)} coins in escrow, "
+                f"{len(econ.order_digest_queue)} awaiting notification), {len(econ.shop_items)} shop items.")
+    return econ
+@timed(GUILD_ECONOMY_SECONDS, "unload")
+async def unload_guild_economy(guild_id: int, econ: GuildEconomy):
+    """Shard unloader: credits pending chat rewards, flushes dirty rows and the journal, then closes the ledger. Raises (and the
+    shard stays loaded) if rows could not be written."""
+    econ.credit_message_rewards(); econ.save_bot_data() # Picks up scan checkpoints advanced by on_message
+    if econ._flush_task and not econ._flush_task.done(): await econ._flush_task
+    await econ.flush_dirty_data_async()
+    if econ.write_buffer.has_pending(): raise RuntimeError(f"guild {guild_id} still has unflushed rows")
+    await run_io(econ.journal.write, econ.journal.take_pending()); await run_io(econ.ledger.close); await run_io(cluster.release, guild_lease(guild_id))
+    logger.info(f"Unloaded guild {guild_id} economy ({len(econ.user_data):,} users). {econ.write_buffer.summary()}")
+guild_economies = ShardCache(load_guild_economy, unload_guild_economy, SHARD_IDLE_MINUTES * 60)
+metrics_registry.gauge("bot_guild_economies_loaded", "Guild economy shards in memory.").set_function(lambda: len(guild_economies))
+metrics_registry.gauge("bot_journal_pending_entries", "Journal entries not yet fsync'd, all loaded guilds.").set_function(lambda: sum(e.journal.pending() for e in guild_economies.values()))
+
+# --- Cluster --- (cluster.py --simulate models load_guild_economy, cluster_tick and lottery_drawing; change it with them)
+cluster = ClusterState(CLUSTER_DB_FILE, make_owner_id(f"shards{','.join(map(str, SHARD_IDS))}" if SHARD_IDS else "bot"), CLUSTER_LEASE_SECONDS)
+def import_lottery_schedule_file():
+    """One-shot move of the pre-cluster lottery schedule file into the cluster store (rounds already registered win)."""
+    if not os.path.exists(LOTTERY_SCHEDULE_FILE): return
     try:
-        with open(BOT_DATA_FILE, 'w') as f: json.dump(bot_data, f, indent=4)
-    except Exception as e: logger.error(f"Error saving bot data: {e}")
+        with open(LOTTERY_SCHEDULE_FILE, 'r') as f: entries = {int(guild_id): float(due) for guild_id, due in json.load(f).items()}
+        scheduled = cluster.draws()
+        for guild_id, due in entries.items():
+            if guild_id not in scheduled: cluster.schedule_draw(guild_id, due)
+        os.replace(LOTTERY_SCHEDULE_FILE, LOTTERY_SCHEDULE_FILE + ".imported"); logger.info(f"Imported {len(entries)} lottery draws into {CLUSTER_DB_FILE}.")
+    except Exception as e: logger.error(f"Error importing {LOTTERY_SCHEDULE_FILE}: {e}")
+async def schedule_lottery_draw(econ: GuildEconomy, refresh: bool = False):
+    """Starts the round's draw clock on its first ticket (the guild's interval from now) and registers the draw cluster-wide.
+    `refresh` re-registers a round that is already running."""
+    next_draw = econ.bot_data.get("lottery_next_draw")
+    if isinstance(next_draw, (int, float)) and not refresh: return
+    if not isinstance(next_draw, (int, float)): next_draw = econ.bot_data["lottery_next_draw"] = time_module.time() + econ.lottery_interval_hours() * 3600; econ.save_bot_data()
+    await run_io(cluster.schedule_draw, econ.guild_id, next_draw)
 
 # --- Bot Initialization ---
 intents = disnake.Intents.default()
 intents.message_content = True; intents.members = True; intents.guilds = True
-bot = commands.Bot(command_prefix="!", intents=intents, help_command=None, sync_commands_debug=True)
+class HelpPagesMixin:
+    """Keeps /help pages per permission profile in `help_pages`; adding or removing a cog or slash command clears them."""
+    def __init__(self, *args, **kwargs): self.help_pages: dict[tuple[bool, bool, bool, bool], list[disnake.Embed]] = {}; super().__init__(*args, **kwargs)
+    def add_cog(self, *args, **kwargs): self.help_pages.clear(); return super().add_cog(*args, **kwargs)
+    def remove_cog(self, *args, **kwargs): self.help_pages.clear(); return super().remove_cog(*args, **kwargs)
+    def add_slash_command(self, *args, **kwargs): self.help_pages.clear(); return super().add_slash_command(*args, **kwargs)
+    def remove_slash_command(self, *args, **kwargs): self.help_pages.clear(); return super().remove_slash_command(*args, **kwargs)
+class EconomyBot(HelpPagesMixin, commands.Bot): pass
+class ShardedEconomyBot(HelpPagesMixin, commands.AutoShardedBot): pass
+if SHARD_COUNT: bot = ShardedEconomyBot(command_prefix="!", intents=intents, help_command=None, sync_commands_debug=True, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+else: bot = EconomyBot(command_prefix="!", intents=intents, help_command=None, sync_commands_debug=True)
 bot.retroactive_scan_done = False
+bot.data_loaded = False # on_ready can fire again after a resume; in-memory state must not be reloaded then
+bot.is_cluster_leader = False # Set by cluster_heartbeat; cluster-wide jobs (legacy adoption, orphaned lottery draws) run only on the leader
+bot.metrics_server = None
+metrics_registry.gauge("bot_cluster_leader", "1 while this process is the cluster leader.").set_function(lambda: int(bot.is_cluster_leader))
+@bot.before_slash_command_invoke
+async def before_command(inter: disnake.ApplicationCommandInteraction):
+    name = inter.application_command.qualified_name; journal_op.set(name) # e.g. "gamble slots"
+    bind_log_fields(command=name, user_id=inter.author.id, guild_id=inter.guild_id) # On every record this command logs
+    command_timers[inter.id] = COMMAND_SECONDS.time(name, in_flight=COMMANDS_IN_FLIGHT).__enter__()
+@bot.after_slash_command_invoke
+async def after_command(inter: disnake.ApplicationCommandInteraction): # Runs whether or not the command raised
+    if not (timer := command_timers.pop(inter.id, None)): return
+    latency_ms = (time_module.perf_counter() - timer.started) * 1000; timer.__exit__(None, None, None)
+    options = {k: getattr(v, "id", v) for k, v in inter.filled_options.items()}; fields = {"latency_ms": round(latency_ms, 2), "options": options}
+    if "amount" in options: fields["amount"] = options["amount"]
+    logger.info(f"/{inter.application_command.qualified_name} by {inter.author.id} took {latency_ms:.1f} ms", extra=fields)
+SERVED_ELSEWHERE = "⏳ Another instance of the bot is serving this server right now (hand-over in progress). Try again in a few seconds."
+def is_lease_held(error: BaseException) -> bool: return isinstance(getattr(error, "original", error), LeaseHeld) # Wrapped in CommandInvokeError for commands
+async def reply_served_elsewhere(inter: disnake.Interaction):
+    """Ephemeral reply for an interaction whose guild economy is owned by another process (guild_economies.get raised LeaseHeld)."""
+    try:
+        if not inter.response.is_done(): await inter.response.send_message(SERVED_ELSEWHERE, ephemeral=True)
+        else: await inter.followup.send(SERVED_ELSEWHERE, ephemeral=True)
+    except Exception as e: logger.warning(f"Could not send hand-over reply: {e}")
+@bot.listen("on_slash_command_error")
+async def count_command_error(inter: disnake.ApplicationCommandInteraction, error: commands.CommandError):
+    cause = getattr(error, "original", error); COMMAND_ERRORS.inc(inter.application_command.qualified_name, type(cause).__name__)
+    if isinstance(cause, LeaseHeld): # Guild owned by another process (lease hand-over); commands with their own handler already replied
+        logger.info(f"/{inter.application_command.qualified_name} in guild {inter.guild_id}: {cause}")
+        if not inter.response.is_done(): await reply_served_elsewhere(inter)
+        return
+    logger.error(f"/{inter.application_command.qualified_name} failed: {cause!r}", exc_info=(type(cause), cause, cause.__traceback__))
 
 # --- Helper Functions ---
-async def perform_economy_reset(triggered_by: str = "Automatic Threshold"): # RESTORED
-    """Resets balances, pools, and notifies admins."""
-    logger.warning(f"ECONOMY RESET TRIGGERED! Reason: {triggered_by}")
-    print(f"!!! ECONOMY RESET TRIGGERED: {triggered_by} !!!")
-    load_user_data(); load_bot_data() # Reload data just before reset
+async def guild_channel(guild_id: int, channel_id: int):
+    """The configured channel if it belongs to this guild, otherwise the guild's system channel (None if it has neither)."""
+    channel = bot.get_channel(channel_id)
+    if channel is not None and getattr(channel, "guild", None) is not None and channel.guild.id == guild_id: return channel
+    guild = bot.get_guild(guild_id)
+    return guild.system_channel if guild else None
+async def perform_economy_reset(econ: GuildEconomy, triggered_by: str = "Automatic Threshold"): # RESTORED
+    """Resets one guild's balances and pools, and notifies its admins. Other guilds are untouched."""
+    logger.warning(f"ECONOMY RESET TRIGGERED in guild {econ.guild_id}! Reason: {triggered_by}")
+    print(f"!!! ECONOMY RESET TRIGGERED (guild {econ.guild_id}): {triggered_by} !!!")
     users_reset = 0
-    for user_id_str in list(user_data.keys()):
+    for user_id_str in list(econ.user_data.keys()):
         try:
             user_id = int(user_id_str)
-            udata = user_data[user_id]
-            udata["balance"] = INITIAL_STARTING_BALANCE # Reset to starting balance
-            udata["savings"] = 0
+            udata = econ.user_data[user_id]
+            udata.balance = INITIAL_STARTING_BALANCE # Reset to starting balance
+            udata.savings = 0
             users_reset += 1
         except (ValueError, KeyError) as e: logger.warning(f"Skipping invalid user ID {user_id_str} during reset: {e}")
-    bot_data["slot_jackpot_pool"] = 0.0
-    bot_data["lottery_pot"] = 0.0
-    bot_data["lottery_tickets"] = []
-    logger.warning(f"Economy Reset Complete. Reset {users_reset} users. Reset pools.")
-    save_user_data(); save_bot_data() # Save reset state
+    econ.bot_data["slot_jackpot_pool"] = 0
+    econ.bot_data["lottery_pot"] = 0
+    econ.journal.record(None, "*", value=INITIAL_STARTING_BALANCE, op="reset")
+    econ.message_rewards.clear() # Uncredited chat rewards were earned in the old economy
+    econ.lottery_tickets.clear(); econ.bot_data["lottery_next_draw"] = None
+    await run_io(cluster.cancel_draw, econ.guild_id)
+    econ.reconcile_money_supply() # Totals were rewritten wholesale; resync the running aggregates
+    logger.warning(f"Economy Reset Complete for guild {econ.guild_id}. Reset {users_reset} users. Reset pools.")
+    econ.save_economy() # Save reset state (this guild's users + pools in one transaction)
     try:
-        admin_channel = bot.get_channel(ADMIN_CHANNEL_ID) or await bot.fetch_channel(ADMIN_CHANNEL_ID)
+        admin_channel = await guild_channel(econ.guild_id, ADMIN_CHANNEL_ID)
         if admin_channel:
-            await admin_channel.send(f"🚨 **ECONOMY RESET TRIGGERED** 🚨\nReason: {triggered_by}\nBalances reset to **{INITIAL_STARTING_BALANCE:,}**, savings/pools cleared.")
-            logger.info(f"Sent economy reset notification to admin channel {ADMIN_CHANNEL_ID}.")
-        else: logger.error("Could not find admin channel for reset notification.")
+            await admin_channel.send(f"🚨 **ECONOMY RESET TRIGGERED** 🚨\nReason: {triggered_by}\nBalances reset to **{fmt_coins(INITIAL_STARTING_BALANCE)}**, savings/pools cleared.")
+            logger.info(f"Sent economy reset notification to channel {admin_channel.id}.")
+        else: logger.error(f"Could not find an admin channel in guild {econ.guild_id} for reset notification.")
     except Exception as e: logger.error(f"Failed to send economy reset notification: {e}")
 
-async def announce_big_win(interaction: disnake.ApplicationCommandInteraction, user: disnake.Member, winnings: float, game_name: str):
+async def announce_big_win(interaction: disnake.ApplicationCommandInteraction, user: disnake.Member, winnings: Milli, game_name: str):
     if winnings < BIG_WIN_THRESHOLD: return
     channel = interaction.channel
     if not channel or not isinstance(channel, disnake.TextChannel): logger.warning(f"Cannot announce big win - invalid channel."); return
@@ -195,134 +548,297 @@ async def announce_big_win(interaction: disnake.ApplicationCommandInteraction, u
     if not perms.send_messages: logger.warning(f"Cannot announce big win - missing Send Messages perm."); return
     everyone_ping_allowed = perms.mention_everyone
     mention_str = f"@everyone {user.mention}" if everyone_ping_allowed else f"{user.mention}"
-    winnings_display = f"{int(winnings):,}" if winnings == int(winnings) else f"{winnings:,.2f}"
-    message = f"🎉 **BIG WIN!** {mention_str} just won **{winnings_display} coins** playing {game_name}! 🎉"
+    message = f"🎉 **BIG WIN!** {mention_str} just won **{fmt_coins(winnings)} coins** playing {game_name}! 🎉"
     try:
         await channel.send(message, allowed_mentions=disnake.AllowedMentions(everyone=everyone_ping_allowed, users=[user]))
         logger.info(f"Announced big win for {user.name} ({user.id}) in #{channel.name}. Pinged everyone: {everyone_ping_allowed}")
     except Exception as e: logger.error(f"Failed to send big win announcement: {e}", exc_info=True)
 
 # --- Background Tasks ---
+# Every loop walks the guild economies currently in memory; an evicted guild has nothing pending (it was flushed on unload).
 @tasks.loop(minutes=5)
+@timed(TASK_SECONDS, "autosave_data")
 async def autosave_data(): # RESTORED Economy Reset Check
     logger.debug("Autosaving...")
-    try:
-        load_user_data(); load_bot_data() # Load fresh data for check
-        total_user_currency = sum(d.get('balance', 0) + d.get('savings', 0) for d in user_data.values() if isinstance(d, dict))
-        total_pool_currency = bot_data.get('slot_jackpot_pool', 0.0) + bot_data.get('lottery_pot', 0.0)
-        if not isinstance(total_pool_currency, (int, float)): total_pool_currency = 0.0
-        total_currency = total_user_currency + total_pool_currency
-        logger.debug(f"Total currency check: {total_currency:,.2f} / {ECONOMY_RESET_THRESHOLD:,.0f}")
-        if total_currency >= ECONOMY_RESET_THRESHOLD:
-            await perform_economy_reset(triggered_by=f"Automatic Threshold ({total_currency:,.0f})")
-            logger.debug("Autosave cycle finished after economy reset.")
-            return # Skip normal saving if reset occurred
-    except Exception as e: logger.error(f"Error during economy reset check: {e}", exc_info=True)
-    try: save_user_data()
-    except Exception as e: logger.error(f"Autosave user data fail: {e}", exc_info=True)
-    try: save_shop_items()
-    except Exception as e: logger.error(f"Autosave shop items fail: {e}", exc_info=True)
-    try: save_bot_data()
-    except Exception as e: logger.error(f"Autosave bot data fail: {e}", exc_info=True)
+    for econ in guild_economies.values():
+        try: # In-memory state is the source of truth; O(1) check against the guild's running money supply
+            total_currency = econ.money_supply.total
+            logger.debug(f"Guild {econ.guild_id} currency check: {fmt_coins(total_currency)} / {fmt_coins(econ.reset_threshold())}")
+            if total_currency >= econ.reset_threshold():
+                await perform_economy_reset(econ, triggered_by=f"Automatic Threshold ({fmt_coins(total_currency)})")
+                continue # Skip normal saving if reset occurred
+        except Exception as e: logger.error(f"Error during economy reset check for guild {econ.guild_id}: {e}", exc_info=True)
+        try: await econ.flush_dirty_data_async()
+        except Exception as e: logger.error(f"Autosave economy data fail for guild {econ.guild_id}: {e}", exc_info=True)
+        econ.save_bot_data() # Picks up scan checkpoints advanced by on_message
+        econ.order_book.prune(keep=econ.write_buffer.dirty_orders) # Closed orders are in the ledger now
+        logger.debug(f"Guild {econ.guild_id} persistence: {econ.write_buffer.summary()} | message rewards: {econ.message_rewards.summary()}")
+    logger.info(f"Guild economies: {guild_economies.summary()}")
     logger.debug("Autosave cycle finished.")
 @autosave_data.before_loop
 async def before_autosave(): await bot.wait_until_ready(); logger.info("Starting autosave.")
-@tasks.loop(hours=LOTTERY_INTERVAL_HOURS)
+@tasks.loop(minutes=MONEY_SUPPLY_RECONCILE_MINUTES)
+@timed(TASK_SECONDS, "reconcile_money_supply_loop")
+async def reconcile_money_supply_loop():
+    for econ in guild_economies.values():
+        try: econ.reconcile_money_supply()
+        except Exception as e: logger.error(f"Money supply reconcile failed for guild {econ.guild_id}: {e}", exc_info=True)
+@reconcile_money_supply_loop.before_loop
+async def before_reconcile_money_supply(): await bot.wait_until_ready()
+@tasks.loop(seconds=PERSIST_FLUSH_INTERVAL_SECONDS)
+@timed(TASK_SECONDS, "flush_dirty_loop")
+async def flush_dirty_loop():
+    for econ in guild_economies.values():
+        if econ.write_buffer.has_pending():
+            rows = await econ.flush_dirty_data_async()
+            logger.debug(f"Flushed {rows} dirty rows for guild {econ.guild_id} ({econ.write_buffer.stats['last_flush_ms']:.2f} ms).")
+@flush_dirty_loop.before_loop
+async def before_flush_dirty(): await bot.wait_until_ready(); logger.info(f"Starting write-behind flusher (every {PERSIST_FLUSH_INTERVAL_SECONDS}s or {PERSIST_FLUSH_MAX_DIRTY} dirty users per guild).")
+@tasks.loop(minutes=1)
+@timed(TASK_SECONDS, "evict_idle_guilds")
+async def evict_idle_guilds():
+    if evicted := await guild_economies.evict_idle(can_evict=lambda econ: not econ.busy()): logger.info(f"Evicted {evicted} idle guild economies ({guild_economies.summary()}).")
+@evict_idle_guilds.before_loop
+async def before_evict_idle_guilds(): await bot.wait_until_ready(); logger.info(f"Starting guild economy eviction (idle after {SHARD_IDLE_MINUTES:g} min).")
+@tasks.loop(seconds=MESSAGE_REWARD_BATCH_SECONDS)
+@timed(TASK_SECONDS, "message_reward_loop")
+async def message_reward_loop():
+    for econ in guild_economies.values():
+        try: econ.credit_message_rewards()
+        except Exception as e: logger.error(f"Crediting message rewards failed for guild {econ.guild_id}: {e}", exc_info=True)
+@message_reward_loop.before_loop
+async def before_message_rewards(): await bot.wait_until_ready(); logger.info(f"Starting message rewards ({MESSAGE_REWARD_FULL_RATE} full-rate msgs/{MESSAGE_REWARD_WINDOW_SECONDS:g}s, decay {MESSAGE_REWARD_DECAY}, credited every {MESSAGE_REWARD_BATCH_SECONDS}s).")
+@tasks.loop(seconds=JOURNAL_FSYNC_SECONDS)
+@timed(TASK_SECONDS, "journal_flush_loop")
+async def journal_flush_loop():
+    for econ in guild_economies.values():
+        if econ.journal.pending(): await run_io(econ.journal.write, econ.journal.take_pending()) # One write + fsync per batch
+@journal_flush_loop.before_loop
+async def before_journal_flush(): await bot.wait_until_ready(); logger.info(f"Starting journal writer (fsync every {JOURNAL_FSYNC_SECONDS}s).")
+@tasks.loop(minutes=JOURNAL_SNAPSHOT_MINUTES)
+@timed(TASK_SECONDS, "journal_snapshot_loop")
+async def journal_snapshot_loop(): # A shard also snapshots when it is first created, so replay always has a base
+    for econ in guild_economies.values():
+        try: await econ.journal_snapshot()
+        except Exception as e: logger.error(f"Journal snapshot failed for guild {econ.guild_id}: {e}", exc_info=True)
+@journal_snapshot_loop.before_loop
+async def before_journal_snapshot(): await bot.wait_until_ready()
+@tasks.loop(seconds=SHOP_FILE_WATCH_SECONDS)
+@timed(TASK_SECONDS, "shop_file_watch")
+async def shop_file_watch():
+    for econ in guild_economies.values():
+        mtime = await run_io(econ.shop_file_mtime)
+        if mtime is not None and mtime != econ.shop_catalog.file_mtime:
+            logger.info(f"{econ.shop_items_file} changed on disk, reloading shop catalog."); await econ.load_shop_items_async()
+@shop_file_watch.before_loop
+async def before_shop_file_watch(): await bot.wait_until_ready()
+@tasks.loop(minutes=1)
+@timed(TASK_SECONDS, "lottery_drawing")
 async def lottery_drawing():
-    logger.info("Attempting lottery drawing...")
-    load_bot_data(); load_user_data()
-    if not bot_data.get("lottery_tickets"): return logger.info("No lottery tickets sold.")
-    if not isinstance(bot_data.get("lottery_pot", 0.0), (int, float)): bot_data["lottery_pot"] = 0.0
-    if bot_data["lottery_pot"] <= 0: logger.info("Lottery pot zero."); bot_data["lottery_tickets"] = []; save_bot_data(); return
+    """Runs every due draw for guilds this process serves. The leader also draws lotteries left overdue by a process that is
+    gone. A draw is claimed under the guild's lease first, so each one runs exactly once cluster-wide."""
+    now = time_module.time()
+    for guild_id, due in (await run_io(cluster.due_draws, now)).items():
+        orphan = bot.get_guild(guild_id) is None # Served by another shard process (or the bot left the guild)
+        if orphan and not (bot.is_cluster_leader and due <= now - LOTTERY_ORPHAN_GRACE_SECONDS and await run_io(cluster.holder, guild_lease(guild_id)) is None): continue
+        try:
+            econ = await guild_economies.get(guild_id)
+            if await run_io(cluster.claim_draw, guild_id, guild_lease(guild_id)): await draw_lottery(econ)
+            if orphan: await guild_economies.evict(guild_id) # Hand the guild straight back to its own process
+        except LeaseHeld: logger.info(f"Guild {guild_id} lottery is due but another process owns the guild; it draws there.")
+        except Exception as e: logger.error(f"Lottery drawing for guild {guild_id} failed: {e}", exc_info=True)
+@lottery_drawing.before_loop
+async def before_lottery_drawing(): await bot.wait_until_ready(); logger.info(f"Starting lottery drawing loop ({len(await run_io(cluster.draws))} guilds scheduled cluster-wide).")
+async def cluster_tick():
+    """Renews this process's leases, contends for leadership, and drops any guild whose lease another process has taken."""
+    held = await run_io(cluster.renew)
+    leader = await run_io(cluster.try_acquire, LEADER_LEASE) == cluster.owner
+    if leader != bot.is_cluster_leader: logger.warning(f"{'Became' if leader else 'No longer'} cluster leader ({cluster.owner})."); bot.is_cluster_leader = leader
+    for guild_id in guild_economies.keys():
+        if guild_lease(guild_id) in held: continue
+        if await run_io(cluster.try_acquire, guild_lease(guild_id)) == cluster.owner: logger.warning(f"Guild {guild_id} lease had lapsed (event loop stalled?); re-acquired."); continue
+        econ = guild_economies.discard(guild_id); cluster.stats["lost"] += 1 # The new owner is authoritative; writing here would clobber it
+        logger.critical(f"Guild {guild_id} economy was taken over by another process; dropped it here with {econ.write_buffer.summary()}.")
+        await run_io(econ.ledger.close)
+@tasks.loop(seconds=CLUSTER_LEASE_SECONDS / 3)
+@timed(TASK_SECONDS, "cluster_heartbeat")
+async def cluster_heartbeat():
+    try: await cluster_tick()
+    except Exception as e: logger.error(f"Cluster heartbeat failed: {e}", exc_info=True)
+@cluster_heartbeat.before_loop
+async def before_cluster_heartbeat(): await bot.wait_until_ready(); logger.info(f"Starting cluster heartbeat ({cluster.owner}, lease {CLUSTER_LEASE_SECONDS:g}s).")
+async def draw_lottery(econ: GuildEconomy):
+    logger.info(f"Attempting lottery drawing for guild {econ.guild_id}...")
+    bot_data = econ.bot_data; lottery_tickets = econ.lottery_tickets
+    bot_data["lottery_next_draw"] = None; econ.save_bot_data() # The next round's first ticket starts its clock
+    if lottery_tickets.total <= 0: return logger.info("No lottery tickets sold.")
+    if not isinstance(bot_data.get("lottery_pot", 0), int): bot_data["lottery_pot"] = 0
+    if bot_data["lottery_pot"] <= 0: logger.info("Lottery pot zero."); econ.set_pool("lottery_pot", 0); lottery_tickets.clear(); econ.save_bot_data(); return
     try:
-        winner_id = random.choice(bot_data["lottery_tickets"]); prize_amount = bot_data["lottery_pot"]
-        winner_data = get_user_data(winner_id)
-        if not isinstance(winner_data["balance"], (int, float)): winner_data["balance"] = 0
-        winner_data["balance"] += prize_amount
-        logger.info(f"Lottery winner: {winner_id}, Prize: {prize_amount:.2f}")
+        winner_id = lottery_tickets.draw(random); prize_amount = bot_data["lottery_pot"]
+        journal_op.set("lottery draw"); econ.adjust_balance(winner_id, prize_amount)
+        logger.info(f"Lottery winner in guild {econ.guild_id}: {winner_id}, Prize: {fmt_coins(prize_amount)}")
         original_pot = bot_data["lottery_pot"]
-        bot_data["lottery_pot"] = 0.0; bot_data["lottery_tickets"] = []
-        save_user_data(); save_bot_data()
-        announce_channel = bot.get_channel(LOTTERY_ANNOUNCE_CHANNEL_ID) or await bot.fetch_channel(LOTTERY_ANNOUNCE_CHANNEL_ID)
+        econ.set_pool("lottery_pot", 0); lottery_tickets.clear()
+        econ.record_win(winner_id, prize_amount); econ.save_economy(winner_id)
+        announce_channel = await guild_channel(econ.guild_id, LOTTERY_ANNOUNCE_CHANNEL_ID)
+        if announce_channel is None: logger.warning(f"No lottery announcement channel in guild {econ.guild_id}."); return
         winner_user = bot.get_user(winner_id) or await bot.fetch_user(winner_id)
         winner_mention = winner_user.mention if winner_user else f"User ID `{winner_id}`"
         embed = disnake.Embed(title="🎉 Lottery Winner! 🎉", color=disnake.Color.gold(), timestamp=datetime.datetime.now(timezone.utc), description=f"Congrats to {winner_mention}!")
-        prize_display = f"{int(original_pot):,}" if original_pot == int(original_pot) else f"{original_pot:,.2f}"
-        embed.add_field(name="Prize Won", value=f"{prize_display} coins! 💰")
-        embed.set_footer(text=f"Next draw in {LOTTERY_INTERVAL_HOURS} hours.")
+        embed.add_field(name="Prize Won", value=f"{fmt_coins(original_pot)} coins! 💰")
+        embed.set_footer(text=f"Next draw {econ.lottery_interval_hours():g} hours after the next ticket is bought.")
         await announce_channel.send(content=winner_mention if winner_user else None, embed=embed, allowed_mentions=disnake.AllowedMentions(users=True if winner_user else False))
         logger.info(f"Lottery winner announced.")
     except (disnake.NotFound, disnake.Forbidden) as e: logger.error(f"Error finding/accessing lottery channel/user: {e}")
     except IndexError: logger.info("Lottery tickets empty during draw.")
     except Exception as e: logger.error(f"Error during lottery drawing: {e}", exc_info=True)
-@lottery_drawing.before_loop
-async def before_lottery_drawing(): await bot.wait_until_ready(); logger.info(f"Starting lottery drawing loop.")
+
+# --- Retroactive Message Scan ---
+class ScanProgress:
+    def __init__(self):
+        self.started_at = time_module.monotonic(); self.finished_at = None
+        self.channels_total = 0; self.channels_done = 0; self.channels_skipped = 0; self.channels_failed = 0
+        self.messages = 0; self.coins = 0; self.users: set[int] = set(); self.active: dict[int, str] = {}
+        self.state = "running"; self.attempt = 1; self.error = None
+    def elapsed(self) -> float: return (self.finished_at or time_module.monotonic()) - self.started_at
+    def rate(self) -> float: return self.messages / self.elapsed() if self.elapsed() > 0 else 0.0
+    def remaining(self) -> int: return self.channels_total - self.channels_done - self.channels_skipped - self.channels_failed
+    def summary(self) -> str:
+        return (f"{self.messages:,} msgs in {self.elapsed():.1f}s ({self.rate():,.0f} msg/s), channels {self.channels_done}/{self.channels_total} done, "
+                f"{self.remaining()} remaining, {self.channels_skipped} skipped, {self.channels_failed} failed, {self.coins:,} coins to {len(self.users):,} users")
+scan_progress: ScanProgress | None = None; retro_scan_task: asyncio.Task | None = None
+class PageRateLimiter:
+    """Paces history page fetches (100 messages each) across all scan workers, on top of disnake's own 429 handling."""
+    def __init__(self, per_second: float):
+        self.interval = 1.0 / per_second if per_second > 0 else 0.0; self._next = 0.0; self._lock = asyncio.Lock()
+    async def wait(self):
+        if not self.interval: return
+        async with self._lock:
+            now = time_module.monotonic(); delay = self._next - now
+            if delay > 0: await asyncio.sleep(delay)
+            self._next = max(now, self._next) + self.interval
+async def scan_channel(channel: disnake.TextChannel, cutoff: disnake.Object, limiter: PageRateLimiter, progress: ScanProgress):
+    """First scan: newest SCAN_MESSAGE_LIMIT messages. Later scans: only messages after the channel's checkpoint.
+    Messages after `cutoff` (scan start) are left to on_message. Credits go to the channel's guild economy."""
+    hwm = (await guild_economies.get(channel.guild.id)).scan_checkpoints().get(str(channel.id))
+    if hwm: history = channel.history(limit=SCAN_MESSAGE_LIMIT_PER_CHANNEL, after=disnake.Object(id=hwm), before=cutoff, oldest_first=True)
+    else: history = channel.history(limit=SCAN_MESSAGE_LIMIT_PER_CHANNEL, before=cutoff)
+    counts = {}; newest = hwm or 0; seen = 0
+    await limiter.wait()
+    async for message in history:
+        seen += 1; progress.messages += 1; newest = max(newest, message.id)
+        if seen % 100 == 0: await limiter.wait() # Next iteration triggers the next page fetch
+        if not message.author.bot and message.author.id != bot.user.id: counts[message.author.id] = counts.get(message.author.id, 0) + 1
+    # Fully caught up -> everything before the cutoff is done; hit the limit on an incremental scan -> resume from `newest`
+    checkpoint = newest if hwm and seen >= SCAN_MESSAGE_LIMIT_PER_CHANNEL else max(newest, cutoff.id)
+    (await guild_economies.get(channel.guild.id)).apply_scan_credits(channel.id, counts, checkpoint) # Re-fetched: the shard may have been evicted meanwhile
+    progress.coins += sum(counts.values()); progress.users.update(counts.keys())
+async def run_retro_scan(attempt: int = 1):
+    """Scans all readable text channels with a bounded worker pool, crediting and checkpointing channel by channel."""
+    global scan_progress
+    progress = scan_progress = ScanProgress(); progress.attempt = attempt; limiter = PageRateLimiter(SCAN_MAX_PAGES_PER_SECOND)
+    cutoff = disnake.Object(id=disnake.utils.time_snowflake(datetime.datetime.now(timezone.utc)))
+    queue: asyncio.Queue = asyncio.Queue()
+    for guild in bot.guilds:
+        for channel in guild.text_channels:
+            progress.channels_total += 1; permissions = channel.permissions_for(guild.me)
+            if permissions.read_message_history and permissions.view_channel: queue.put_nowait(channel)
+            else: progress.channels_skipped += 1
+    logger.info(f"Starting retro scan of {queue.qsize()} channels in {len(bot.guilds)} guilds ({SCAN_CONCURRENCY} workers)...")
+    async def worker():
+        while True:
+            try: channel = queue.get_nowait()
+            except asyncio.QueueEmpty: return
+            progress.active[channel.id] = f"#{channel.name}"
+            try: await scan_channel(channel, cutoff, limiter, progress); progress.channels_done += 1
+            except Exception as e: logger.warning(f" Error scanning #{channel.name}: {e}"); progress.channels_failed += 1
+            finally: progress.active.pop(channel.id, None)
+    async def reporter():
+        while True: await asyncio.sleep(SCAN_PROGRESS_LOG_SECONDS); logger.info(f"Retro scan progress: {progress.summary()}")
+    reporter_task = asyncio.create_task(reporter())
+    try: await asyncio.gather(*(worker() for _ in range(min(SCAN_CONCURRENCY, max(1, queue.qsize())))))
+    finally: reporter_task.cancel(); progress.finished_at = time_module.monotonic(); TASK_SECONDS.observe(progress.elapsed(), "retro_scan")
+    progress.state = "finished"
+    logger.info(f"--- Retro Scan Summary ---"); logger.info(f" {progress.summary()}"); logger.info(f"--------------------------")
+
+async def supervise_retro_scan():
+    """Background supervisor: retries a crashed scan (checkpoints make retries cheap) and records the final state."""
+    for attempt in range(1, SCAN_MAX_RESTARTS + 2):
+        try: await run_retro_scan(attempt); return
+        except asyncio.CancelledError:
+            if scan_progress: scan_progress.state = "cancelled"; scan_progress.finished_at = time_module.monotonic()
+            logger.warning(f"Retro scan cancelled. {scan_progress.summary() if scan_progress else ''}"); raise
+        except Exception as e:
+            if scan_progress: scan_progress.state = "failed"; scan_progress.error = str(e); scan_progress.finished_at = time_module.monotonic()
+            if attempt > SCAN_MAX_RESTARTS: logger.error(f"Retro scan failed permanently: {e}", exc_info=True); return
+            backoff = 5 * 2 ** (attempt - 1); logger.error(f"Retro scan crashed ({e}); restarting in {backoff}s (attempt {attempt + 1}).", exc_info=True)
+            await asyncio.sleep(backoff)
+def start_retro_scan() -> bool:
+    """Starts the supervised scan in the background. Returns False if one is already running."""
+    global retro_scan_task
+    if retro_scan_task and not retro_scan_task.done(): return False
+    retro_scan_task = asyncio.get_running_loop().create_task(supervise_retro_scan(), name="retro-scan"); return True
 
 # --- Event Handlers ---
+async def adopt_legacy_economy():
+    """Moves the pre-shard single economy (data/economy.db, journal, shop and JSON files) into one guild's shard directory."""
+    guild_id = LEGACY_GUILD_ID or (bot.guilds[0].id if len(bot.guilds) == 1 and not SHARD_IDS else None) # A shard process only sees its own guilds
+    if guild_id is None: logger.error(f"Found a pre-shard economy in {DATA_DIR}/ but the bot is in {len(bot.guilds)} guilds; set LEGACY_GUILD_ID to the guild that owns it. Leaving it in place."); return
+    if guild_id in guild_economies: logger.error(f"Guild {guild_id} economy is already loaded; not adopting the pre-shard economy."); return
+    moved = await run_io(adopt_legacy_data, DATA_DIR, GUILDS_DIR, guild_id)
+    if moved: logger.warning(f"Moved the pre-shard economy into guild {guild_id}'s shard ({', '.join(moved)}).")
 @bot.event
-async def on_ready(): # Restored one-time balance check flag logic
+async def on_ready():
+    ready_started = time_module.perf_counter(); first_ready = not bot.data_loaded
     logger.info(f'{bot.user} ready. Version: {disnake.__version__}')
     if PLACEHOLDER_IDS_PRESENT: logger.warning("!!! Placeholder IDs might be active.")
-    load_user_data(); load_shop_items(); load_bot_data()
-    if not bot_data.get("initial_balance_check_done", False):
-        logger.info(f"Performing one-time check/top-up for users below {INITIAL_STARTING_BALANCE} balance...")
-        updated_count = 0
-        load_user_data()
-        for user_id_str in list(user_data.keys()):
-            try:
-                user_id = int(user_id_str)
-                udata = user_data[user_id]
-                current_bal = udata.get("balance")
-                if not isinstance(current_bal, (int, float)) or current_bal < INITIAL_STARTING_BALANCE:
-                    logger.debug(f"Topping up user {user_id} from {current_bal} to {INITIAL_STARTING_BALANCE}.")
-                    udata["balance"] = INITIAL_STARTING_BALANCE
-                    updated_count += 1
-            except (ValueError, KeyError) as e: logger.warning(f"Error processing user {user_id_str} during initial balance check: {e}")
-        if updated_count > 0: logger.info(f"Topped up {updated_count} existing users to {INITIAL_STARTING_BALANCE} balance."); save_user_data()
-        bot_data["initial_balance_check_done"] = True
-        save_bot_data()
-        logger.info("Initial balance check complete.")
-    else: logger.info("Initial balance check already performed previously.")
+    if not bot.data_loaded: # Guild economies load lazily on first use; only cluster-wide state is handled here
+        await cluster_tick() # Settles leadership before the one-off jobs below
+        if bot.is_cluster_leader:
+            await run_io(import_lottery_schedule_file)
+            if await run_io(has_legacy_data, DATA_DIR): await adopt_legacy_economy()
+        bot.data_loaded = True
+    if not cluster_heartbeat.is_running(): cluster_heartbeat.start()
+    if METRICS_PORT and bot.metrics_server is None:
+        port = METRICS_PORT + (SHARD_IDS[0] if SHARD_IDS else 0)
+        try: bot.metrics_server = await serve_metrics(metrics_registry, METRICS_HOST, port); logger.info(f"Metrics at http://{METRICS_HOST}:{port}/metrics")
+        except OSError as e: logger.error(f"Could not start metrics endpoint on {METRICS_HOST}:{port}: {e}")
     if not autosave_data.is_running(): autosave_data.start()
+    if not reconcile_money_supply_loop.is_running(): reconcile_money_supply_loop.start()
+    if not flush_dirty_loop.is_running(): flush_dirty_loop.start()
+    if not evict_idle_guilds.is_running(): evict_idle_guilds.start()
     if not lottery_drawing.is_running(): lottery_drawing.start()
-    if not bot.retroactive_scan_done:
-        logger.info("Starting retro scan...")
-        bot.retroactive_scan_done = True; start_scan_time = time_module.time()
-        total_messages_scanned = 0; user_message_counts = {}
-        for guild in bot.guilds:
-            logger.info(f"Scanning guild: {guild.name}")
-            guild_message_count = 0; channel_scan_count = 0; skipped_channels = 0
-            for channel in guild.text_channels:
-                permissions = channel.permissions_for(guild.me)
-                if permissions.read_message_history and permissions.view_channel:
-                    try:
-                        async for message in channel.history(limit=SCAN_MESSAGE_LIMIT_PER_CHANNEL):
-                            total_messages_scanned += 1; guild_message_count += 1
-                            if not message.author.bot and message.author.id != bot.user.id:
-                                user_message_counts[message.author.id] = user_message_counts.get(message.author.id, 0) + 1
-                        channel_scan_count += 1
-                    except Exception as e: logger.warning(f" Error scanning #{channel.name}: {e}"); skipped_channels += 1
-                else: skipped_channels += 1
-            logger.info(f" Scanned {guild_message_count} msgs ({channel_scan_count} channels). Skipped {skipped_channels}.")
-        logger.info("Applying retroactive counts...")
-        updated_user_count = 0; total_coins_added = 0
-        load_user_data()
-        for user_id, count in user_message_counts.items():
-            if count > 0:
-                udata = get_user_data(user_id)
-                if not isinstance(udata["balance"], (int, float)): udata["balance"] = 0
-                udata["balance"] += count; updated_user_count += 1; total_coins_added += count
-        scan_duration = time_module.time() - start_scan_time
-        logger.info(f"--- Retro Scan Summary ---"); logger.info(f" Duration: {scan_duration:.2f}s, Total Scanned: {total_messages_scanned}"); logger.info(f" Users Awarded: {updated_user_count}, Total Coins: {total_coins_added}"); logger.info(f"--------------------------")
-        save_user_data()
-    else: logger.info("Retro scan done.")
+    if not shop_file_watch.is_running(): shop_file_watch.start()
+    if not order_digest.is_running(): order_digest.start()
+    if not journal_flush_loop.is_running(): journal_flush_loop.start()
+    if not message_reward_loop.is_running(): message_reward_loop.start()
+    if not journal_snapshot_loop.is_running(): journal_snapshot_loop.start()
+    for guild in bot.guilds: shopkeeper_index.seed(guild)
+    if not bot.retroactive_scan_done: # Runs in the background; commands are usable immediately
+        bot.retroactive_scan_done = True; start_retro_scan(); logger.info("Retro scan started in background.")
+    else: logger.info("Retro scan already started this session.")
+    bot.help_pages = {profile: build_help_pages(profile) for profile in HELP_PROFILES} # Commands are synced by now; /help is a lookup from here on
+    TASK_SECONDS.observe(time_module.perf_counter() - ready_started, "on_ready")
+    if first_ready: STARTUP_SECONDS.set(time_module.monotonic() - PROCESS_STARTED)
     logger.info("Bot ready.")
 @bot.event
 async def on_message(message: disnake.Message):
     if message.author.bot or not message.guild: return
-    udata = get_user_data(message.author.id)
-    if not isinstance(udata["balance"], (int, float)): udata["balance"] = 0
-    udata["balance"] += 1
+    try: econ = await guild_economies.get(message.guild.id) # An active guild stays loaded; a quiet one is loaded by its first message
+    except LeaseHeld: return # Another process serves this guild (hand-over); it counts its own messages
+    econ.message_rewards.add(message.author.id) # Counted here, credited in batches by message_reward_loop
+    logger.info("Message counted for rewards.", extra={"sample": "on_message", "user_id": message.author.id, "guild_id": message.guild.id, "channel_id": message.channel.id}) # Sampled 1 in LOG_SAMPLE_EVERY
+    cps = econ.bot_data.get("scan_checkpoints") # Credited live, so a later incremental scan must start after it
+    if cps and (key := str(message.channel.id)) in cps and message.id > cps[key] and message.channel.id not in (scan_progress.active if scan_progress else ()): cps[key] = message.id
+@bot.event
+async def on_member_update(before: disnake.Member, after: disnake.Member): shopkeeper_index.update(after)
+@bot.event
+async def on_member_join(member: disnake.Member): shopkeeper_index.update(member)
+@bot.event
+async def on_member_remove(member: disnake.Member): shopkeeper_index.discard(member.guild.id, member.id)
+@bot.event
+async def on_guild_join(guild: disnake.Guild): shopkeeper_index.seed(guild)
 
 # --- Shop Helper Functions ---
 def is_shop_open() -> bool:
@@ -349,52 +865,227 @@ def time_until_shop_opens() -> str:
         if not parts: return "imminently"
         return " ".join(parts)
     except Exception as e: logger.error(f"Error calc shop time: {e}"); return "?"
-async def notify_shopkeepers(interaction: disnake.Interaction, item_data: dict, payment_method: str) -> bool:
-    if not interaction.guild: logger.error("notify_shopkeepers no guild context."); return False
-    shopkeeper_role = interaction.guild.get_role(SHOPKEEPER_ROLE_ID)
-    if not shopkeeper_role: logger.error(f"Shopkeeper role {SHOPKEEPER_ROLE_ID} not found."); await interaction.followup.send(f"Shopkeeper role not found.", ephemeral=True); return False
-    buyer = interaction.user; buyer_data = get_user_data(buyer.id)
-    current_balance = buyer_data.get("balance", 0);
-    if not isinstance(current_balance, (int, float)): current_balance = 0
-    embed = disnake.Embed(title="🛒 Shop Purchase Notification 🛒", color=disnake.Color.blue(), timestamp=datetime.datetime.now(timezone.utc), description=f"User initiated purchase in **{interaction.guild.name}**.")
-    embed.add_field(name="Buyer", value=f"{buyer.mention} ({buyer.name})", inline=False)
-    embed.add_field(name="Buyer ID", value=f"`{buyer.id}`", inline=False)
-    embed.add_field(name="Item", value=f"{item_data.get('name','Unknown')} (ID: `{item_data.get('id','N/A')}`)", inline=False)
-    embed.add_field(name="Payment Method", value=payment_method, inline=True)
-    if payment_method == "Credits": embed.add_field(name="Credit Cost", value=f"{item_data.get('credit_cost', 0):,} coins", inline=True)
-    elif payment_method == "USD/Other":
-        usd_price = item_data.get('usd_price'); price_str = f"${usd_price:.2f}" if isinstance(usd_price, (int, float)) and usd_price > 0 else "N/A"
-        embed.add_field(name="USD Price", value=price_str, inline=True)
-    embed.add_field(name="Buyer's Balance", value=f"{int(current_balance):,} coins", inline=False)
-    embed.set_footer(text="Coordinate with buyer.")
-    success_count = 0; fail_count = 0
-    shopkeepers_to_notify = [m for m in interaction.guild.members if shopkeeper_role in m.roles and not m.bot]
-    if not shopkeepers_to_notify: logger.warning(f"No shopkeepers found."); await interaction.followup.send("No shopkeepers found.", ephemeral=True); return False
-    logger.info(f"Notifying {len(shopkeepers_to_notify)} shopkeepers...")
-    tasks = [member.send(embed=embed) for member in shopkeepers_to_notify]
-    results = await asyncio.gather(*tasks, return_exceptions=True)
-    for i, result in enumerate(results):
-        if isinstance(result, Exception): logger.warning(f"Failed DM to {shopkeepers_to_notify[i].id}: {result}"); fail_count += 1
-        else: success_count += 1
-    if success_count > 0:
-        logger.info(f"Notified {success_count} shopkeepers ({fail_count} failed).");
-        await interaction.followup.send(f"✅ Purchase initiated for **{item_data.get('name','?')}**! {success_count} shopkeeper(s) notified.", ephemeral=False) # Public confirmation
-        return True
-    else:
-        logger.error(f"Failed to notify any shopkeepers.");
-        await interaction.followup.send("❌ Failed to notify any shopkeepers.", ephemeral=True) # Ephemeral error
-        return False
+def parse_shop_expiry(value) -> datetime.datetime | None:
+    """Parses an item's `expires_at` ISO string (None = never). Raises ValueError on bad input."""
+    if not value: return None
+    expires_at_dt = datetime.datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    return expires_at_dt if expires_at_dt.tzinfo else expires_at_dt.replace(tzinfo=timezone.utc)
+class ShopCatalog:
+    """In-memory view of active shop items. Expiry datetimes are parsed once per rebuild, upcoming expirations sit in a
+    min-heap, and the name-sorted list is only rebuilt when the items change (shopadmin writes, file mtime change).
+    One per guild economy (`owner`), over that guild's shop_items."""
+    def __init__(self, owner):
+        self.owner = owner; self.file_mtime: int | None = None
+        self._dirty = True; self._active: list[tuple[str, dict]] = []; self._active_ids: dict[str, dict] = {}
+        self._expiry_heap: list[tuple[datetime.datetime, str]] = []
+    def invalidate(self): self._dirty = True
+    def _rebuild(self, now_utc: datetime.datetime):
+        active = []; heap = []
+        for item_id, item in self.owner.shop_items.items():
+            if not isinstance(item, dict) or 'name' not in item or 'credit_cost' not in item: continue
+            try: expires_at_dt = parse_shop_expiry(item.get("expires_at"))
+            except Exception: logger.error(f"Invalid date for {item_id}"); expires_at_dt = None
+            if expires_at_dt is not None:
+                if now_utc >= expires_at_dt: continue
+                heap.append((expires_at_dt, item_id))
+            active.append((item_id, item))
+        active.sort(key=lambda i: i[1].get('name', '').lower()); heapq.heapify(heap)
+        self._active = active; self._active_ids = dict(active); self._expiry_heap = heap; self._dirty = False
+    def active_items(self) -> list[tuple[str, dict]]:
+        """Name-sorted (item_id, item) pairs that haven't expired. Don't mutate the returned list."""
+        now_utc = datetime.datetime.now(timezone.utc)
+        if self._dirty: self._rebuild(now_utc)
+        elif self._expiry_heap and self._expiry_heap[0][0] <= now_utc:
+            expired = set()
+            while self._expiry_heap and self._expiry_heap[0][0] <= now_utc: expired.add(heapq.heappop(self._expiry_heap)[1])
+            self._active = [pair for pair in self._active if pair[0] not in expired]
+            for item_id in expired: self._active_ids.pop(item_id, None)
+        return self._active
+    def get_active(self, item_id: str) -> dict | None:
+        self.active_items(); return self._active_ids.get(item_id)
+class RoleMemberIndex:
+    """Per-guild set of non-bot member IDs holding one role. Seeded once from role.members, then kept current by member events."""
+    def __init__(self, role_id: int):
+        self.role_id = role_id; self._members: dict[int, set[int]] = {}
+    def seed(self, guild: disnake.Guild) -> set[int]:
+        role = guild.get_role(self.role_id)
+        members = {m.id for m in role.members if not m.bot} if role else set()
+        self._members[guild.id] = members; logger.info(f"Indexed {len(members)} members with role {self.role_id} in guild {guild.id}.")
+        return members
+    def update(self, member: disnake.Member):
+        if member.guild.id not in self._members: return # Seeded lazily on first lookup
+        if not member.bot and member.get_role(self.role_id): self._members[member.guild.id].add(member.id)
+        else: self._members[member.guild.id].discard(member.id)
+    def discard(self, guild_id: int, member_id: int):
+        if guild_id in self._members: self._members[guild_id].discard(member_id)
+    def contains(self, guild: disnake.Guild, member_id: int) -> bool:
+        ids = self._members.get(guild.id)
+        return member_id in (ids if ids is not None else self.seed(guild))
+    def members(self, guild: disnake.Guild) -> list[disnake.Member]:
+        """Resolves the indexed members in O(role size); IDs no longer cached by the guild are dropped."""
+        ids = self._members.get(guild.id)
+        if ids is None: ids = self.seed(guild)
+        resolved = []
+        for member_id in list(ids):
+            if (member := guild.get_member(member_id)) is not None: resolved.append(member)
+            else: ids.discard(member_id)
+        return resolved
+shopkeeper_index = RoleMemberIndex(SHOPKEEPER_ROLE_ID)
+async def send_dms(members: list[disnake.Member], concurrency: int, **kwargs) -> tuple[int, dict[str, list[int]]]:
+    """DMs each member with at most `concurrency` sends in flight. Returns (sent, {error type: [member IDs]})."""
+    semaphore = asyncio.Semaphore(concurrency); failures: dict[str, list[int]] = {}; sent = 0
+    async def send_one(member: disnake.Member):
+        nonlocal sent
+        async with semaphore:
+            try: await member.send(**kwargs); sent += 1; DMS_SENT.inc("sent")
+            except Exception as e: failures.setdefault(type(e).__name__, []).append(member.id); DMS_SENT.inc(type(e).__name__)
+    await asyncio.gather(*(send_one(m) for m in members))
+    return sent, failures
+def format_dm_failures(failures: dict[str, list[int]]) -> str:
+    return "; ".join(f"{name} x{len(ids)} ({', '.join(map(str, ids[:10]))}{', ...' if len(ids) > 10 else ''})" for name, ids in failures.items())
+
+# --- Purchase Orders ---
+class CallBudget:
+    """Sliding one-minute window of outbound API calls."""
+    def __init__(self, per_minute: int):
+        self.per_minute = per_minute; self._calls: collections.deque[tuple[float, int]] = collections.deque(); self._used = 0
+    def used(self) -> int:
+        cutoff = time_module.monotonic() - 60
+        while self._calls and self._calls[0][0] <= cutoff: self._used -= self._calls.popleft()[1]
+        return self._used
+    def spend(self, calls: int): self.used(); self._calls.append((time_module.monotonic(), calls)); self._used += calls
+    def try_spend(self, calls: int) -> bool:
+        if self.used() + calls > self.per_minute: return False
+        self.spend(calls); return True
+order_dm_budget = CallBudget(ORDER_DM_BUDGET_PER_MINUTE) # Bot-wide: every guild's DMs count against the same rate limit
+def new_order_id() -> str: return uuid.uuid4().hex[:10]
+def order_embed(order: dict, guild_name: str | None = None) -> disnake.Embed:
+    colors = {"pending": disnake.Color.blue(), "claimed": disnake.Color.orange(), "fulfilled": disnake.Color.green(), "cancelled": disnake.Color.red()}
+    embed = disnake.Embed(title=f"🛒 Order #{order['order_id']} ({order['status'].upper()})", color=colors.get(order["status"], disnake.Color.greyple()),
+                          timestamp=datetime.datetime.fromtimestamp(order["created_at"], timezone.utc), description=f"Purchase in **{guild_name}**." if guild_name else None)
+    embed.add_field(name="Buyer", value=f"<@{order['user_id']}> (`{order['user_id']}`)", inline=False)
+    embed.add_field(name="Item", value=f"{order['item_name']} (ID: `{order.get('item_id') or 'N/A'}`)", inline=False)
+    embed.add_field(name="Payment Method", value=order["payment_method"], inline=True)
+    if order["amount"]: embed.add_field(name="In Escrow" if order["status"] in ORDER_OPEN_STATUSES else "Credit Cost", value=f"{fmt_coins(order['amount'])} coins", inline=True)
+    if order.get("claimed_by"): embed.add_field(name="Claimed By", value=f"<@{order['claimed_by']}>", inline=True)
+    embed.set_footer(text="Claim the order, coordinate with the buyer, then mark it fulfilled.")
+    return embed
+def order_button_id(action: str, order: dict) -> str: return f"order:{action}:{order['guild_id']}:{order['order_id']}" # Guild ID picks the shard
+def order_components(order: dict) -> list[disnake.ui.ActionRow]:
+    if order["status"] == "pending": buttons = [disnake.ui.Button(label="Claim", style=disnake.ButtonStyle.green, custom_id=order_button_id("claim", order))]
+    elif order["status"] == "claimed": buttons = [disnake.ui.Button(label="Mark Fulfilled", style=disnake.ButtonStyle.green, custom_id=order_button_id("fulfill", order))]
+    else: return []
+    buttons.append(disnake.ui.Button(label="Reject & Refund", style=disnake.ButtonStyle.red, custom_id=order_button_id("reject", order)))
+    return [disnake.ui.ActionRow(*buttons)]
+async def announce_order(econ: GuildEconomy, guild: disnake.Guild, order: dict) -> bool:
+    """DMs shopkeepers right away while under the per-minute budget, otherwise queues the order for the digest."""
+    shopkeepers = shopkeeper_index.members(guild)
+    if not shopkeepers: logger.warning(f"No shopkeepers for order {order['order_id']}, queued for digest."); econ.order_digest_queue.append(order["order_id"]); return False
+    if not order_dm_budget.try_spend(len(shopkeepers)):
+        logger.info(f"Order DM budget used ({order_dm_budget.used()}/{ORDER_DM_BUDGET_PER_MINUTE}/min), order {order['order_id']} queued for digest.")
+        econ.order_digest_queue.append(order["order_id"]); return False
+    with NOTIFY_SECONDS.time("announce"): sent, failures = await send_dms(shopkeepers, SHOPKEEPER_DM_CONCURRENCY, embed=order_embed(order, guild.name), components=order_components(order))
+    if failures: logger.warning(f"Order {order['order_id']} DM failures: {format_dm_failures(failures)}")
+    if not sent: econ.order_digest_queue.append(order["order_id"]); return False
+    logger.info(f"Order {order['order_id']}: notified {sent} shopkeepers."); econ.mark_orders_notified([order])
+    return True
+async def notify_order_buyer(order: dict, message: str):
+    try:
+        buyer = bot.get_user(order["user_id"]) or await bot.fetch_user(order["user_id"])
+        order_dm_budget.spend(1); await buyer.send(message)
+    except Exception as e: logger.warning(f"Could not DM buyer {order['user_id']} about order {order['order_id']}: {e}")
+async def place_order(econ: GuildEconomy, interaction: disnake.MessageInteraction, item_data: dict, payment_method: str, order_id: str) -> dict:
+    """Records the order and escrows its credits in one step; repeat calls with the same order ID return the existing order.
+    Raises InsufficientFunds."""
+    buyer_id = interaction.user.id; journal_op.set("order")
+    cost = item_data.get("credit_cost", 0) if payment_method == "Credits" else 0 # Shop prices are in coins
+    cost = to_milli(cost) if isinstance(cost, (int, float)) and not isinstance(cost, bool) and cost > 0 else 0
+    async with econ.balance_ops.hold(buyer_id): # No await below: check, debit and record happen together
+        if (existing := econ.order_book.get(order_id)) is not None: return existing
+        if cost: econ.balance_ops.debit_now(buyer_id, cost); econ.money_supply.add("escrow", cost)
+        order = econ.order_book.create(order_id, buyer_id, econ.guild_id, item_data, payment_method, cost)
+        econ.mark_dirty(buyer_id, orders=(order_id,)) # Escrow debit and order row land in the same transaction
+    logger.info(f"Order {order_id}: user {buyer_id} bought '{order['item_name']}' via {payment_method} ({fmt_coins(cost)} coins escrowed).")
+    notified = await announce_order(econ, interaction.guild, order)
+    escrow_note = f" **{fmt_coins(cost)}** coins are held in escrow until it's fulfilled." if cost else ""
+    await interaction.followup.send(f"✅ Order `#{order_id}` placed for **{order['item_name']}**!{escrow_note} " + ("Shopkeepers notified." if notified else "Shopkeepers will be notified shortly."), ephemeral=False) # Public confirmation
+    return order
+async def settle_order(econ: GuildEconomy, order_id: str, status: str, actor_id: int) -> dict:
+    """Closes an open order: 'fulfilled' spends the escrow, 'cancelled' refunds it to the buyer."""
+    order = econ.order_book.get(order_id)
+    if order is None: raise OrderStateError(f"Order {order_id} not found or already closed.")
+    journal_op.set(f"order {status}")
+    async with econ.balance_ops.hold(order["user_id"]):
+        econ.order_book.close(order_id, status, actor_id); amount = order["amount"]
+        if amount:
+            econ.money_supply.add("escrow", -amount)
+            if status == "cancelled": econ.balance_ops.credit_now(order["user_id"], amount)
+        econ.mark_dirty(order["user_id"], orders=(order_id,))
+    logger.info(f"Order {order_id} {status} by {actor_id} ({fmt_coins(amount)} coins {'refunded' if status == 'cancelled' else 'spent'}).")
+    return order
+@bot.listen("on_button_click")
+async def on_order_button(inter: disnake.MessageInteraction):
+    custom_id = inter.component.custom_id or ""
+    if not custom_id.startswith("order:"): return
+    parts = custom_id.split(":")
+    if len(parts) == 4:
+        _, action, guild_id, order_id = parts
+        try: econ = await guild_economies.get(int(guild_id))
+        except LeaseHeld: await reply_served_elsewhere(inter); return
+    else: # Pre-shard buttons (order:<action>:<order_id>) in old DMs: the order can only be in a loaded guild
+        _, action, order_id = custom_id.split(":", 2); econ = next((e for e in guild_economies.values() if e.order_book.get(order_id)), None)
+    order = econ.order_book.get(order_id) if econ else None; guild = bot.get_guild(order["guild_id"]) if order else None
+    if order is None or order["status"] not in ORDER_OPEN_STATUSES: await inter.response.send_message(f"Order #{order_id} is no longer open.", ephemeral=True); return
+    if not guild or not shopkeeper_index.contains(guild, inter.author.id): await inter.response.send_message("Only shopkeepers can manage orders.", ephemeral=True); return
+    try:
+        if action == "claim": econ.order_book.claim(order_id, inter.author.id); econ.mark_dirty(orders=(order_id,)); buyer_note = f"🛠️ Your order `#{order_id}` (**{order['item_name']}**) was claimed by a shopkeeper."
+        elif action == "fulfill": await settle_order(econ, order_id, "fulfilled", inter.author.id); buyer_note = f"✅ Your order `#{order_id}` (**{order['item_name']}**) was fulfilled."
+        elif action == "reject":
+            await settle_order(econ, order_id, "cancelled", inter.author.id)
+            buyer_note = f"❌ Your order `#{order_id}` (**{order['item_name']}**) was rejected." + (f" {fmt_coins(order['amount'])} coins were refunded." if order["amount"] else "")
+        else: await inter.response.send_message("Unknown order action.", ephemeral=True); return
+    except OrderStateError as e: await inter.response.send_message(f"❌ {e}", ephemeral=True); return
+    await inter.response.send_message(embed=order_embed(order, guild.name), components=order_components(order))
+    await notify_order_buyer(order, buyer_note)
+@tasks.loop(seconds=ORDER_DIGEST_SECONDS)
+@timed(TASK_SECONDS, "order_digest")
+async def order_digest():
+    """Sends each guild's queued orders as one digest (at least one per tick, more while the DM budget allows)."""
+    for econ in guild_economies.values():
+        if not econ.order_digest_queue: continue
+        queue = econ.order_digest_queue; guild_id = econ.guild_id
+        orders = [o for oid in dict.fromkeys(queue) if (o := econ.order_book.get(oid)) and o["status"] == "pending"]; queue.clear()
+        if not orders: continue
+        guild = bot.get_guild(guild_id); shopkeepers = shopkeeper_index.members(guild) if guild else []
+        if not shopkeepers: logger.warning(f"Order digest: no shopkeepers reachable in guild {guild_id}, keeping {len(orders)} orders queued."); queue.extend(o["order_id"] for o in orders); continue
+        for i in range(0, len(orders), ORDER_DIGEST_MAX_ORDERS):
+            chunk = orders[i:i + ORDER_DIGEST_MAX_ORDERS]
+            if i and not order_dm_budget.try_spend(len(shopkeepers)): queue.extend(o["order_id"] for o in orders[i:]); break
+            if not i: order_dm_budget.spend(len(shopkeepers))
+            lines = [f"`#{o['order_id']}` **{o['item_name']}** for <@{o['user_id']}> ({o['payment_method']}" + (f", {fmt_coins(o['amount'])} coins" if o["amount"] else "") + f") <t:{int(o['created_at'])}:R>" for o in chunk]
+            embed = disnake.Embed(title=f"🛒 {len(chunk)} New Orders", color=disnake.Color.blue(), timestamp=datetime.datetime.now(timezone.utc), description="\n".join(lines)[:4096])
+            buttons = [disnake.ui.Button(label=f"Claim #{o['order_id']}", style=disnake.ButtonStyle.green, custom_id=order_button_id("claim", o)) for o in chunk]
+            with NOTIFY_SECONDS.time("digest"): sent, failures = await send_dms(shopkeepers, SHOPKEEPER_DM_CONCURRENCY, embed=embed, components=[disnake.ui.ActionRow(*buttons[j:j + 5]) for j in range(0, len(buttons), 5)])
+            if failures: logger.warning(f"Order digest DM failures: {format_dm_failures(failures)}")
+            if sent: econ.mark_orders_notified(chunk); logger.info(f"Order digest: {len(chunk)} orders sent to {sent} shopkeepers in guild {guild_id}.")
+            else: queue.extend(o["order_id"] for o in chunk)
+@order_digest.before_loop
+async def before_order_digest(): await bot.wait_until_ready()
 
 # --- Shop Views ---
 class PaymentMethodView(disnake.ui.View):
     def __init__(self, item_data: dict, original_user_id: int):
         super().__init__(timeout=180)
         self.item_data = item_data; self.original_user_id = original_user_id; self.payment_chosen = False
+        self.order_id = new_order_id() # One order per view: repeated or concurrent clicks resolve to the same order
         self.pay_credits_button = disnake.ui.Button(label="Pay with Credits", style=disnake.ButtonStyle.green, custom_id="pay_credits"); self.pay_credits_button.callback = self.pay_credits_callback; self.add_item(self.pay_credits_button)
         self.pay_usd_button = disnake.ui.Button(label="Pay with USD/Other", style=disnake.ButtonStyle.blurple, custom_id="pay_usd"); self.pay_usd_button.callback = self.pay_usd_callback
         usd_price = self.item_data.get("usd_price")
         if not isinstance(usd_price, (int, float)) or usd_price <= 0: self.pay_usd_button.disabled = True; self.pay_usd_button.label = "USD Payment (N/A)"
         self.add_item(self.pay_usd_button)
+    async def on_error(self, error: Exception, item: disnake.ui.Item, interaction: disnake.MessageInteraction):
+        if isinstance(error, LeaseHeld): await reply_served_elsewhere(interaction)
+        else: await super().on_error(error, item, interaction)
     async def interaction_check(self, interaction: disnake.MessageInteraction) -> bool:
         if interaction.user.id != self.original_user_id: await interaction.response.send_message("Not yours!", ephemeral=True); return False
         if self.payment_chosen: await interaction.response.send_message("Chosen.", ephemeral=True); return False
@@ -410,17 +1101,15 @@ class PaymentMethodView(disnake.ui.View):
     async def pay_credits_callback(self, interaction: disnake.MessageInteraction):
         if await self.interaction_check(interaction) is False: return
         await interaction.response.defer(ephemeral=True, with_message=False)
-        user_id = interaction.user.id; udata = get_user_data(user_id)
-        cost = self.item_data.get("credit_cost", 0); current_balance = udata.get("balance", 0)
-        if not isinstance(current_balance, (int, float)): current_balance = 0
-        if current_balance >= cost:
-            logger.info(f"User {user_id} attempting buy '{self.item_data.get('name','?')}' with credits.")
-            await notify_shopkeepers(interaction, self.item_data, "Credits")
-            await self.disable_buttons(interaction)
-        else:
+        user_id = interaction.user.id; econ = await guild_economies.get(interaction.guild.id) # Fetched per click: the view may outlive the shard
+        if (existing := econ.order_book.get(self.order_id)) is not None: await interaction.followup.send(f"Order `#{existing['order_id']}` is already placed.", ephemeral=True); return
+        logger.info(f"User {user_id} attempting buy '{self.item_data.get('name','?')}' with credits.")
+        try: await place_order(econ, interaction, self.item_data, "Credits", self.order_id)
+        except InsufficientFunds as e:
             logger.info(f"User {user_id} failed buy - Insufficient credits.")
             await self.disable_buttons(interaction)
-            await interaction.followup.send(f"❌ Insufficient credits ({int(current_balance):,}/{cost:,}).", ephemeral=True)
+            await interaction.followup.send(f"❌ Insufficient credits ({fmt_coins(e.available)}/{fmt_coins(e.required)}).", ephemeral=True); return
+        await self.disable_buttons(interaction)
     async def pay_usd_callback(self, interaction: disnake.MessageInteraction):
         if await self.interaction_check(interaction) is False: return
         await interaction.response.defer(ephemeral=True, with_message=False)
@@ -428,25 +1117,17 @@ class PaymentMethodView(disnake.ui.View):
         usd_price = self.item_data.get("usd_price")
         if not isinstance(usd_price, (int, float)) or usd_price <= 0:
             await interaction.followup.send("❌ Item not available for USD.", ephemeral=True); await self.disable_buttons(interaction); return
-        await notify_shopkeepers(interaction, self.item_data, "USD/Other")
+        econ = await guild_economies.get(interaction.guild.id)
+        if (existing := econ.order_book.get(self.order_id)) is not None: await interaction.followup.send(f"Order `#{existing['order_id']}` is already placed.", ephemeral=True); return
+        await place_order(econ, interaction, self.item_data, "USD/Other", self.order_id)
         await self.disable_buttons(interaction)
 
 class DynamicShopView(disnake.ui.View):
-    def __init__(self): super().__init__(timeout=None); self.populate_items()
-    def get_active_items(self) -> list[tuple[str, dict]]:
-        load_shop_items(); active = []
-        now_utc = datetime.datetime.now(timezone.utc)
-        for item_id, item in shop_items.items():
-             if not isinstance(item, dict) or 'name' not in item or 'credit_cost' not in item: continue
-             is_expired = False
-             if expires_at_str := item.get("expires_at"):
-                 try:
-                     expires_at_dt = datetime.datetime.fromisoformat(expires_at_str.replace('Z', '+00:00'))
-                     if expires_at_dt.tzinfo is None: expires_at_dt = expires_at_dt.replace(tzinfo=timezone.utc)
-                     if now_utc >= expires_at_dt: is_expired = True
-                 except Exception: logger.error(f"Invalid date for {item_id}")
-             if not is_expired: active.append((item_id, item))
-        active.sort(key=lambda i: i[1].get('name', '').lower()); return active
+    def __init__(self, econ: GuildEconomy): super().__init__(timeout=None); self.guild_id = econ.guild_id; self.active_items = econ.shop_catalog.active_items(); self.populate_items()
+    async def on_error(self, error: Exception, item: disnake.ui.Item, interaction: disnake.MessageInteraction):
+        if isinstance(error, LeaseHeld): await reply_served_elsewhere(interaction)
+        else: await super().on_error(error, item, interaction)
+    def get_active_items(self) -> list[tuple[str, dict]]: return self.active_items
     def populate_items(self):
         self.clear_items(); active_items = self.get_active_items(); count = 0
         for i, (item_id, item) in enumerate(active_items, 1):
@@ -462,16 +1143,16 @@ class DynamicShopView(disnake.ui.View):
         custom_id = interaction.component.custom_id
         if not custom_id or not custom_id.startswith("shop_item_"): await interaction.response.send_message("Invalid button.", ephemeral=True); return
         item_id = custom_id.split("shop_item_")[-1]
-        load_shop_items(); item_data = shop_items.get(item_id)
-        if not item_data: await interaction.response.send_message("Item not found.", ephemeral=True); return
+        item_data = (await guild_economies.get(self.guild_id)).shop_catalog.get_active(item_id)
+        if not item_data: await interaction.response.send_message("Item not found or expired.", ephemeral=True); return
         if not is_shop_open(): await interaction.response.send_message(f"Shop closed.", ephemeral=True); return
         payment_view = PaymentMethodView(item_data, interaction.user.id)
         await interaction.response.send_message(f"Pay for **{item_data.get('name','?')}**:", view=payment_view, ephemeral=True)
 
 # --- Shop Command ---
-@bot.slash_command(name="shop", description="Browse items available for purchase.")
+@bot.slash_command(name="shop", description="Browse items available for purchase.", dm_permission=False)
 async def shop(interaction: disnake.ApplicationCommandInteraction):
-    shop_view = DynamicShopView()
+    shop_view = DynamicShopView(await guild_economies.get(interaction.guild.id))
     embed = disnake.Embed(title="🛒 Shop 🛒", color=disnake.Color.blurple())
     description_lines = []
     active_items = shop_view.get_active_items()
@@ -489,29 +1170,42 @@ async def shop(interaction: disnake.ApplicationCommandInteraction):
     await interaction.response.send_message(embed=embed, view=shop_view, ephemeral=False)
 
 # --- Balance Command ---
-@bot.slash_command(name="balance", description="Check your current coin balance.")
+@bot.slash_command(name="balance", description="Check your current coin balance.", dm_permission=False)
 async def balance(inter: disnake.ApplicationCommandInteraction):
-    udata = get_user_data(inter.author.id); current_balance = udata.get("balance", 0)
-    if not isinstance(current_balance, (int, float)): current_balance = 0
-    await inter.response.send_message(f"💰 Your balance: **{int(current_balance):,}** coins.", ephemeral=True)
+    econ = await guild_economies.get(inter.guild.id)
+    await inter.response.send_message(f"💰 Your balance: **{fmt_coins(econ.get_user_data(inter.author.id).balance)}** coins.", ephemeral=True)
 
 # --- Pay Command ---
-@bot.slash_command(name="pay", description="Give coins to another user.")
+@bot.slash_command(name="pay", description="Give coins to another user.", dm_permission=False)
 async def pay( inter: disnake.ApplicationCommandInteraction, user: disnake.Member, amount: int = commands.Param(gt=0) ):
     sender = inter.author; recipient = user; amount = abs(amount)
     if sender.id == recipient.id: await inter.response.send_message("❌ Cannot pay yourself!", ephemeral=True); return
     if recipient.bot: await inter.response.send_message("❌ Cannot pay bots!", ephemeral=True); return
-    sender_data = get_user_data(sender.id); recipient_data = get_user_data(recipient.id)
-    sender_balance = sender_data.get("balance", 0)
-    if not isinstance(sender_balance, (int, float)): sender_balance = 0
-    if sender_balance < amount: await inter.response.send_message(f"❌ Insufficient funds ({int(sender_balance):,}).", ephemeral=True); return
-    sender_data["balance"] -= amount
-    if not isinstance(recipient_data.get("balance"), (int, float)): recipient_data["balance"] = 0
-    recipient_data["balance"] += amount
-    save_user_data() # Save immediately
+    econ = await guild_economies.get(inter.guild.id)
+    try: await econ.balance_ops.transfer(sender.id, recipient.id, to_milli(amount)) # Both rows change (and are flushed) together or not at all
+    except InsufficientFunds as e: await inter.response.send_message(f"❌ Insufficient funds ({fmt_coins(e.available)}).", ephemeral=True); return
     logger.info(f"User {sender.id} paid {amount} coins to {recipient.id}.")
     await inter.response.send_message(f"💸 {sender.mention} paid **{amount:,}** coins to {recipient.mention}!", allowed_mentions=disnake.AllowedMentions(users=[sender, recipient]), ephemeral=False) # Public confirmation
 
+# --- Leaderboard Command ---
+def render_leaderboard(econ: GuildEconomy, board: str) -> disnake.Embed:
+    """Top-K embed for a guild's board, shared by all callers for LEADERBOARD_CACHE_SECONDS."""
+    now = time_module.monotonic()
+    if (cached := econ.leaderboard_cache.get(board)) and cached[0] > now: return cached[1]
+    index = econ.rank_indexes[board]; medals = {1: "🥇", 2: "🥈", 3: "🥉"}
+    lines = [f"{medals.get(pos, f'**{pos}.**')} <@{uid}> - {fmt_coins(score)} coins" for pos, (uid, score) in enumerate(index.top(LEADERBOARD_SIZE), 1)]
+    embed = disnake.Embed(title=f"🏆 Leaderboard: {LEADERBOARDS[board]}", color=disnake.Color.gold(), description="\n".join(lines) or "*No players yet.*",
+                          timestamp=datetime.datetime.now(timezone.utc))
+    embed.set_footer(text=f"{len(index):,} players ranked")
+    econ.leaderboard_cache[board] = (now + LEADERBOARD_CACHE_SECONDS, embed)
+    return embed
+@bot.slash_command(name="leaderboard", description="Show the richest players and your rank.", dm_permission=False)
+async def leaderboard(inter: disnake.ApplicationCommandInteraction, board: str = commands.Param(default="balance", choices={label: key for key, label in LEADERBOARDS.items()})):
+    econ = await guild_economies.get(inter.guild.id); index = econ.rank_indexes[board]
+    embed = render_leaderboard(econ, board).copy(); rank = index.rank(inter.author.id); score = index.score(inter.author.id)
+    embed.add_field(name="Your Rank", value=f"#{rank:,} of {len(index):,} ({fmt_coins(score)} coins)" if rank else "Unranked", inline=False)
+    await inter.response.send_message(embed=embed, allowed_mentions=disnake.AllowedMentions.none())
+
 # --- Admin Cog ---
 class ShopAdminCog(commands.Cog):
     def __init__(self, bot: commands.Bot): self.bot = bot
@@ -532,7 +1226,7 @@ class ShopAdminCog(commands.Cog):
     async def shopadmin(self, inter: disnake.ApplicationCommandInteraction): pass
     @shopadmin.sub_command(name="list", description="List all shop items.")
     async def shopadmin_list(self, inter: disnake.ApplicationCommandInteraction):
-        load_shop_items();
+        shop_items = (await guild_economies.get(inter.guild.id)).shop_items
         if not shop_items: await inter.response.send_message("No items.", ephemeral=True); return
         embeds = []; current_desc = ""; items_in_page = 0; max_items = 5
         now_utc = datetime.datetime.now(timezone.utc)
@@ -548,8 +1242,7 @@ class ShopAdminCog(commands.Cog):
              expires = "Never"; is_expired = False
              if exp_str := item.get("expires_at"):
                  try:
-                     exp_dt = datetime.datetime.fromisoformat(exp_str.replace('Z', '+00:00'))
-                     if exp_dt.tzinfo is None: exp_dt = exp_dt.replace(tzinfo=timezone.utc)
+                     exp_dt = parse_shop_expiry(exp_str)
                      if now_utc >= exp_dt: is_expired = True; expires = f"Expired <t:{int(exp_dt.timestamp())}:R>"
                      else: expires = f"Expires <t:{int(exp_dt.timestamp())}:R>"
                  except Exception: expires = f"Invalid Date ({exp_str})"
@@ -562,9 +1255,9 @@ class ShopAdminCog(commands.Cog):
         await inter.response.send_message(embed=embeds[0], ephemeral=True)
     @shopadmin.sub_command(name="remove", description="Remove an item.")
     async def shopadmin_remove(self, inter: disnake.ApplicationCommandInteraction, item_id: str):
-        item_id = item_id.strip(); load_shop_items()
-        if item_id in shop_items:
-            name = shop_items[item_id].get('name', '?'); del shop_items[item_id]; save_shop_items()
+        item_id = item_id.strip(); econ = await guild_economies.get(inter.guild.id)
+        if item_id in econ.shop_items:
+            name = econ.shop_items[item_id].get('name', '?'); del econ.shop_items[item_id]; econ.shop_catalog.invalidate(); await econ.save_shop_items_async()
             logger.info(f"Admin {inter.author} removed item '{name}' ({item_id})")
             await inter.response.send_message(f"✅ Removed '{name}'.", ephemeral=True)
         else: await inter.response.send_message(f"❌ ID `{item_id}` not found.", ephemeral=True)
@@ -577,10 +1270,10 @@ class ShopAdminCog(commands.Cog):
                            disnake.ui.TextInput(label="Unique ID (Optional)", placeholder="Auto if blank", custom_id="item_unique_id", required=False) ]
             super().__init__(title="Add Shop Item", components=components, custom_id="shop_add_item_modal")
         async def callback(self, inter: disnake.ModalInteraction):
-            await inter.response.defer(ephemeral=True); load_shop_items()
+            await inter.response.defer(ephemeral=True)
             name = inter.text_values["item_name"].strip(); cost_str = inter.text_values["item_credit_cost"].strip()
             usd_str = inter.text_values["item_usd_price"].strip(); dur_str = inter.text_values["item_duration"].strip().lower()
-            custom_id = inter.text_values["item_unique_id"].strip()
+            custom_id = inter.text_values["item_unique_id"].strip(); econ = await guild_economies.get(inter.guild.id); shop_items = econ.shop_items
             try: cost = int(cost_str); assert cost >= 0
             except Exception: await inter.followup.send("❌ Invalid Credit Cost.", ephemeral=True); return
             usd = None
@@ -610,7 +1303,7 @@ class ShopAdminCog(commands.Cog):
             item = {"id": uid, "name": name, "credit_cost": cost, "usd_price": usd,
                     "expires_at": expires.isoformat(timespec='seconds').replace('+00:00', 'Z') if expires else None,
                     "added_by": inter.author.id, "added_at": datetime.datetime.now(timezone.utc).isoformat(timespec='seconds').replace('+00:00', 'Z') }
-            shop_items[uid] = item; save_shop_items()
+            shop_items[uid] = item; econ.shop_catalog.invalidate(); await econ.save_shop_items_async()
             logger.info(f"Admin {inter.author} added item '{name}' ({uid})")
             await inter.followup.send(f"✅ Added **{name}** (`{uid}`).", ephemeral=True)
     @shopadmin.sub_command(name="add", description="Add item via modal.")
@@ -622,50 +1315,127 @@ class ShopAdminCog(commands.Cog):
     @admincoins.sub_command(name="give", description="Give coins.")
     async def admincoins_give(self, inter: disnake.ApplicationCommandInteraction, user: disnake.Member, amount: int = commands.Param(ge=1)):
         if user.bot: await inter.response.send_message("❌ Cannot mod bot.", ephemeral=True); return
-        udata = get_user_data(user.id);
-        if not isinstance(udata["balance"], (int, float)): udata["balance"] = 0
-        udata["balance"] += amount
+        udata = await (await guild_economies.get(inter.guild.id)).balance_ops.credit(user.id, to_milli(amount))
         logger.info(f"Admin {inter.author} gave {amount} to {user.id}.")
-        save_user_data()
-        await inter.response.send_message(f"✅ Gave {amount:,} to {user.mention}. Bal: {int(udata['balance']):,}.", ephemeral=True, allowed_mentions=disnake.AllowedMentions.none())
+        await inter.response.send_message(f"✅ Gave {amount:,} to {user.mention}. Bal: {fmt_coins(udata.balance)}.", ephemeral=True, allowed_mentions=disnake.AllowedMentions.none())
     @admincoins.sub_command(name="take", description="Take coins.")
     async def admincoins_take(self, inter: disnake.ApplicationCommandInteraction, user: disnake.Member, amount: int = commands.Param(ge=1)):
         if user.bot: await inter.response.send_message("❌ Cannot mod bot.", ephemeral=True); return
-        udata = get_user_data(user.id);
-        if not isinstance(udata["balance"], (int, float)): udata["balance"] = 0
-        original = udata["balance"]; taken = min(amount, original)
-        udata["balance"] -= taken
-        logger.info(f"Admin {inter.author} took {taken} from {user.id}.")
-        save_user_data()
-        await inter.response.send_message(f"✅ Took {taken:,} from {user.mention}. Bal: {int(udata['balance']):,}.", ephemeral=True, allowed_mentions=disnake.AllowedMentions.none())
+        econ = await guild_economies.get(inter.guild.id)
+        async with econ.balance_ops.hold(user.id):
+            taken = max(0, min(to_milli(amount), econ.get_user_data(user.id).balance)); udata = econ.balance_ops.debit_now(user.id, taken)
+        logger.info(f"Admin {inter.author} took {fmt_coins(taken)} from {user.id}.")
+        await inter.response.send_message(f"✅ Took {fmt_coins(taken)} from {user.mention}. Bal: {fmt_coins(udata.balance)}.", ephemeral=True, allowed_mentions=disnake.AllowedMentions.none())
     @admincoins.sub_command(name="set", description="Set balance.")
     async def admincoins_set(self, inter: disnake.ApplicationCommandInteraction, user: disnake.Member, amount: int = commands.Param(ge=0)):
         if user.bot: await inter.response.send_message("❌ Cannot mod bot.", ephemeral=True); return
-        udata = get_user_data(user.id); udata["balance"] = amount
-        logger.info(f"Admin {inter.author} set {user.id}'s bal to {amount}.")
-        save_user_data()
+        econ = await guild_economies.get(inter.guild.id)
+        async with econ.balance_ops.hold(user.id): econ.set_balance(user.id, to_milli(amount)); econ.save_user_data(user.id) # Waits out an in-flight round/transfer
+        logger.info(f"Admin {inter.author} set {user.id}'s bal to {amount} in guild {econ.guild_id}.")
         await inter.response.send_message(f"✅ Set {user.mention}'s bal to {amount:,}.", ephemeral=True, allowed_mentions=disnake.AllowedMentions.none())
     @admincoins.sub_command(name="setjackpot", description="Set jackpot pool amount.")
     async def admincoins_setjackpot(self, inter: disnake.ApplicationCommandInteraction, amount: float = commands.Param(ge=0.0)):
-        load_bot_data()
-        if 'slot_jackpot_pool' not in bot_data or not isinstance(bot_data['slot_jackpot_pool'], float): bot_data['slot_jackpot_pool'] = 0.0
-        bot_data["slot_jackpot_pool"] = float(amount)
-        save_bot_data()
-        logger.info(f"Admin {inter.author} set jackpot pool to {amount:.2f}.")
-        await inter.response.send_message(f"✅ Set jackpot to {amount:,.2f}.", ephemeral=True)
+        econ = await guild_economies.get(inter.guild.id); econ.set_pool("slot_jackpot_pool", to_milli(amount))
+        econ.save_bot_data()
+        logger.info(f"Admin {inter.author} set guild {econ.guild_id} jackpot pool to {fmt_coins(econ.bot_data['slot_jackpot_pool'])}.")
+        await inter.response.send_message(f"✅ Set jackpot to {fmt_coins(econ.bot_data['slot_jackpot_pool'])}.", ephemeral=True)
     @admincoins.sub_command(name="setjackpotcontribution", description="Set % of slot loss added to jackpot (0-100).")
     async def admincoins_setjackpotcontribution(self, inter: disnake.ApplicationCommandInteraction, percentage: float = commands.Param(ge=0.0, le=100.0)):
-        load_bot_data(); new_rate = percentage / 100.0
-        bot_data["slot_jackpot_contribution"] = new_rate; save_bot_data()
+        new_rate = percentage / 100.0
+        econ = await guild_economies.get(inter.guild.id); econ.bot_data["slot_jackpot_contribution"] = new_rate; econ.save_bot_data()
         logger.info(f"Admin {inter.author} set jackpot contribution rate to {new_rate:.1%}.")
         await inter.response.send_message(f"✅ Set jackpot contribution rate to **{percentage:.1f}%**.", ephemeral=True)
     @admincoins.sub_command(name="setjackpotchance", description="Set % override chance for jackpot win (0=off).")
     async def admincoins_setjackpotchance(self, inter: disnake.ApplicationCommandInteraction, percentage: float = commands.Param(ge=0.0, le=100.0)):
-        load_bot_data(); new_override_rate = percentage / 100.0
-        bot_data["slot_jackpot_override_chance"] = new_override_rate; save_bot_data()
+        new_override_rate = percentage / 100.0
+        econ = await guild_economies.get(inter.guild.id); econ.bot_data["slot_jackpot_override_chance"] = new_override_rate; econ.save_bot_data()
         logger.info(f"Admin {inter.author} set jackpot override chance to {new_override_rate:.1%}.")
         if new_override_rate > 0: await inter.response.send_message(f"✅ Set jackpot override chance to **{percentage:.1f}%**.", ephemeral=True)
         else: await inter.response.send_message(f"✅ Disabled jackpot override chance.", ephemeral=True)
+    @admincoins.sub_command(name="setresetthreshold", description="Set the money supply at which this server's economy resets.")
+    async def admincoins_setresetthreshold(self, inter: disnake.ApplicationCommandInteraction, amount: int = commands.Param(ge=1)):
+        econ = await guild_economies.get(inter.guild.id); threshold = to_milli(amount)
+        if threshold <= econ.money_supply.total: await inter.response.send_message(f"❌ Must be above the current money supply ({fmt_coins(econ.money_supply.total)}), or the economy would reset at once.", ephemeral=True); return
+        econ.bot_data["economy_reset_threshold"] = threshold; econ.money_supply.threshold = threshold; econ.save_bot_data()
+        logger.info(f"Admin {inter.author} set guild {econ.guild_id} reset threshold to {fmt_coins(threshold)}.")
+        await inter.response.send_message(f"✅ Economy resets when the money supply reaches **{fmt_coins(threshold)}** coins.", ephemeral=True)
+    @admincoins.sub_command(name="setlotteryinterval", description="Set hours between a lottery round's first ticket and its draw.")
+    async def admincoins_setlotteryinterval(self, inter: disnake.ApplicationCommandInteraction, hours: float = commands.Param(gt=0, le=24 * 30)):
+        econ = await guild_economies.get(inter.guild.id); econ.bot_data["lottery_interval_hours"] = hours; econ.save_bot_data()
+        logger.info(f"Admin {inter.author} set guild {econ.guild_id} lottery interval to {hours:g}h.")
+        await inter.response.send_message(f"✅ Lottery draws **{hours:g}** hours after a round's first ticket (from the next round).", ephemeral=True)
+
+    @admincoins.sub_command(name="simulate", description="Monte Carlo RTP / jackpot projection for a game with the current (or given) settings.")
+    async def admincoins_simulate(self, inter: disnake.ApplicationCommandInteraction, game: str = commands.Param(choices=["slots", "dice", "redblack"]),
+                                  rounds: int = commands.Param(default=1_000_000, ge=1000, le=SIMULATE_MAX_ROUNDS), bet: int = commands.Param(default=100, ge=1),
+                                  contribution: float = commands.Param(default=None, ge=0.0, le=100.0, description="Jackpot contribution % (default: current)."),
+                                  chance: float = commands.Param(default=None, ge=0.0, le=100.0, description="Jackpot override chance % (default: current)."),
+                                  rounds_per_hour: float = commands.Param(default=1000.0, gt=0, description="Play rate used for the time-to-reset estimate.")):
+        econ = await guild_economies.get(inter.guild.id); contribution_rate, override_chance = slot_settings(econ)
+        if contribution is not None: contribution_rate = contribution / 100.0
+        if chance is not None: override_chance = chance / 100.0
+        await inter.response.defer(ephemeral=True)
+        report = await asyncio.to_thread(games.simulate, game, rounds, bet, contribution_rate, override_chance, to_coins(econ.bot_data.get("slot_jackpot_pool", 0))) # CPU-bound, keep it off the loop
+        settings = f"contribution {contribution_rate:.1%}, override {override_chance:.2%}, " if game == "slots" else ""
+        embed = disnake.Embed(title=f"🧪 {game.capitalize()} Simulation", color=disnake.Color.purple(), description="\n".join(report.lines(to_coins(econ.reset_threshold()), to_coins(econ.money_supply.total), rounds_per_hour))[:4096])
+        embed.set_footer(text=f"{settings}supply {fmt_coins(econ.money_supply.total)} / reset at {fmt_coins(econ.reset_threshold())}")
+        logger.info(f"Admin {inter.author} simulated {game} x{rounds} (RTP {report.rtp:.4%}, {report.elapsed:.2f}s).")
+        await inter.edit_original_message(embed=embed)
+
+    @admincoins.sub_command(name="stats", description="Show this server's money supply and persistence stats.")
+    async def admincoins_stats(self, inter: disnake.ApplicationCommandInteraction, reconcile: bool = commands.Param(default=False, description="Verify running totals with a full scan first.")):
+        drift_line = ""; econ = await guild_economies.get(inter.guild.id); money_supply = econ.money_supply
+        if reconcile: drift = econ.reconcile_money_supply(); drift_line = f"\nReconciled now: drift {drift:+,} milli ({money_supply.last_reconcile_ms:.1f} ms)."
+        comps = money_supply.components; total = money_supply.total
+        embed = disnake.Embed(title="📊 Economy Stats", color=disnake.Color.teal(), timestamp=datetime.datetime.now(timezone.utc))
+        embed.add_field(name="Money Supply", value=f"{fmt_coins(total)}\n{total / econ.reset_threshold():.6%} of reset threshold ({fmt_coins(econ.reset_threshold())})", inline=False)
+        embed.add_field(name="Balances", value=fmt_coins(comps['balance']), inline=True); embed.add_field(name="Savings", value=fmt_coins(comps['savings']), inline=True)
+        embed.add_field(name="Jackpot Pool", value=fmt_coins(comps['slot_jackpot_pool']), inline=True); embed.add_field(name="Lottery Pot", value=fmt_coins(comps['lottery_pot']), inline=True)
+        embed.add_field(name="Order Escrow", value=f"{fmt_coins(comps['escrow'])} ({len(econ.order_book.open_orders()):,} open, {len(econ.order_digest_queue):,} queued)", inline=True)
+        embed.add_field(name="Users", value=f"{len(econ.user_data):,}", inline=True)
+        last = f"<t:{int(money_supply.last_reconcile_at)}:R> (drift {money_supply.last_reconcile_drift:+,} milli)" if money_supply.last_reconcile_at else "Never"
+        embed.add_field(name="Last Reconcile", value=last + drift_line, inline=False)
+        embed.add_field(name="Persistence", value=f"`{econ.write_buffer.summary()}`", inline=False)
+        embed.add_field(name="Journal", value=f"`{econ.journal.summary()}`", inline=False)
+        embed.add_field(name="Message Rewards", value=f"`{econ.message_rewards.summary()}`", inline=False)
+        embed.add_field(name="Guild Economies", value=f"`{guild_economies.summary()}`", inline=False)
+        embed.add_field(name="Slot Animations", value=f"`{animation_scheduler.summary()}`", inline=False)
+        embed.add_field(name="Logging", value=f"`{log_pipeline.summary()}`", inline=False)
+        await inter.response.send_message(embed=embed, ephemeral=True)
+
+    @admincoins.sub_command(name="perf", description="Show command, persistence and background task latency (p50/p95/p99).")
+    async def admincoins_perf(self, inter: disnake.ApplicationCommandInteraction):
+        embed = disnake.Embed(title="⏱️ Performance", color=disnake.Color.dark_teal(), timestamp=datetime.datetime.now(timezone.utc))
+        for title, histogram, limit in (("Commands", COMMAND_SECONDS, 12), ("Persistence", IO_SECONDS, 8), ("Background Tasks", TASK_SECONDS, 12), ("Shopkeeper DMs", NOTIFY_SECONDS, 2), ("Guild Economies", GUILD_ECONOMY_SECONDS, 2)):
+            embed.add_field(name=title, value=perf_table(histogram, limit), inline=False)
+        errors = sorted(COMMAND_ERRORS.values.items(), key=lambda kv: -kv[1])[:5]
+        if errors: embed.add_field(name="Command Errors (since start)", value="\n".join(f"`{cmd}`: {int(n)}× {err}" for (cmd, err), n in errors), inline=False)
+        embed.set_footer(text=f"Last {METRICS_WINDOW_MINUTES:g} min, this process ({cluster.owner}) · p50/p95/p99 in ms")
+        await inter.response.send_message(embed=embed, ephemeral=True)
+
+    @admincoins.sub_command(name="scanstatus", description="Show retroactive message scan progress.")
+    async def admincoins_scanstatus(self, inter: disnake.ApplicationCommandInteraction):
+        progress = scan_progress
+        if not progress: await inter.response.send_message("Retro scan has not started.", ephemeral=True); return
+        colors = {"running": disnake.Color.blue(), "finished": disnake.Color.green(), "cancelled": disnake.Color.orange(), "failed": disnake.Color.red()}
+        embed = disnake.Embed(title=f"🔎 Retro Scan: {progress.state.upper()}", color=colors.get(progress.state, disnake.Color.greyple()), description=progress.summary())
+        embed.add_field(name="Attempt", value=f"{progress.attempt}/{SCAN_MAX_RESTARTS + 1}", inline=True)
+        embed.add_field(name="Workers", value=f"{len(progress.active)}/{SCAN_CONCURRENCY} busy", inline=True)
+        embed.add_field(name="Checkpointed Channels", value=f"{len((await guild_economies.get(inter.guild.id)).scan_checkpoints()):,}", inline=True)
+        if progress.active: embed.add_field(name="Scanning Now", value=", ".join(list(progress.active.values())[:10])[:1024], inline=False)
+        if progress.error: embed.add_field(name="Last Error", value=progress.error[:1024], inline=False)
+        await inter.response.send_message(embed=embed, ephemeral=True)
+    @admincoins.sub_command(name="scancontrol", description="Cancel or restart the background message scan.")
+    async def admincoins_scancontrol(self, inter: disnake.ApplicationCommandInteraction, action: str = commands.Param(choices=["cancel", "restart"])):
+        running = retro_scan_task is not None and not retro_scan_task.done()
+        if action == "cancel":
+            if not running: await inter.response.send_message("No scan is running.", ephemeral=True); return
+            retro_scan_task.cancel(); logger.info(f"Admin {inter.author} cancelled the retro scan.")
+            await inter.response.send_message("🛑 Retro scan cancelled. Finished channels keep their credits; restart resumes from checkpoints.", ephemeral=True)
+        else:
+            if running: await inter.response.send_message("A scan is already running.", ephemeral=True); return
+            start_retro_scan(); logger.info(f"Admin {inter.author} restarted the retro scan.")
+            await inter.response.send_message("🔁 Retro scan restarted (incremental from checkpoints).", ephemeral=True)
 
     # --- Manual Economy Reset Command ---
     class ConfirmResetView(disnake.ui.View):
@@ -697,149 +1467,262 @@ class ShopAdminCog(commands.Cog):
                     await message.edit(content="⌛ Economy reset confirmation timed out.", view=self)
              except (disnake.NotFound, disnake.HTTPException): pass
 
-    @commands.slash_command(name="reseteconomy", description="[DANGEROUS] Reset all user balances/savings and pools.")
+    @commands.slash_command(name="reseteconomy", description="[DANGEROUS] Reset this server's balances/savings and pools.")
     async def reseconomy(self, inter: disnake.ApplicationCommandInteraction):
         view = self.ConfirmResetView(inter)
         await inter.response.send_message(
             "**⚠️ ARE YOU ABSOLUTELY SURE? ⚠️**\n"
-            f"Reset ALL user balances to **{INITIAL_STARTING_BALANCE:,}**, clear savings, reset pools.\n"
+            f"Reset ALL of this server's balances to **{fmt_coins(INITIAL_STARTING_BALANCE)}**, clear savings, reset pools.\n"
             "**THIS CANNOT BE UNDONE.** Confirm within 60 seconds.",
             view=view, ephemeral=True
         )
         await view.wait()
         if view.confirmed:
-             await perform_economy_reset(triggered_by=f"Manual command by {inter.author}") # Use helper
+             await perform_economy_reset(await guild_economies.get(inter.guild.id), triggered_by=f"Manual command by {inter.author}") # Use helper
              await inter.followup.send("✅ Economy reset complete.", ephemeral=True)
 
 # --- Savings Account Commands ---
-@bot.slash_command(name="savings", description="Manage savings.")
+@bot.slash_command(name="savings", description="Manage savings.", dm_permission=False)
 async def savings_base(inter: disnake.ApplicationCommandInteraction): pass
 @savings_base.sub_command(name="codeset", description="Set/reset 4-digit PIN.")
 async def savings_codeset(inter: disnake.ApplicationCommandInteraction, pin: str = commands.Param(min_length=4, max_length=4)):
     pin = pin.strip()
     if not pin.isdigit(): await inter.response.send_message("❌ PIN must be 4 digits.", ephemeral=True); return
-    udata = get_user_data(inter.author.id); old = udata.get("pin"); udata["pin"] = pin
+    econ = await guild_economies.get(inter.guild.id); udata = econ.get_user_data(inter.author.id); old = udata.pin; udata.pin = pin
     msg = "reset" if old else "set"; logger.info(f"User {inter.author} {msg} PIN.")
-    save_user_data(); await inter.response.send_message(f"✅ PIN {msg}.", ephemeral=True)
+    econ.save_user_data(inter.author.id); await inter.response.send_message(f"✅ PIN {msg}.", ephemeral=True)
 @savings_base.sub_command(name="balance", description="Check savings balance.")
 async def savings_balance(inter: disnake.ApplicationCommandInteraction, pin: str = commands.Param(min_length=4, max_length=4)):
-    pin = pin.strip(); udata = get_user_data(inter.author.id)
-    if udata.get("pin") is None: await inter.response.send_message("❌ No PIN set.", ephemeral=True); return
-    if udata.get("pin") != pin: await inter.response.send_message("❌ Incorrect PIN.", ephemeral=True); return
-    bal = udata.get('savings', 0);
-    if not isinstance(bal, (int, float)): bal = 0
-    await inter.response.send_message(f"💰 Savings: {int(bal):,} coins.", ephemeral=True)
+    pin = pin.strip(); econ = await guild_economies.get(inter.guild.id); udata = econ.get_user_data(inter.author.id)
+    if udata.pin is None: await inter.response.send_message("❌ No PIN set.", ephemeral=True); return
+    if udata.pin != pin: await inter.response.send_message("❌ Incorrect PIN.", ephemeral=True); return
+    await inter.response.send_message(f"💰 Savings: {fmt_coins(udata.savings)} coins.", ephemeral=True)
 @savings_base.sub_command(name="deposit", description="Deposit to savings.")
 async def savings_deposit(inter: disnake.ApplicationCommandInteraction, amount: int = commands.Param(gt=0), pin: str = commands.Param(min_length=4, max_length=4)):
-    pin = pin.strip(); udata = get_user_data(inter.author.id)
-    if udata.get("pin") is None: await inter.response.send_message("❌ No PIN set.", ephemeral=True); return
-    if udata.get("pin") != pin: await inter.response.send_message("❌ Incorrect PIN.", ephemeral=True); return
-    if not isinstance(udata.get("balance"), (int, float)): udata["balance"] = 0
-    if not isinstance(udata.get("savings"), (int, float)): udata["savings"] = 0
-    if udata["balance"] < amount: await inter.response.send_message(f"❌ Insufficient funds.", ephemeral=True); return
-    udata["balance"] -= amount; udata["savings"] += amount
+    pin = pin.strip(); econ = await guild_economies.get(inter.guild.id); udata = econ.get_user_data(inter.author.id)
+    if udata.pin is None: await inter.response.send_message("❌ No PIN set.", ephemeral=True); return
+    if udata.pin != pin: await inter.response.send_message("❌ Incorrect PIN.", ephemeral=True); return
+    try: await econ.balance_ops.move(inter.author.id, to_milli(amount), "balance", "savings")
+    except InsufficientFunds: await inter.response.send_message(f"❌ Insufficient funds.", ephemeral=True); return
     logger.info(f"User {inter.author} deposited {amount}.")
-    save_user_data(); await inter.response.send_message(f"✅ Deposited {amount:,}.\nSav: {int(udata['savings']):,}, Bal: {int(udata['balance']):,}", ephemeral=True)
+    await inter.response.send_message(f"✅ Deposited {amount:,}.\nSav: {fmt_coins(udata.savings)}, Bal: {fmt_coins(udata.balance)}", ephemeral=True)
 @savings_base.sub_command(name="withdraw", description="Withdraw from savings.")
 async def savings_withdraw(inter: disnake.ApplicationCommandInteraction, amount: int = commands.Param(gt=0), pin: str = commands.Param(min_length=4, max_length=4)):
-    pin = pin.strip(); udata = get_user_data(inter.author.id)
-    if udata.get("pin") is None: await inter.response.send_message("❌ No PIN set.", ephemeral=True); return
-    if udata.get("pin") != pin: await inter.response.send_message("❌ Incorrect PIN.", ephemeral=True); return
-    if not isinstance(udata.get("balance"), (int, float)): udata["balance"] = 0
-    if not isinstance(udata.get("savings"), (int, float)): udata["savings"] = 0
-    if udata["savings"] < amount: await inter.response.send_message(f"❌ Insufficient savings.", ephemeral=True); return
-    udata["savings"] -= amount; udata["balance"] += amount
+    pin = pin.strip(); econ = await guild_economies.get(inter.guild.id); udata = econ.get_user_data(inter.author.id)
+    if udata.pin is None: await inter.response.send_message("❌ No PIN set.", ephemeral=True); return
+    if udata.pin != pin: await inter.response.send_message("❌ Incorrect PIN.", ephemeral=True); return
+    try: await econ.balance_ops.move(inter.author.id, to_milli(amount), "savings", "balance")
+    except InsufficientFunds: await inter.response.send_message(f"❌ Insufficient savings.", ephemeral=True); return
     logger.info(f"User {inter.author} withdrew {amount}.")
-    save_user_data(); await inter.response.send_message(f"✅ Withdrew {amount:,}.\nSav: {int(udata['savings']):,}, Bal: {int(udata['balance']):,}", ephemeral=True)
+    await inter.response.send_message(f"✅ Withdrew {amount:,}.\nSav: {fmt_coins(udata.savings)}, Bal: {fmt_coins(udata.balance)}", ephemeral=True)
+
+# --- Slot Animation ---
+class TokenBucket:
+    def __init__(self, capacity: float, per_second: float):
+        self.capacity = capacity; self.per_second = per_second; self.tokens = capacity; self.updated = time_module.monotonic()
+    def _refill(self):
+        now = time_module.monotonic(); self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.per_second); self.updated = now
+    def try_take(self) -> bool:
+        self._refill()
+        if self.tokens < 1: return False
+        self.tokens -= 1; return True
+    def take(self): self._refill(); self.tokens -= 1 # May go negative: the debt delays later frames
+    def drain(self): self._refill(); self.tokens = min(self.tokens, 0)
+class AnimationScheduler:
+    """Renders animation frames through per-route token buckets plus one global bucket.
+
+    A route is the channel being edited in; its bucket is shared by every animation there, so back-to-back spins in one
+    channel draw from the same budget. Intermediate frames are dropped (the next one supersedes them) whenever either
+    bucket is empty, so animations degrade to fewer frames instead of queuing behind 429s. The final frame is always sent.
+    An edit slower than ANIMATION_SLOW_EDIT_SECONDS (the HTTP client sat out a rate limit) drains the route's bucket.
+    Idle routes whose bucket has refilled are dropped (a new bucket would be identical).
+    """
+    def __init__(self, global_per_second: float, route_burst: int, route_per_second: float):
+        self.global_bucket = TokenBucket(global_per_second, global_per_second); self.route_burst = route_burst; self.route_per_second = route_per_second
+        self._routes: dict[int, TokenBucket] = {}; self._playing: dict[int, int] = {} # route -> animations in progress
+        self.stats = {"animations": 0, "frames_sent": 0, "frames_dropped": 0, "slow_edits": 0}
+    def _bucket(self, route: int) -> TokenBucket:
+        if (bucket := self._routes.get(route)) is None: bucket = self._routes[route] = TokenBucket(self.route_burst, self.route_per_second)
+        return bucket
+    def _prune(self):
+        for route, bucket in list(self._routes.items()):
+            if route in self._playing: continue
+            bucket._refill()
+            if bucket.tokens >= bucket.capacity: del self._routes[route]
+    async def _edit(self, bucket: TokenBucket, edit, embed: disnake.Embed):
+        started = time_module.monotonic(); await edit(embed=embed); self.stats["frames_sent"] += 1
+        if time_module.monotonic() - started > ANIMATION_SLOW_EDIT_SECONDS: self.stats["slow_edits"] += 1; bucket.drain(); self.global_bucket.drain()
+    async def play(self, route: int, edit, frames: list[tuple[disnake.Embed, float]], final: disnake.Embed):
+        """Shows `frames` (embed, seconds to hold it) via `edit(embed=...)`, then `final`. `route` is the channel ID."""
+        self.stats["animations"] += 1; self._prune()
+        bucket = self._bucket(route); self._playing[route] = self._playing.get(route, 0) + 1
+        try:
+            for embed, hold_seconds in frames:
+                if bucket.try_take():
+                    if self.global_bucket.try_take(): await self._edit(bucket, edit, embed)
+                    else: bucket.tokens += 1; self.stats["frames_dropped"] += 1
+                else: self.stats["frames_dropped"] += 1
+                await asyncio.sleep(hold_seconds)
+            bucket.take(); self.global_bucket.take(); await self._edit(bucket, edit, final)
+        finally:
+            if (left := self._playing[route] - 1): self._playing[route] = left
+            else: del self._playing[route]
+    def summary(self) -> str:
+        st = self.stats
+        return (f"animations={st['animations']} frames sent/dropped={st['frames_sent']}/{st['frames_dropped']} slow_edits={st['slow_edits']} "
+                f"playing={sum(self._playing.values())} routes={len(self._routes)}")
+animation_scheduler = AnimationScheduler(ANIMATION_EDITS_PER_SECOND, ANIMATION_ROUTE_BURST, ANIMATION_ROUTE_EDITS_PER_SECOND)
+def slots_turbo(econ: GuildEconomy, user_id: int) -> bool: return bool(econ.bot_data.get("slots_turbo_users", {}).get(str(user_id), SLOTS_TURBO_DEFAULT))
+def slot_settings(econ: GuildEconomy) -> tuple[float, float]:
+    """The guild's (jackpot contribution rate, jackpot override chance), validated."""
+    contribution_rate = econ.bot_data.get("slot_jackpot_contribution", DEFAULT_SLOT_JACKPOT_CONTRIBUTION)
+    override_chance = econ.bot_data.get("slot_jackpot_override_chance", DEFAULT_SLOT_JACKPOT_OVERRIDE_CHANCE)
+    if not isinstance(contribution_rate, float) or not (0.0 <= contribution_rate <= 1.0): contribution_rate = DEFAULT_SLOT_JACKPOT_CONTRIBUTION
+    if not isinstance(override_chance, float) or not (0.0 <= override_chance <= 1.0): override_chance = DEFAULT_SLOT_JACKPOT_OVERRIDE_CHANCE
+    return contribution_rate, override_chance
+def resolve_slots_spin(econ: GuildEconomy, stake: Milli) -> dict:
+    """Draws the reels and applies jackpot pool changes. Returns the outcome; the caller settles the bet and winnings."""
+    if not isinstance(econ.bot_data.get("slot_jackpot_pool"), int): econ.bot_data["slot_jackpot_pool"] = 0
+    contribution_rate, override_chance = slot_settings(econ)
+    reels, outcome, winnings, pool_delta = spin_slots(random, stake, econ.bot_data["slot_jackpot_pool"], contribution_rate, override_chance)
+    econ.adjust_pool("slot_jackpot_pool", pool_delta)
+    if outcome in ("jackpot", "override"): payout_desc = f"🎉 **JACKPOT!** Won **{fmt_coins(winnings)}**!"; color = disnake.Color.gold()
+    elif outcome == "triple": payout_desc = f"💰 3 of a kind! Won **{fmt_coins(winnings)}**!"; color = disnake.Color.green()
+    elif outcome == "pair": payout_desc = f"👍 Pair! Won **{fmt_coins(winnings)}**!"; color = disnake.Color.blue()
+    else: payout_desc = f"😥 Lost. {fmt_coins(pool_delta)} ({contribution_rate:.0%}) added to jackpot."; color = disnake.Color.red()
+    return {"reels": reels, "winnings": winnings, "payout_desc": payout_desc, "color": color, "jackpot_hit": outcome in ("jackpot", "override"), "override_win": outcome == "override"}
+def resolve_slots_rounds(econ: GuildEconomy, stake: Milli, rounds: int) -> dict:
+    """Plays `rounds` spins in one pass against a local copy of the pool, then applies the net pool change once."""
+    if not isinstance(econ.bot_data.get("slot_jackpot_pool"), int): econ.bot_data["slot_jackpot_pool"] = 0
+    contribution_rate, override_chance = slot_settings(econ)
+    pool = start_pool = econ.bot_data["slot_jackpot_pool"]; winnings = 0; best = 0; counts = dict.fromkeys(games.SLOT_OUTCOMES, 0)
+    for _ in range(rounds):
+        _, outcome, won, pool_delta = spin_slots(random, stake, pool, contribution_rate, override_chance)
+        pool += pool_delta; winnings += won; best = max(best, won); counts[outcome] += 1
+    econ.adjust_pool("slot_jackpot_pool", pool - start_pool)
+    return {"winnings": winnings, "best": best, "counts": counts, "pool_delta": pool - start_pool}
+def rounds_summary_embed(title: str, stake: Milli, rounds: int, winnings: Milli, distribution: list[tuple[str, int]], new_balance: Milli) -> disnake.Embed:
+    """One embed for a batch of rounds: totals plus how often each outcome came up."""
+    net = winnings - stake * rounds
+    embed = disnake.Embed(title=title, color=disnake.Color.green() if net > 0 else disnake.Color.red() if net < 0 else disnake.Color.greyple())
+    embed.add_field(name="Rounds", value=f"{rounds:,} × {fmt_coins(stake)}", inline=True); embed.add_field(name="Total Bet", value=fmt_coins(stake * rounds), inline=True)
+    embed.add_field(name="Total Won", value=fmt_coins(winnings), inline=True)
+    embed.add_field(name="Outcomes", value="\n".join(f"{label}: **{count:,}** ({count / rounds:.1%})" for label, count in distribution if count) or "-", inline=False)
+    embed.add_field(name="Net", value=("+" if net >= 0 else "") + fmt_coins(net), inline=True); embed.add_field(name="Your New Balance", value=f"{fmt_coins(new_balance)} coins", inline=True)
+    return embed
+async def settle_rounds(econ: GuildEconomy, inter: disnake.ApplicationCommandInteraction, stake: Milli, rounds: int, resolve) -> tuple[dict, UserRecord] | None:
+    """Debits the whole stake, resolves every round and credits the total in one step, then marks the user dirty once.
+    Returns (batch, user data), or None after telling the user they can't cover the stake."""
+    user_id = inter.author.id
+    try: batch, udata = await econ.balance_ops.bet(user_id, stake * rounds, resolve)
+    except InsufficientFunds as e: await inter.response.send_message(f"❌ Insufficient balance for {rounds:,} rounds ({fmt_coins(stake * rounds)} needed, have {fmt_coins(e.available)}).", ephemeral=True); return None
+    econ.save_economy(user_id)
+    return batch, udata
 
 # --- Gambling Commands ---
-@bot.slash_command(name="gamble", description="Try your luck!")
+@bot.slash_command(name="gamble", description="Try your luck!", dm_permission=False)
 async def gamble_base(inter: disnake.ApplicationCommandInteraction): pass
 @gamble_base.sub_command(name="slots", description="Spin the slot machine!")
-async def gamble_slots(inter: disnake.ApplicationCommandInteraction, amount: int = commands.Param(ge=1)):
-    user_id = inter.author.id; udata = get_user_data(user_id)
-    if not isinstance(udata.get("balance"), (int, float)): udata["balance"] = 0
-    if udata["balance"] < amount: await inter.response.send_message(f"❌ Insufficient balance.", ephemeral=True); return
+async def gamble_slots(inter: disnake.ApplicationCommandInteraction, amount: int = commands.Param(ge=1), rounds: int = commands.Param(default=1, ge=1, le=MAX_GAMBLE_ROUNDS, description="Spin this many times at once (one summary).")):
+    user_id = inter.author.id; stake = to_milli(amount); econ = await guild_economies.get(inter.guild.id)
+    if rounds > 1:
+        if not (settled := await settle_rounds(econ, inter, stake, rounds, lambda: resolve_slots_rounds(econ, stake, rounds))): return
+        batch, udata = settled; c = batch["counts"]
+        logger.info(f"User {user_id} slots x{rounds}. Bet:{amount}, Win:{fmt_coins(batch['winnings'])}, Outcomes:{c}")
+        embed = rounds_summary_embed(f"🎰 {inter.author.display_name}'s {rounds:,} Spins 🎰", stake, rounds, batch["winnings"],
+                                     [("🎉 Jackpot", c["jackpot"] + c["override"]), ("💰 3 of a kind", c["triple"]), ("👍 Pair", c["pair"]), ("😥 Loss", c["loss"])], udata.balance)
+        embed.add_field(name="Jackpot Pool", value=f"{fmt_coins(econ.bot_data['slot_jackpot_pool'])} coins ({'+' if batch['pool_delta'] >= 0 else ''}{fmt_coins(batch['pool_delta'])})", inline=True)
+        await inter.response.send_message(embed=embed)
+        econ.record_win(user_id, batch["best"]); await announce_big_win(inter, inter.author, batch["best"], "Slots"); return
+    try: spin, udata = await econ.balance_ops.bet(user_id, stake, lambda: resolve_slots_spin(econ, stake)) # Bet, outcome, payout and jackpot update settle together, before any rendering
+    except InsufficientFunds: await inter.response.send_message(f"❌ Insufficient balance.", ephemeral=True); return
+    logger.info(f"User {user_id} slots. Bet:{amount}, Win:{fmt_coins(spin['winnings'])}, Override:{spin['override_win']}")
+    econ.save_economy(user_id)
+    result_embed = disnake.Embed(title=f"🎰 {inter.author.display_name}'s Result 🎰", description=" ".join(spin["reels"]), color=spin["color"]).set_footer(text=f"Bet: {amount:,}")
+    result_embed.add_field(name="Result", value=spin["payout_desc"], inline=False)
+    result_embed.add_field(name="Your New Balance", value=f"{fmt_coins(udata.balance)} coins", inline=True)
+    result_embed.add_field(name="Jackpot Pool", value=f"{fmt_coins(econ.bot_data['slot_jackpot_pool'])} coins", inline=True)
     await inter.response.defer(ephemeral=False)
-    load_bot_data(); udata["balance"] -= amount
-    initial_embed = disnake.Embed(title=f"🎰 {inter.author.display_name}'s Spin 🎰", description="❓ ❓ ❓", color=disnake.Color.dark_gold()).set_footer(text=f"Bet: {amount:,}")
-    try: await inter.edit_original_message(embed=initial_embed)
-    except Exception as e: logger.warning(f"Slots init fail: {e}"); udata["balance"] += amount; save_user_data(); await inter.followup.send("Error starting slots.", ephemeral=True); return
-    spin_count = random.randint(4, 7); final_reels = [random.choice(SLOT_EMOJIS) for _ in range(3)]
-    for i in range(spin_count):
-        display_reels = [random.choice(SLOT_EMOJIS) for _ in range(3)] if i < spin_count - 1 else final_reels
-        spin_embed = disnake.Embed(title=f"🎰 {inter.author.display_name}'s Spin 🎰", description=" ".join(display_reels), color=disnake.Color.dark_gold()).set_footer(text=f"Bet: {amount:,} | Spinning...")
-        try: await inter.edit_original_message(embed=spin_embed); await asyncio.sleep(0.6 - i*0.07)
-        except Exception: break
-    reels = final_reels; result_embed = disnake.Embed(title=f"🎰 {inter.author.display_name}'s Result 🎰", description=" ".join(reels)).set_footer(text=f"Bet: {amount:,}")
-    winnings = 0; payout_desc = ""; jackpot_hit = False; is_loss = False; override_win = False
-    if not isinstance(bot_data.get("slot_jackpot_pool"), float): bot_data["slot_jackpot_pool"] = 0.0
-    jackpot_pool = bot_data["slot_jackpot_pool"]
-    contribution_rate = bot_data.get("slot_jackpot_contribution", DEFAULT_SLOT_JACKPOT_CONTRIBUTION)
-    override_chance = bot_data.get("slot_jackpot_override_chance", DEFAULT_SLOT_JACKPOT_OVERRIDE_CHANCE)
-    if not isinstance(contribution_rate, float) or not (0.0 <= contribution_rate <= 1.0): contribution_rate = DEFAULT_SLOT_JACKPOT_CONTRIBUTION
-    if not isinstance(override_chance, float) or not (0.0 <= override_chance <= 1.0): override_chance = DEFAULT_SLOT_JACKPOT_OVERRIDE_CHANCE
-    natural_win = False
-    if reels[0] == reels[1] == reels[2]:
-        if reels[0] == SLOT_JACKPOT_EMOJI: winnings = amount + (jackpot_pool * 0.50); bot_data["slot_jackpot_pool"] *= 0.50; payout_desc = f"🎉 **JACKPOT!** Won **{winnings:,.2f}**!"; result_embed.color = disnake.Color.gold(); jackpot_hit = True; natural_win = True
-        else: winnings = amount * 10; payout_desc = f"💰 3 of a kind! Won **{winnings:,}**!"; result_embed.color = disnake.Color.green(); natural_win = True
-    elif reels[0] == reels[1] or reels[1] == reels[2] or reels[0] == reels[2]: winnings = amount * 2; payout_desc = f"👍 Pair! Won **{winnings:,}**!"; result_embed.color = disnake.Color.blue(); natural_win = True
-    if not natural_win:
-        if override_chance > 0 and random.random() < override_chance: winnings = amount + (jackpot_pool * 0.50); bot_data["slot_jackpot_pool"] *= 0.50; payout_desc = f"🎉 **JACKPOT!** Won **{winnings:,.2f}**!"; result_embed.color = disnake.Color.gold(); jackpot_hit = True; override_win = True
-        else: is_loss = True
-    if is_loss and not override_win:
-        contribution = amount * contribution_rate; bot_data["slot_jackpot_pool"] += contribution
-        payout_desc = f"😥 Lost. {contribution:,.2f} ({contribution_rate:.0%}) added to jackpot."; result_embed.color = disnake.Color.red()
-    if not isinstance(winnings, (int, float)): winnings = 0
-    udata["balance"] += winnings
-    if not isinstance(udata["balance"], (int, float)): udata["balance"] = 0
-    result_embed.add_field(name="Result", value=payout_desc, inline=False)
-    result_embed.add_field(name="Your New Balance", value=f"{int(udata['balance']):,} coins", inline=True)
-    result_embed.add_field(name="Jackpot Pool", value=f"{bot_data['slot_jackpot_pool']:,.2f} coins", inline=True)
-    logger.info(f"User {user_id} slots. Bet:{amount}, Win:{winnings:.2f}, Override:{override_win}")
-    save_bot_data(); save_user_data()
-    await announce_big_win(inter, inter.author, winnings, "Slots")
-    await inter.edit_original_message(embed=result_embed)
+    frames = []
+    if not slots_turbo(econ, user_id):
+        frames.append((disnake.Embed(title=f"🎰 {inter.author.display_name}'s Spin 🎰", description="❓ ❓ ❓", color=disnake.Color.dark_gold()).set_footer(text=f"Bet: {amount:,}"), 0.6))
+        spin_count = random.randint(4, 7)
+        for i in range(spin_count):
+            display_reels = [random.choice(SLOT_EMOJIS) for _ in range(3)] if i < spin_count - 1 else spin["reels"]
+            frames.append((disnake.Embed(title=f"🎰 {inter.author.display_name}'s Spin 🎰", description=" ".join(display_reels), color=disnake.Color.dark_gold()).set_footer(text=f"Bet: {amount:,} | Spinning..."), 0.6 - i * 0.07))
+    try: await animation_scheduler.play(inter.channel_id, inter.edit_original_message, frames, result_embed)
+    except Exception as e: # The spin is already settled; only the display failed
+        logger.warning(f"Slots render fail for {user_id}: {e}")
+        try: await inter.followup.send(embed=result_embed)
+        except Exception: pass
+    econ.record_win(user_id, spin["winnings"]); await announce_big_win(inter, inter.author, spin["winnings"], "Slots")
+@gamble_base.sub_command(name="turbo", description="Skip the slot animation and show results instantly.")
+async def gamble_turbo(inter: disnake.ApplicationCommandInteraction, enabled: bool):
+    econ = await guild_economies.get(inter.guild.id); econ.bot_data.setdefault("slots_turbo_users", {})[str(inter.author.id)] = enabled; econ.save_bot_data()
+    await inter.response.send_message(f"⚡ Turbo slots **{'on' if enabled else 'off'}**.", ephemeral=True)
 @gamble_base.sub_command(name="dice", description="Guess the roll of a 6-sided die.")
-async def gamble_dice(inter: disnake.ApplicationCommandInteraction, guess: int = commands.Param(ge=1, le=6), amount: int = commands.Param(ge=1)):
-    user_id = inter.author.id; udata = get_user_data(user_id)
-    if not isinstance(udata.get("balance"), (int, float)): udata["balance"] = 0
-    if udata["balance"] < amount: await inter.response.send_message(f"❌ Insufficient balance.", ephemeral=True); return
+async def gamble_dice(inter: disnake.ApplicationCommandInteraction, guess: int = commands.Param(ge=1, le=6), amount: int = commands.Param(ge=1), rounds: int = commands.Param(default=1, ge=1, le=MAX_GAMBLE_ROUNDS, description="Roll this many times at once (one summary).")):
+    user_id = inter.author.id; stake = to_milli(amount); econ = await guild_economies.get(inter.guild.id)
+    if rounds > 1:
+        def resolve():
+            faces = [0] * 6
+            for _ in range(rounds): faces[random.randint(1, 6) - 1] += 1
+            return {"faces": faces, "winnings": faces[guess - 1] * dice_win(stake)}
+        if not (settled := await settle_rounds(econ, inter, stake, rounds, resolve)): return
+        batch, udata = settled; emojis = ["1️⃣", "2️⃣", "3️⃣", "4️⃣", "5️⃣", "6️⃣"]
+        logger.info(f"User {user_id} dice x{rounds}. Bet:{amount}, Guess:{guess}, Faces:{batch['faces']}")
+        embed = rounds_summary_embed(f"🎲 {inter.author.display_name} rolled Dice {rounds:,} times!", stake, rounds, batch["winnings"],
+                                     [(f"{emojis[i]}{' ✅' if i == guess - 1 else ''}", n) for i, n in enumerate(batch["faces"])], udata.balance)
+        await inter.response.send_message(embed=embed)
+        best = dice_win(stake) if batch["winnings"] else 0; econ.record_win(user_id, best); await announce_big_win(inter, inter.author, best, "Dice"); return
+    def roll_die():
+        roll = random.randint(1, 6); return {"roll": roll, "winnings": dice_payout(guess, roll, stake)}
+    try: outcome, udata = await econ.balance_ops.bet(user_id, stake, roll_die) # Settled before the defer: no await between bet and payout
+    except InsufficientFunds: await inter.response.send_message(f"❌ Insufficient balance.", ephemeral=True); return
     await inter.response.defer(ephemeral=False)
-    udata["balance"] -= amount; roll = random.randint(1, 6); dice_emoji = ["1️⃣", "2️⃣", "3️⃣", "4️⃣", "5️⃣", "6️⃣"][roll-1]
+    roll = outcome["roll"]; winnings = outcome["winnings"]; dice_emoji = ["1️⃣", "2️⃣", "3️⃣", "4️⃣", "5️⃣", "6️⃣"][roll-1]
     result = disnake.Embed(title=f"🎲 {inter.author.display_name} rolled Dice!", footer=f"Bet:{amount:,}|Guess:{guess}", description=f"Rolled: {dice_emoji}")
-    winnings = 0
-    if guess == roll: winnings = amount * DICE_WIN_MULTIPLIER; udata["balance"] += winnings; result.add_field(name="Result", value=f"🎉 Correct! Won **{winnings:,}**!", inline=False); result.color = disnake.Color.green()
+    if winnings: result.add_field(name="Result", value=f"🎉 Correct! Won **{fmt_coins(winnings)}**!", inline=False); result.color = disnake.Color.green()
     else: result.add_field(name="Result", value=f"😥 Incorrect (was {roll}).", inline=False); result.color = disnake.Color.red()
-    if not isinstance(udata["balance"], (int, float)): udata["balance"] = 0
-    result.add_field(name="Your New Balance", value=f"{int(udata['balance']):,} coins", inline=False)
+    result.add_field(name="Your New Balance", value=f"{fmt_coins(udata.balance)} coins", inline=False)
     logger.info(f"User {user_id} dice. Bet:{amount}, Guess:{guess}, Roll:{roll}")
-    save_user_data()
-    await announce_big_win(inter, inter.author, winnings, "Dice")
+    econ.record_win(user_id, winnings); await announce_big_win(inter, inter.author, winnings, "Dice")
     await inter.edit_original_message(embed=result)
 @gamble_base.sub_command(name="redblack", description="Bet red (even) or black (odd).")
 @commands.cooldown(1, REDBLACK_COOLDOWN_SECONDS, commands.BucketType.user)
-async def gamble_redblack(inter: disnake.ApplicationCommandInteraction, choice: str = commands.Param(choices=["red", "black"]), amount: int = commands.Param(ge=1)):
-    user_id = inter.author.id; udata = get_user_data(user_id)
-    if not isinstance(udata.get("balance"), (int, float)): udata["balance"] = 0
-    if udata["balance"] < amount: inter.application_command.reset_cooldown(inter); await inter.response.send_message(f"❌ Insufficient balance.", ephemeral=True); return
+async def gamble_redblack(inter: disnake.ApplicationCommandInteraction, choice: str = commands.Param(choices=["red", "black"]), amount: int = commands.Param(ge=1), rounds: int = commands.Param(default=1, ge=1, le=MAX_GAMBLE_ROUNDS, description="Play this many times at once (one summary).")):
+    user_id = inter.author.id; stake = to_milli(amount); econ = await guild_economies.get(inter.guild.id)
+    if rounds > 1:
+        def resolve():
+            reds = sum(1 for _ in range(rounds) if redblack_is_red(random.randint(1, 36)))
+            wins = reds if choice == "red" else rounds - reds
+            return {"reds": reds, "wins": wins, "winnings": wins * redblack_win(stake)}
+        if not (settled := await settle_rounds(econ, inter, stake, rounds, resolve)): inter.application_command.reset_cooldown(inter); return
+        batch, udata = settled
+        logger.info(f"User {user_id} R/B x{rounds}. Bet:{amount}, Choice:{choice}, Reds:{batch['reds']}")
+        embed = rounds_summary_embed(f"🎡 {inter.author.display_name} played Red/Black {rounds:,} times!", stake, rounds, batch["winnings"],
+                                     [(f"🔴 Red{' ✅' if choice == 'red' else ''}", batch["reds"]), (f"⚫ Black{' ✅' if choice == 'black' else ''}", rounds - batch["reds"])], udata.balance)
+        await inter.response.send_message(embed=embed)
+        best = redblack_win(stake) if batch["wins"] else 0; econ.record_win(user_id, best); await announce_big_win(inter, inter.author, best, "Red/Black"); return
+    def spin_wheel():
+        roll = random.randint(1, 36); return {"roll": roll, "winnings": redblack_payout(choice, roll, stake)}
+    try: outcome, udata = await econ.balance_ops.bet(user_id, stake, spin_wheel) # Settled before the defer: no await between bet and payout
+    except InsufficientFunds: inter.application_command.reset_cooldown(inter); await inter.response.send_message(f"❌ Insufficient balance.", ephemeral=True); return
     await inter.response.defer(ephemeral=False)
-    udata["balance"] -= amount; roll = random.randint(1, 36); is_red = (roll % 2 == 0)
+    roll = outcome["roll"]; winnings = outcome["winnings"]; is_red = redblack_is_red(roll)
     color = "Red" if is_red else "Black"; emoji = "🔴" if is_red else "⚫"
     result = disnake.Embed(title=f"{emoji} {inter.author.display_name} played Red/Black!", footer=f"Bet:{amount:,}|Choice:{choice.capitalize()}", description=f"Rolled: **{roll}** ({color})")
-    winnings = 0; match = (choice == "red" and is_red) or (choice == "black" and not is_red)
-    if match: winnings = int(amount*REDBLACK_WIN_MULTIPLIER); udata["balance"] += winnings; result.add_field(name="Result", value=f"🎉 Correct! Won **{winnings:,}**!", inline=False); result.color = disnake.Color.red() if is_red else disnake.Color.black()
+    if winnings: result.add_field(name="Result", value=f"🎉 Correct! Won **{fmt_coins(winnings)}**!", inline=False); result.color = disnake.Color.red() if is_red else disnake.Color.black()
     else: result.add_field(name="Result", value=f"😥 Incorrect (was {color}).", inline=False); result.color = disnake.Color.dark_grey()
-    if not isinstance(udata["balance"], (int, float)): udata["balance"] = 0
-    result.add_field(name="Your New Balance", value=f"{int(udata['balance']):,} coins", inline=False)
+    result.add_field(name="Your New Balance", value=f"{fmt_coins(udata.balance)} coins", inline=False)
     logger.info(f"User {user_id} R/B. Bet:{amount}, Choice:{choice}, Roll:{roll}({color})")
-    save_user_data()
-    await announce_big_win(inter, inter.author, winnings, "Red/Black")
+    econ.record_win(user_id, winnings); await announce_big_win(inter, inter.author, winnings, "Red/Black")
     await inter.edit_original_message(embed=result)
 @gamble_redblack.error
 async def redblack_error(inter: disnake.ApplicationCommandInteraction, error):
     msg = None
-    if isinstance(error, commands.CommandOnCooldown): msg = f"⏳ Cooldown {error.retry_after:.1f}s."
+    if is_lease_held(error): inter.application_command.reset_cooldown(inter); msg = SERVED_ELSEWHERE
+    elif isinstance(error, commands.CommandOnCooldown): msg = f"⏳ Cooldown {error.retry_after:.1f}s."
     elif isinstance(error, commands.UserInputError): msg = f"Invalid input: {error}"
     else: logger.error(f"Error in redblack: {error}", exc_info=True); msg = "Unexpected error."
     try:
@@ -848,40 +1731,31 @@ async def redblack_error(inter: disnake.ApplicationCommandInteraction, error):
     except Exception as e: logger.error(f"Failed R/B error response: {e}")
 
 # --- Lottery Commands ---
-@bot.slash_command(name="lottery", description="Coin lottery.")
+@bot.slash_command(name="lottery", description="Coin lottery.", dm_permission=False)
 async def lottery_base(inter: disnake.ApplicationCommandInteraction): pass
 @lottery_base.sub_command(name="buy", description="Buy lottery tickets.")
 async def lottery_buy(inter: disnake.ApplicationCommandInteraction, tickets: int = commands.Param(ge=1, default=1)):
-    user_id = inter.author.id; udata = get_user_data(user_id); load_bot_data()
+    user_id = inter.author.id; econ = await guild_economies.get(inter.guild.id)
     cost = LOTTERY_TICKET_PRICE * tickets
-    if not isinstance(udata.get("balance"), (int, float)): udata["balance"] = 0
-    if not isinstance(bot_data.get("lottery_pot"), (int, float)): bot_data["lottery_pot"] = 0.0
-    if not isinstance(bot_data.get("lottery_tickets"), list): bot_data["lottery_tickets"] = []
-    if udata["balance"] < cost: await inter.response.send_message(f"❌ Need {cost:,}, have {int(udata['balance']):,}.", ephemeral=True); return
-    udata["balance"] -= cost; bot_data["lottery_pot"] += cost; bot_data["lottery_tickets"].extend([user_id] * tickets)
-    logger.info(f"User {user_id} bought {tickets} tickets for {cost}.")
-    save_bot_data(); save_user_data()
-    await inter.response.send_message(f"🎟️ Bought {tickets} ticket(s) for {cost:,}!\nBal: {int(udata['balance']):,}, Pot: {bot_data['lottery_pot']:,.2f}", ephemeral=True)
+    if not isinstance(econ.bot_data.get("lottery_pot"), int): econ.bot_data["lottery_pot"] = 0
+    try: udata = await econ.balance_ops.debit(user_id, cost)
+    except InsufficientFunds as e: await inter.response.send_message(f"❌ Need {fmt_coins(cost)}, have {fmt_coins(e.available)}.", ephemeral=True); return
+    econ.adjust_pool("lottery_pot", cost); econ.lottery_tickets.add(user_id, tickets)
+    logger.info(f"User {user_id} bought {tickets} tickets for {fmt_coins(cost)}.")
+    econ.save_economy(user_id); await schedule_lottery_draw(econ) # The round's first ticket starts its countdown
+    await inter.response.send_message(f"🎟️ Bought {tickets} ticket(s) for {fmt_coins(cost)}! You hold {econ.lottery_tickets.count(user_id):,}.\nBal: {fmt_coins(udata.balance)}, Pot: {fmt_coins(econ.bot_data['lottery_pot'])}", ephemeral=True)
 @lottery_base.sub_command(name="info", description="Show lottery info.")
 async def lottery_info(inter: disnake.ApplicationCommandInteraction):
-    load_bot_data(); pot = bot_data.get('lottery_pot', 0.0); tickets = bot_data.get('lottery_tickets', [])
-    if not isinstance(pot, (int, float)): pot = 0.0
-    if not isinstance(tickets, list): tickets = []
-    count = len(tickets); next_draw = "Not scheduled"
-    if lottery_drawing.is_running():
-        next_dt = lottery_drawing.next_iteration
-        if next_dt:
-             if next_dt.tzinfo is None: next_dt = next_dt.replace(tzinfo=timezone.utc)
-             now = datetime.datetime.now(timezone.utc); delta = next_dt - now
-             if delta.total_seconds() > 0:
-                 secs = int(delta.total_seconds()); h, r = divmod(secs, 3600); m, s = divmod(r, 60)
-                 parts = [f"{x}{u}" for x, u in zip([h, m, s], ['h', 'm', 's']) if x > 0]
-                 next_draw = f"in {' '.join(parts) or 'soon'} (<t:{int(next_dt.timestamp())}:R>)"
-             else: next_draw = "Drawing soon!"
-        else: next_draw = "Calculating..."
+    econ = await guild_economies.get(inter.guild.id); pot = econ.bot_data.get('lottery_pot', 0)
+    if not isinstance(pot, int): pot = 0
+    count = econ.lottery_tickets.total; mine = econ.lottery_tickets.count(inter.author.id); next_draw = "Starts with the first ticket"
+    if isinstance(draw_at := econ.bot_data.get("lottery_next_draw"), (int, float)): # Per guild: the round's first ticket + its interval
+        next_draw = f"<t:{int(draw_at)}:R>" if draw_at > time_module.time() else "Drawing soon!"
+    else: next_draw += f" ({econ.lottery_interval_hours():g}h rounds)"
     embed = disnake.Embed(title="🎟️ Lottery Info 🎟️", color=disnake.Color.gold())
-    embed.add_field(name="Pot", value=f"{pot:,.2f} 💰", inline=True); embed.add_field(name="Tickets", value=f"{count:,}", inline=True)
-    embed.add_field(name="Price", value=f"{LOTTERY_TICKET_PRICE:,}", inline=True); embed.add_field(name="Next Draw", value=next_draw, inline=False)
+    embed.add_field(name="Pot", value=f"{fmt_coins(pot)} 💰", inline=True); embed.add_field(name="Tickets", value=f"{count:,}", inline=True)
+    if mine: embed.add_field(name="Your Tickets", value=f"{mine:,} ({mine / count:.2%} chance)", inline=True)
+    embed.add_field(name="Price", value=fmt_coins(LOTTERY_TICKET_PRICE), inline=True); embed.add_field(name="Next Draw", value=next_draw, inline=False)
     await inter.response.send_message(embed=embed, ephemeral=False)
 
 # --- Role Checks ---
@@ -918,7 +1792,8 @@ async def supporter_nickname(inter: disnake.ApplicationCommandInteraction, new_n
 @supporter_base.error
 async def supporter_error(inter: disnake.ApplicationCommandInteraction, error):
     msg = "Supporter cmd error.";
-    if isinstance(error, commands.CheckFailure): msg = str(error)
+    if is_lease_held(error): msg = SERVED_ELSEWHERE
+    elif isinstance(error, commands.CheckFailure): msg = str(error)
     else: logger.error(f"Supporter Error: {error}", exc_info=True)
     try:
         if not inter.response.is_done(): await inter.response.send_message(msg, ephemeral=True)
@@ -944,7 +1819,8 @@ async def vip_embed(inter: disnake.ApplicationCommandInteraction, message: str =
 @vip_base.error
 async def vip_error(inter: disnake.ApplicationCommandInteraction, error):
     msg = "VIP cmd error.";
-    if isinstance(error, commands.CheckFailure): msg = str(error)
+    if is_lease_held(error): msg = SERVED_ELSEWHERE
+    elif isinstance(error, commands.CheckFailure): msg = str(error)
     else: logger.error(f"VIP Error: {error}", exc_info=True)
     try:
         if not inter.response.is_done(): await inter.response.send_message(msg, ephemeral=True)
@@ -952,71 +1828,54 @@ async def vip_error(inter: disnake.ApplicationCommandInteraction, error):
     except Exception: pass
 
 # --- Custom Help Command ---
+HELP_CATEGORY_ORDER = ["Money", "Savings", "Gambling", "Lottery", "Shop", "Supporter Perks", "VIP Perks", "Admin", "General"]
+HELP_GROUP_CATEGORIES = {"shop": "Shop", "savings": "Savings", "gamble": "Gambling", "lottery": "Lottery", "supporter": "Supporter Perks", "vip": "VIP Perks"}
+HELP_PROFILES = [(True, False, False, False)] + [(False, ctx, sup, vip) for ctx in (False, True) for sup in (False, True) for vip in (False, True)] # (server admin, admin context, supporter, VIP)
+def help_profile(inter: disnake.ApplicationCommandInteraction) -> tuple[bool, bool, bool, bool]:
+    """The permission bits /help output depends on; a server admin sees everything, so the other bits are dropped."""
+    if not inter.guild or not isinstance(inter.author, disnake.Member): return (False, False, False, False)
+    if inter.author.guild_permissions.administrator: return (True, False, False, False)
+    is_admin_context = inter.author.id == inter.guild.owner_id or inter.channel_id == ADMIN_CHANNEL_ID
+    return (False, is_admin_context, check_role(inter, SUPPORTER_ROLE_ID), check_role(inter, VIP_ROLE_ID))
+def help_entries() -> dict[str, list[dict]]:
+    """Category -> sorted command entries (usage string, description, required access) from the current command tree."""
+    def fmt_params(opts: list[disnake.Option]) -> str: return " ".join([f"<{o.name}>" if o.required else f"[{o.name}]" for o in sorted(opts, key=lambda o: not o.required)])
+    cmap: dict[str, list[dict]] = {}
+    for cmd in bot.slash_commands:
+        name = cmd.name
+        if name == "help" or getattr(cmd, "parent", None): continue # Skip help itself; subcommands are listed under their group
+        cat = "Admin" if isinstance(cmd.cog, ShopAdminCog) else HELP_GROUP_CATEGORIES.get(name, "Money")
+        access = {"admin": cat == "Admin", "supporter": cat == "Supporter Perks", "vip": cat == "VIP Perks"}
+        if getattr(cmd, "children", None):
+            for sub_cmd in cmd.children.values():
+                if isinstance(sub_cmd, (commands.InvokableSlashCommand, commands.SubCommand)): # Nested groups are not listed
+                    cmap.setdefault(cat, []).append({"cmd_string": f"</{name} {sub_cmd.name} {fmt_params(sub_cmd.options)}>".strip(), "description": sub_cmd.description or "...", **access})
+        elif isinstance(cmd, commands.InvokableSlashCommand):
+            cmap.setdefault(cat, []).append({"cmd_string": f"</{name} {fmt_params(cmd.options)}>".strip(), "description": cmd.description or "...", **access})
+    for entries in cmap.values(): entries.sort(key=lambda c: c["cmd_string"])
+    return cmap
+def build_help_pages(profile: tuple[bool, bool, bool, bool]) -> list[disnake.Embed]:
+    """The embeds /help sends for a permission profile (at most 10, one message)."""
+    is_server_admin, is_admin_context, is_sup, is_vip = profile; cmap = help_entries(); embeds = []
+    for cat in HELP_CATEGORY_ORDER:
+        acc_cmds = [f"`{info['cmd_string']}`\n{info['description']}" for info in cmap.get(cat, ())
+                    if is_server_admin or not ((info["admin"] and not is_admin_context) or (info["supporter"] and not is_sup) or (info["vip"] and not is_vip))]
+        if not acc_cmds: continue
+        val = "\n\n".join(acc_cmds)
+        if len(val) > 4096: embeds += [disnake.Embed(title=f"**{cat} ({i + 1})**", description=val[j:j + 4000], color=disnake.Color.blurple()) for i, j in enumerate(range(0, len(val), 4000))]
+        else: embeds.append(disnake.Embed(title=f"**{cat}**", description=val, color=disnake.Color.blurple()))
+    if not embeds: return [disnake.Embed(title=f"{bot.user.name} Help", description="No commands accessible.", color=disnake.Color.blurple()).set_footer(text="<> required, [] optional.")]
+    if len(embeds) == 1: return embeds
+    more = len(embeds) > 10; embeds = embeds[:10]
+    embeds[0].title = f"{bot.user.name} Help"; embeds[0].description = (("Categories(1/many):" if more else "Categories:") + "\n\n" + embeds[0].description).strip()
+    embeds[0].set_footer(text="<> req, [] opt. More cmds." if more else "<> req, [] opt.")
+    return embeds
 @bot.slash_command(name="help", description="Shows available commands.")
 async def help_command(inter: disnake.ApplicationCommandInteraction):
-    await inter.response.defer(ephemeral=True)
     try:
-        embeds = []; base = disnake.Embed(title=f"{bot.user.name} Help", color=disnake.Color.blurple()).set_footer(text="<> required, [] optional.")
-        cmap = {}; pgroups = set();
-        def fmt_params(opts: list[disnake.Option]) -> str: return " ".join([f"<{o.name}>" if o.required else f"[{o.name}]" for o in sorted(opts, key=lambda o: not o.required)])
-        is_server_admin = False
-        if inter.guild and isinstance(inter.author, disnake.Member): is_server_admin = inter.author.guild_permissions.administrator
-        for cmd in bot.slash_commands:
-            name = cmd.name;
-            if hasattr(cmd, 'parent') and cmd.parent and name in pgroups: continue
-            if name == "help": continue # Skip help itself
-            cat = "General"; adm = False; sup = False; vip = False
-            if isinstance(cmd.cog, ShopAdminCog): cat = "Admin"; adm = True
-            elif name == "shop": cat = "Shop"
-            elif name == "savings": cat = "Savings"
-            elif name == "gamble": cat = "Gambling"
-            elif name == "lottery": cat = "Lottery"
-            elif name == "supporter": cat = "Supporter Perks"; sup = True
-            elif name == "vip": cat = "VIP Perks"; vip = True
-            elif name == "balance": cat = "Money"
-            elif name == "pay": cat = "Money"
-            else: cat = "Money"
-            if cat not in cmap: cmap[cat] = []
-            if hasattr(cmd, 'children') and cmd.children:
-                pgroups.add(name)
-                for sub_cmd in cmd.children.values():
-                    if isinstance(sub_cmd, commands.InvokableSlashCommand):
-                        ps = fmt_params(sub_cmd.options); s = f"</{name} {sub_cmd.name} {ps}>".strip()
-                        sub_cat = cat; sub_adm = adm; sub_sup = sup; sub_vip = vip
-                        if sub_cat not in cmap: cmap[sub_cat] = []
-                        cmap[sub_cat].append({"cmd_string": s, "description": sub_cmd.description or "...", "admin": sub_adm, "supporter": sub_sup, "vip": sub_vip })
-            elif isinstance(cmd, commands.InvokableSlashCommand):
-                if hasattr(cmd, 'parent') and cmd.parent and cmd.parent.name in pgroups: continue
-                ps = fmt_params(cmd.options); s = f"</{name} {ps}>".strip()
-                cmap[cat].append({"cmd_string": s, "description": cmd.description or "...", "admin": adm, "supporter": sup, "vip": vip })
-        order = ["Money", "Savings", "Gambling", "Lottery", "Shop", "Supporter Perks", "VIP Perks", "Admin", "General"]
-        is_admin_context = False
-        if not is_server_admin and inter.guild and isinstance(inter.author, disnake.Member): is_admin_context = (inter.author.id == inter.guild.owner_id or inter.channel_id == ADMIN_CHANNEL_ID)
-        is_sup = check_role(inter, SUPPORTER_ROLE_ID); is_vip = check_role(inter, VIP_ROLE_ID); accessible_count = 0
-        for cat in order:
-            if cat in cmap:
-                acc_cmds = []
-                for info in sorted(cmap[cat], key=lambda c: c['cmd_string']):
-                    can_access = True
-                    if not is_server_admin: # Apply checks only if not server admin
-                        if info["admin"] and not is_admin_context: can_access = False
-                        if info["supporter"] and not is_sup: can_access = False
-                        if info["vip"] and not is_vip: can_access = False
-                    if can_access: acc_cmds.append(f"`{info['cmd_string']}`\n{info['description']}")
-                if acc_cmds:
-                    accessible_count += 1; cat_embed = disnake.Embed(title=f"**{cat}**", color=disnake.Color.blurple())
-                    val = "\n\n".join(acc_cmds)
-                    if len(val) > 4096:
-                         parts = [val[i:i+4000] for i in range(0, len(val), 4000)]
-                         for i, p in enumerate(parts): embeds.append(disnake.Embed(title=f"**{cat} ({i+1})**", description=p, color=disnake.Color.blurple()))
-                    else: cat_embed.description = val; embeds.append(cat_embed)
-        if accessible_count == 0: base.description = "No commands accessible."; await inter.followup.send(embed=base, ephemeral=True)
-        elif len(embeds) == 1: await inter.followup.send(embed=embeds[0], ephemeral=True)
-        elif len(embeds) <= 10:
-             embeds[0].title = f"{bot.user.name} Help"; embeds[0].description = ("Categories:\n\n" + embeds[0].description).strip(); embeds[0].set_footer(text="<> req, [] opt.")
-             await inter.followup.send(embeds=embeds, ephemeral=True)
-        else: embeds[0].title = f"{bot.user.name} Help"; embeds[0].description = ("Categories(1/many):\n\n" + embeds[0].description).strip(); embeds[0].set_footer(text="<> req, [] opt. More cmds.")
-        await inter.followup.send(embeds=embeds[:10], ephemeral=True)
+        profile = help_profile(inter)
+        if (pages := bot.help_pages.get(profile)) is None: pages = bot.help_pages[profile] = build_help_pages(profile) # Only after a cog/command change
+        await inter.response.send_message(embeds=pages, ephemeral=True)
     except Exception as e:
         logger.error(f"Error generating help command: {e}", exc_info=True)
         await inter.followup.send("❌ Error generating help message.", ephemeral=True)
@@ -1031,7 +1890,21 @@ async def on_close():
     logger.info("Shutting down...");
     if autosave_data.is_running(): autosave_data.cancel(); logger.info("Autosave cancelled.")
     if lottery_drawing.is_running(): lottery_drawing.cancel(); logger.info("Lottery cancelled.")
-    await asyncio.sleep(1); logger.info("Final save..."); save_user_data(); save_shop_items(); save_bot_data(); logger.info("Save complete.")
+    if flush_dirty_loop.is_running(): flush_dirty_loop.cancel(); logger.info("Write-behind flusher cancelled.")
+    if reconcile_money_supply_loop.is_running(): reconcile_money_supply_loop.cancel()
+    if shop_file_watch.is_running(): shop_file_watch.cancel()
+    if order_digest.is_running(): order_digest.cancel()
+    if journal_flush_loop.is_running(): journal_flush_loop.cancel()
+    if message_reward_loop.is_running(): message_reward_loop.cancel()
+    if journal_snapshot_loop.is_running(): journal_snapshot_loop.cancel()
+    if evict_idle_guilds.is_running(): evict_idle_guilds.cancel()
+    if cluster_heartbeat.is_running(): cluster_heartbeat.cancel()
+    if bot.metrics_server: bot.metrics_server.close()
+    if retro_scan_task and not retro_scan_task.done(): retro_scan_task.cancel(); logger.info("Retro scan cancelled.")
+    await asyncio.sleep(1); logger.info(f"Final save of {len(guild_economies)} guild economies...")
+    await guild_economies.close() # Each unload credits rewards, flushes, writes the journal, closes the ledger and releases the guild's lease
+    await run_io(cluster.release_all); await run_io(cluster.close) # Leadership passes on now instead of after the lease runs out
+    persist_executor.shutdown(wait=True); logger.info(f"Save complete. {guild_economies.summary()}")
 
 if __name__ == "__main__":
     if not DISCORD_BOT_TOKEN: print("FATAL: Bot token missing.")